@@ -0,0 +1,181 @@
+# coding: utf8
+''' 批次將多本書的 XML 轉換為 EPUB
+用法:
+	python batch.py manifest.json [-j 4]
+	python batch.py manifest.csv --defaults defaults.json
+
+manifest 可以是 JSON 或 CSV:
+	JSON: {"defaults": {...}, "books": [{...}, {...}]}, 或只有 books 的 list
+	CSV: 第一列是 config 的 key, 之後每一列是一本書
+每本書的 config 與 x2epub.XmlToEpub 相同, 沒有設定的 key 使用 defaults (例如 css, license_template, publisher, epub_ver)。
+路徑以 manifest 所在的資料夾為基準。
+沒有設定 temp_folder 時直接寫出 EPUB; defaults 有 temp_folder 時, 每本書使用其下以編號命名的資料夾。
+某本書轉換失敗不會中斷其他書, 最後列出所有失敗的書, 有失敗時 exit code 為 1。
+有設定 epub_validator 時, 不在每本書轉換完就驗證, 而是全部轉換完之後以 validate.check_many() 同時驗證,
+先做 precheck, 沒通過的書不再執行 epubcheck; 驗證失敗也算失敗。
+有 targets 的書驗證其中每個 EPUB (HTML 資料夾不驗證)。
+'''
+import argparse
+import collections
+import concurrent.futures
+import csv
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+import validate
+import x2epub
+
+# config 中代表路徑的 key, 以 manifest 所在資料夾為基準
+PATH_KEYS = ('xml', 'css', 'cover_page', 'license_template', 'epub_path', 'temp_folder',
+	'graphic_base', 'glyph_base', 'epub_validator', 'asset_cache', 'cache_folder', 'image_cache', 'profile')
+# CSV 讀進來都是字串, 這些 key 要轉換型別
+INT_KEYS = ('epub_ver', 'workers', 'compress_level', 'compress_threads', 'split_size')
+BOOL_KEYS = ('convert_lb_to_br', 'streaming', 'huge_tree', 'remove_comments', 'remove_pis', 'precheck', 'profile_memory')
+# 可以是 True/False 或路徑的 key
+BOOL_OR_PATH_KEYS = ('profile',)
+
+def read_manifest(path):
+	''' 讀取 manifest, 傳回 (defaults, books) '''
+	if path.lower().endswith('.csv'):
+		with open(path, 'r', encoding='utf-8-sig', newline='') as fi:
+			books = [convert_csv_row(row) for row in csv.DictReader(fi)]
+		return {}, books
+	with open(path, 'r', encoding='utf-8-sig') as fi:
+		data = json.load(fi)
+	if isinstance(data, list):
+		return {}, data
+	return data.get('defaults', {}), data['books']
+
+def convert_csv_row(row):
+	r = {}
+	for k, v in row.items():
+		if v is None or v == '':
+			continue
+		if k in INT_KEYS:
+			v = int(v)
+		elif k in BOOL_KEYS:
+			v = v.lower() in ('1', 'true', 'yes')
+		elif k in BOOL_OR_PATH_KEYS and v.lower() in ('0', '1', 'false', 'true', 'no', 'yes'):
+			v = v.lower() in ('1', 'true', 'yes')
+		r[k] = v
+	return r
+
+def make_configs(defaults, books, base):
+	''' 合併 defaults 與每本書的設定, 並將路徑轉為以 base 為基準 '''
+	temp_base = defaults.get('temp_folder')
+	configs = []
+	for i, book in enumerate(books, 1):
+		config = dict(defaults)
+		config.update(book)
+		if temp_base is not None and 'temp_folder' not in book:
+			config['temp_folder'] = os.path.join(temp_base, str(i))
+		for k in PATH_KEYS:
+			if isinstance(config.get(k), str): # profile 也可以是 True
+				config[k] = os.path.join(base, config[k])
+		if 'targets' in config:
+			config['targets'] = dict((k, os.path.join(base, v)) for k, v in config['targets'].items())
+		configs.append(config)
+	return configs
+
+def convert_book(config):
+	''' 在 worker process 中轉換一本書, 傳回 (是否成功, 秒數, 錯誤訊息) '''
+	t = time.time()
+	try:
+		if x2epub.XmlToEpub(config).convert() is False:
+			return False, time.time() - t, 'config 中沒有 xml 或 lxml-etree'
+	except Exception:
+		return False, time.time() - t, traceback.format_exc()
+	return True, time.time() - t, None
+
+def run(configs, jobs=None, out=sys.stdout):
+	''' 同時轉換多本書, 每完成一本就輸出一行進度, 傳回失敗的 [(config, 錯誤訊息)] '''
+	failures = []
+	total = len(configs)
+	done = 0
+	to_validate = collections.defaultdict(list) # epub_validator => 轉換成功的 config
+	with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+		futures = {}
+		for config in configs:
+			if 'epub_validator' in config:
+				config = dict(config)
+				checker = config.pop('epub_validator')
+			else:
+				checker = None
+			futures[pool.submit(convert_book, config)] = (config, checker)
+		for future in concurrent.futures.as_completed(futures):
+			config, checker = futures[future]
+			done += 1
+			name = config.get('xml', config.get('epub_path', ''))
+			try:
+				ok, seconds, error = future.result()
+			except Exception:
+				# worker process 異常結束
+				ok, seconds, error = False, 0, traceback.format_exc()
+			if ok:
+				print('[{}/{}] ok {} ({:.1f}s)'.format(done, total, name, seconds), file=out, flush=True)
+				if checker is not None:
+					to_validate[checker].append(config)
+			else:
+				print('[{}/{}] FAIL {}'.format(done, total, name), file=out, flush=True)
+				failures.append((config, error))
+	
+	for checker, validate_configs in to_validate.items():
+		epubs = [(config, path) for config in validate_configs for path in epub_paths(config)]
+		print('驗證 {} 個 EPUB...'.format(len(epubs)), file=out, flush=True)
+		results = validate.check_many([path for config, path in epubs], checker, jobs)
+		invalid = {} # id(config) => (config, 錯誤訊息 list), 一本書有多個 EPUB 沒通過時只算一次失敗
+		for (config, path), r in zip(epubs, results):
+			if not r.ok:
+				print('INVALID {}'.format(r.path), file=out, flush=True)
+				invalid.setdefault(id(config), (config, []))[1].append(format_problems(r.problems))
+		failures.extend((config, '\n'.join(errors)) for config, errors in invalid.values())
+	return failures
+
+def epub_paths(config):
+	''' 一本書寫出的 EPUB 路徑: targets 中的 epub3、epub2, 沒有 targets 時是 epub_path; HTML 資料夾不驗證 '''
+	if 'targets' in config:
+		return [path for format, path in config['targets'].items() if x2epub.TARGET_FORMATS[format] is not None]
+	if isinstance(config.get('epub_path'), str):
+		return [config['epub_path']]
+	return []
+
+def format_problems(problems):
+	lines = []
+	for p in problems:
+		lines.append('{} {}({}): {}'.format(p.level, p.file, p.line, p.message))
+	return '\n'.join(lines)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='批次將 XML 轉換為 EPUB')
+	parser.add_argument('manifest', help='JSON 或 CSV 格式的書單')
+	parser.add_argument('-j', '--jobs', type=int, default=None, help='同時轉換的 process 數, 預設為 CPU 核心數')
+	parser.add_argument('--defaults', help='JSON 格式的共用設定, 會被 manifest 中的 defaults 覆蓋')
+	parser.add_argument('-v', '--verbose', action='store_true', help='輸出轉換過程的訊息 (缺字等)')
+	args = parser.parse_args(argv)
+	if args.verbose:
+		logging.basicConfig(level=logging.DEBUG, format='%(processName)s %(name)s: %(message)s')
+
+	defaults = {}
+	if args.defaults is not None:
+		with open(args.defaults, 'r', encoding='utf-8-sig') as fi:
+			defaults = json.load(fi)
+	manifest_defaults, books = read_manifest(args.manifest)
+	defaults.update(manifest_defaults)
+	base = os.path.dirname(os.path.abspath(args.manifest))
+	configs = make_configs(defaults, books, base)
+
+	failures = run(configs, args.jobs)
+	print('{} 本, 成功 {}, 失敗 {}'.format(len(configs), len(configs) - len(failures), len(failures)))
+	for config, error in failures:
+		print('=' * 40)
+		print(config.get('xml', config.get('epub_path', '')))
+		print(error)
+	if len(failures) > 0:
+		return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,343 @@
+# coding: utf8
+''' 效能測試: 產生各種大小的合成 TEI XML, 量測 XmlToEpub.convert() 及 create_archive() 的時間與記憶體
+用法:
+	python benchmark.py --sizes 100k,1m,10m --save result.json
+	python benchmark.py --sizes 100k,1m,10m --baseline result.json     # 與之前的結果比較, 變慢超過 tolerance 時 exit code 為 1
+	python benchmark.py --sizes 1m --config '{"streaming": true}' --memory
+
+合成的 XML 依照 schema/ebook.rnc (另加 TEI 的 charDecl 缺字), 可以調整章數以外的結構:
+	--depth 每章 div 的層數, --sections 每層的子 div 數, --paragraphs 最內層 div 的段落數,
+	--notes 每段的章節末註解數, --glyphs charDecl 中的缺字數, --tables, --figures 每章的表格及圖片數
+章數依 --sizes 指定的 XML 大小 (100k, 1m, 10m, 100m, 500m 或 bytes 數) 決定。
+產生的 XML 及圖片存在 --work 資料夾, 參數相同時會重複使用。
+每個大小在新的 process 中轉換, 記錄 profile 報告 (見 profiling.py) 及 process 的最大 RSS。
+最大 RSS 在 Linux、macOS 以 resource 模組取得, Windows 需要 psutil (peak working set), 都沒有時顯示為 -。
+'''
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import struct
+import sys
+import time
+import zlib
+import lxml
+import x2epub
+try:
+	import resource
+except ImportError:
+	resource = None # Windows 沒有 resource 模組
+try:
+	import psutil
+except ImportError:
+	psutil = None
+
+SIZES = {'100k': 100 * 1000, '1m': 1000 * 1000, '10m': 10 * 1000 * 1000, '100m': 100 * 1000 * 1000, '500m': 500 * 1000 * 1000}
+
+DEFAULT_PARAMS = {
+	'depth': 2,
+	'sections': 3,
+	'paragraphs': 8,
+	'notes': 1,
+	'glyphs': 50,
+	'tables': 1,
+	'figures': 1,
+	'seed': 1,
+}
+
+# 合成內文用的字
+HANZI = ('佛法僧心性空無常苦我道德修行禪定智慧慈悲眾生煩惱菩提涅槃因緣果報世間出世間信願戒律經論'
+	'觀照念住身受心法戒定慧三學六度布施持戒忍辱精進般若聞思修正見正思惟正語正業正命正精進正念正定')
+WORDS = ('dharma', 'sangha', 'meditation', 'wisdom', 'compassion', 'practice', 'mind', 'nature', 'emptiness')
+
+def parse_size(s):
+	s = s.strip().lower()
+	if s in SIZES:
+		return SIZES[s]
+	return int(s)
+
+class Generator:
+	''' 產生合成的 TEI XML '''
+	def __init__(self, params):
+		self.params = dict(DEFAULT_PARAMS)
+		self.params.update(params)
+		self.random = random.Random(self.params['seed'])
+		r = self.random
+		# 先產生一些句子, 之後從中挑選, 產生大檔案時才夠快
+		self.sentences = []
+		for i in range(500):
+			if i % 10 == 0:
+				s = ' '.join(r.choice(WORDS) for j in range(r.randint(5, 15))) + '. '
+			else:
+				s = ''.join(r.choice(HANZI) for j in range(r.randint(10, 40))) + '。'
+			self.sentences.append(s)
+
+	def header(self):
+		p = self.params
+		s = '<?xml version="1.0" encoding="UTF-8"?>\n'
+		s += '<TEI xmlns="http://www.tei-c.org/ns/1.0">\n<teiHeader>\n<fileDesc>\n'
+		s += '<titleStmt><title>合成測試書</title><author>benchmark</author></titleStmt>\n'
+		s += '<publicationStmt><p>benchmark.py</p></publicationStmt>\n<sourceDesc><p>synthetic</p></sourceDesc>\n</fileDesc>\n'
+		if p['glyphs'] > 0:
+			s += '<encodingDesc><charDecl>\n'
+			for i in range(p['glyphs']):
+				s += '<char xml:id="c{}"><graphic url="glyphs/g{}.png"/></char>\n'.format(i, i)
+			s += '</charDecl></encodingDesc>\n'
+		s += '</teiHeader>\n<text>\n<front><div><p>{}</p></div></front>\n<body>\n'.format(self.text(3))
+		return s
+
+	def footer(self):
+		return '</body>\n</text>\n</TEI>\n'
+
+	def text(self, n):
+		return ''.join(self.random.choice(self.sentences) for i in range(n))
+
+	def paragraph(self):
+		p = self.params
+		r = self.random
+		parts = [self.text(r.randint(2, 6))]
+		for i in range(p['notes']):
+			parts.append('<note place="bottom">{}</note>'.format(self.text(1)))
+			parts.append(self.text(r.randint(1, 3)))
+		if p['glyphs'] > 0 and r.random() < 0.5:
+			parts.append('<g ref="#c{}"/>'.format(r.randrange(p['glyphs'])))
+			parts.append(self.text(1))
+		return '<p>{}</p>\n'.format(''.join(parts))
+
+	def leaf(self):
+		p = self.params
+		s = ''.join(self.paragraph() for i in range(p['paragraphs']))
+		s += '<quote><lg><l>{}</l><l>{}</l></lg></quote>\n'.format(self.text(1), self.text(1))
+		s += '<list type="bulleted"><item>{}</item><item>{}</item></list>\n'.format(self.text(1), self.text(1))
+		return s
+
+	def div(self, level):
+		p = self.params
+		s = '<div>\n<head>{}</head>\n'.format(self.text(1)[:12])
+		if level < p['depth']:
+			s += self.paragraph()
+			for i in range(p['sections']):
+				s += self.div(level + 1)
+		else:
+			s += self.leaf()
+		s += '</div>\n'
+		return s
+
+	def chapter(self, n):
+		p = self.params
+		s = '<div>\n<head>第{}章 {}</head>\n'.format(n, self.text(1)[:10])
+		s += self.paragraph()
+		for i in range(p['tables']):
+			s += '<table>'
+			for row in range(4):
+				s += '<row>' + ''.join('<cell>{}</cell>'.format(self.text(1)[:8]) for c in range(3)) + '</row>'
+			s += '</table>\n'
+		for i in range(p['figures']):
+			s += '<figure><graphic url="figures/f{}.png"/><head>圖 {}</head></figure>\n'.format((n + i) % 20, n)
+		if p['depth'] > 1:
+			for i in range(p['sections']):
+				s += self.div(2)
+		else:
+			s += self.leaf()
+		s += '</div>\n'
+		return s
+
+	def write(self, path, size):
+		''' 產生約 size bytes 的 XML 及其中用到的圖片, 傳回章數 '''
+		folder = os.path.dirname(path)
+		write_images(folder, self.params['glyphs'])
+		with open(path, 'w', encoding='utf8') as fo:
+			fo.write(self.header())
+			written = fo.tell()
+			n = 0
+			while written < size or n == 0:
+				n += 1
+				fo.write(self.chapter(n))
+				written = fo.tell()
+			fo.write(self.footer())
+		return n
+
+def write_png(path, width, height, rgb):
+	''' 不依賴 Pillow, 產生單色的 PNG '''
+	raw = b''.join(b'\x00' + bytes(rgb) * width for y in range(height))
+	def chunk(kind, data):
+		return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+	png = b'\x89PNG\r\n\x1a\n'
+	png += chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+	png += chunk(b'IDAT', zlib.compress(raw))
+	png += chunk(b'IEND', b'')
+	with open(path, 'wb') as fo:
+		fo.write(png)
+
+def write_images(folder, glyphs):
+	for sub in ('glyphs', 'figures'):
+		path = os.path.join(folder, sub)
+		if not os.path.exists(path):
+			os.makedirs(path)
+	for i in range(glyphs):
+		write_png(os.path.join(folder, 'glyphs', 'g{}.png'.format(i)), 24, 24, (i % 256, 0, 128))
+	for i in range(20):
+		write_png(os.path.join(folder, 'figures', 'f{}.png'.format(i)), 400, 300, (0, i * 12, 200))
+
+def prepare(work, size, params):
+	''' 產生 (或重複使用) 約 size bytes 的 XML, 傳回 (路徑, 章數) '''
+	key = json.dumps(params, sort_keys=True)
+	name = 'bench-{}-{}'.format(size, hashlib.sha1(key.encode('utf8')).hexdigest()[:8])
+	folder = os.path.join(work, name)
+	path = os.path.join(folder, 'book.xml')
+	info_path = os.path.join(folder, 'info.json')
+	if os.path.exists(info_path):
+		with open(info_path, 'r', encoding='utf8') as fi:
+			return path, json.load(fi)['chapters']
+	if os.path.exists(folder):
+		shutil.rmtree(folder)
+	os.makedirs(folder)
+	chapters = Generator(params).write(path, size)
+	with open(info_path, 'w', encoding='utf8') as fo:
+		json.dump({'size': size, 'params': params, 'chapters': chapters}, fo)
+	return path, chapters
+
+def max_rss():
+	''' 目前 process 的最大 RSS (bytes), 無法取得時傳回 None '''
+	if resource is not None:
+		rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		# macOS 的單位是 byte, Linux 等是 KB
+		return rss if sys.platform == 'darwin' else rss * 1024
+	if psutil is not None:
+		info = psutil.Process().memory_info()
+		return getattr(info, 'peak_wset', info.rss) # Windows 才有 peak_wset
+	return None
+
+def run_case(xml, config, memory):
+	''' 在 worker process 中轉換一次, 傳回 profile 報告及 process 的最大 RSS '''
+	folder = os.path.dirname(xml)
+	config = dict(config)
+	config['xml'] = xml
+	config.setdefault('epub_path', os.path.join(folder, 'book.epub'))
+	config.setdefault('temp_folder', os.path.join(folder, 'temp'))
+	config['huge_tree'] = True
+	config['profile'] = True
+	config['profile_memory'] = memory
+	report = x2epub.XmlToEpub(config).convert()
+	report['max_rss'] = max_rss()
+	report['epub_bytes'] = os.path.getsize(config['epub_path'])
+	if config['temp_folder'] is not None:
+		shutil.rmtree(config['temp_folder'], ignore_errors=True)
+	os.remove(config['epub_path'])
+	return report
+
+def measure(xml, config, memory, repeat):
+	''' 每次都在新啟動 (spawn) 的 process 中轉換, 才能量到各自的最大 RSS; 傳回 wall 最短的一次 '''
+	best = None
+	context = multiprocessing.get_context('spawn')
+	for i in range(repeat):
+		with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as pool:
+			report = pool.submit(run_case, xml, config, memory).result()
+		if best is None or report['wall'] < best['wall']:
+			best = report
+	return best
+
+def summarize(name, size, xml, chapters, report):
+	phases = dict((p['name'], p['wall']) for p in report['phases'])
+	return {
+		'size': name,
+		'xml_bytes': os.path.getsize(xml),
+		'chapters': chapters,
+		'epub_bytes': report['epub_bytes'],
+		'wall': report['wall'],
+		'cpu': report['cpu'],
+		'archive': phases.get('finish.archive'),
+		'max_rss': report['max_rss'],
+		'memory_peak': report['memory_peak'],
+		'phases': phases,
+		'handlers': report['handlers'][:10],
+	}
+
+def compare(results, baseline, tolerance, out=sys.stdout):
+	''' 與 baseline 比較 wall, archive 及 max_rss, 傳回超過 tolerance (比例) 的項目 '''
+	base = dict((r['size'], r) for r in baseline['results'])
+	regressions = []
+	for r in results:
+		b = base.get(r['size'])
+		if b is None:
+			continue
+		for key in ('wall', 'archive', 'max_rss'):
+			if r.get(key) is None or not b.get(key):
+				continue
+			ratio = r[key] / b[key]
+			flag = ''
+			if ratio > 1 + tolerance:
+				flag = ' REGRESSION'
+				regressions.append((r['size'], key, ratio))
+			unit = 1e6 if key == 'max_rss' else 1 # 記憶體以 MB 顯示
+			print('{:>6} {:<8} {:>10.3f} -> {:>10.3f} ({:+.1%}){}'.format(r['size'], key, b[key] / unit, r[key] / unit, ratio - 1, flag), file=out)
+	return regressions
+
+def format_row(r):
+	mb = r['xml_bytes'] / 1e6
+	rss = '{:>8.1f}MB'.format(r['max_rss'] / 1e6) if r['max_rss'] is not None else '{:>10}'.format('-')
+	return '{:>6} {:>9.1f}MB {:>6} {:>9.2f}s {:>7.2f}MB/s {:>8.2f}s {}'.format(
+		r['size'], mb, r['chapters'], r['wall'], mb / r['wall'] if r['wall'] > 0 else 0,
+		r['archive'] or 0, rss)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='XML 轉 EPUB 效能測試')
+	parser.add_argument('--sizes', default='100k,1m,10m', help='以逗號分隔的 XML 大小: 100k, 1m, 10m, 100m, 500m 或 bytes 數')
+	parser.add_argument('--work', default='benchmark', help='存放產生的 XML 的資料夾')
+	parser.add_argument('--config', default='{}', help='JSON 格式的額外 config, 例如 {"streaming": true, "workers": 4}')
+	parser.add_argument('--memory', action='store_true', help='以 tracemalloc 記錄記憶體高峰 (會變慢)')
+	parser.add_argument('--repeat', type=int, default=1, help='每個大小轉換的次數, 取最快的一次')
+	parser.add_argument('--save', help='將結果寫成 JSON 檔')
+	parser.add_argument('--baseline', help='之前以 --save 存下的結果, 與之比較')
+	parser.add_argument('--tolerance', type=float, default=0.2, help='比 baseline 慢多少比例以上算是退步, 預設 0.2')
+	parser.add_argument('--generate-only', action='store_true', help='只產生 XML, 不轉換')
+	for k, v in DEFAULT_PARAMS.items():
+		parser.add_argument('--' + k, type=int, default=v)
+	args = parser.parse_args(argv)
+
+	params = dict((k, getattr(args, k)) for k in DEFAULT_PARAMS)
+	config = json.loads(args.config)
+	results = []
+	if not args.generate_only:
+		print('{:>6} {:>11} {:>6} {:>10} {:>11} {:>9} {:>10}'.format('size', 'xml', 'chap', 'wall', 'speed', 'archive', 'max_rss'))
+	for name in args.sizes.split(','):
+		size = parse_size(name)
+		t = time.perf_counter()
+		xml, chapters = prepare(args.work, size, params)
+		if args.generate_only:
+			print('{} {} ({} 章, {:.1f}s)'.format(name, xml, chapters, time.perf_counter() - t), flush=True)
+			continue
+		report = measure(xml, config, args.memory, args.repeat)
+		r = summarize(name.strip(), size, xml, chapters, report)
+		results.append(r)
+		print(format_row(r), flush=True)
+
+	data = {
+		'python': platform.python_version(),
+		'lxml': lxml.__version__,
+		'machine': platform.platform(),
+		'cpu_count': os.cpu_count(),
+		'x2epub': x2epub.converter_version().hex()[:12],
+		'params': params,
+		'config': config,
+		'results': results,
+	}
+	if args.save is not None:
+		with open(args.save, 'w', encoding='utf8') as fo:
+			json.dump(data, fo, ensure_ascii=False, indent=1)
+	if args.baseline is not None:
+		with open(args.baseline, 'r', encoding='utf8') as fi:
+			baseline = json.load(fi)
+		regressions = compare(results, baseline, args.tolerance)
+		if len(regressions) > 0:
+			print('{} 項比 baseline 慢 {:.0%} 以上'.format(len(regressions), args.tolerance))
+			return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
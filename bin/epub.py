@@ -1,19 +1,43 @@
 ﻿# coding: utf_8_sig
 ''' 產生 EPUB 3.0 檔案
-環境: Python 3.3 
+環境: Python 3.7 以上
 EPUB 3.0 規格: http://idpf.org/epub
 2013.3.21-12.9 周邦信 修改自 https://code.google.com/p/python-epub-builder/
 '''
 from datetime import datetime, date
 import collections
+import concurrent.futures
+import contextlib
+import hashlib
 import mimetypes
 import os
 import shutil
-import subprocess
+import struct
+import threading
+import time
 import uuid
 import zipfile
+import zlib
+
+COPY_CHUNK = 1024 * 1024 # 複製檔案到 zip 時每次讀取的大小
+COMPRESS_LEVEL = 6 # XHTML, CSS, SVG 等檔案預設的 deflate 壓縮等級
+# 本身已經壓縮過的檔案, 放進 zip 時不再壓縮
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.m4a', '.woff', '.woff2')
+PENDING_LIMIT = 64 # ZipWriter 中同時壓縮中的檔案數上限, 限制記憶體用量
+# 每本書各自產生的檔案, 不放進 AssetCache
+GENERATED_EXTENSIONS = ('.htm', '.html', '.xhtml', '.opf', '.ncx')
+
+def charset_declaration(epub_ver):
+	''' XHTML 中的 charset 宣告 '''
+	if epub_ver == 3:
+		# 避開 epub validate 時產生的問題
+		return '<meta charset="utf-8" />'
+	return '<meta http-equiv="Content-Type" content="text/html; charset=utf-8" />'
 
 class TocNode:
+	# 大書的目錄節點、缺字圖片很多, 用 __slots__ 節省記憶體 (仍可 pickle)
+	__slots__ = ('title', 'href', 'children', 'play_order')
+	
 	def __init__(self):
 		self.title = ''
 		self.href = ''
@@ -21,6 +45,8 @@ class TocNode:
 		self.play_order = 0
 
 class EpubItem:
+	__slots__ = ('id', 'src_path', 'dest_path', 'html', 'mime_type', 'properties', 'written')
+	
 	def __init__(self):
 		self.id = ''
 		self.src_path = ''
@@ -28,6 +54,344 @@ class EpubItem:
 		self.html = None
 		self.mime_type = ''
 		self.properties = None
+		self.written = False # 已由 start_book() 或 start_epub() 之後的 add_html() 直接寫出
+
+class FolderWriter:
+	''' 將 EPUB 中的檔案寫到資料夾 root_dir, 之後再以 create_archive() 壓縮 '''
+	def __init__(self, root_dir):
+		self.root_dir = root_dir
+		
+	def _path(self, name):
+		path = os.path.join(self.root_dir, *name.split('/'))
+		folder = os.path.dirname(path)
+		if not os.path.exists(folder):
+			os.makedirs(folder)
+		return path
+		
+	def write_text(self, name, text, compress=True):
+		with open(self._path(name), 'w', encoding='utf8') as fout:
+			fout.write(text)
+			
+	def write_bytes(self, name, data, compress=True):
+		with open(self._path(name), 'wb') as fout:
+			fout.write(data)
+			
+	def write_chunks(self, name, chunks, compress=True):
+		''' chunks 是字串的 iterable, 逐段寫出, 不必先組成整個檔案 '''
+		with open(self._path(name), 'w', encoding='utf8') as fout:
+			for chunk in chunks:
+				fout.write(chunk)
+			
+	def copy_file(self, name, src_path, compress=True):
+		shutil.copyfile(src_path, self._path(name))
+		
+	def close(self):
+		pass
+
+class AssetCache:
+	''' 壓縮好的 zip entry 的快取, 存在 folder 中, 可以多本書 (多個 process) 共用
+	key 是檔案內容的 hash 及壓縮等級, 內容相同的 CSS、SVG 缺字圖等只壓縮一次,
+	之後直接把壓縮好的資料及 CRC 寫進 zip; HTML 等每本書不同的檔案, 以及不壓縮的檔案不放進快取 '''
+	HEADER = struct.Struct('<IQH') # CRC, 原始大小, compress_type
+	generated = False # 是否也快取 HTML 等每本書產生的檔案
+	
+	def __init__(self, folder):
+		self.folder = folder
+		self.hits = 0
+		self.misses = 0
+		
+	def key(self, data, level):
+		return '{}-{}'.format(hashlib.sha1(data).hexdigest(), level)
+		
+	def _path(self, key):
+		return os.path.join(self.folder, key[:2], key)
+		
+	def get(self, key):
+		''' 傳回 (CRC, 原始大小, compress_type, 壓縮後的資料), 沒有的話傳回 None '''
+		try:
+			with open(self._path(key), 'rb') as fi:
+				header = fi.read(self.HEADER.size)
+				payload = fi.read()
+		except OSError:
+			header = b''
+		if len(header) != self.HEADER.size:
+			self.misses += 1
+			return None
+		self.hits += 1
+		return self.HEADER.unpack(header) + (payload,)
+		
+	def put(self, key, info, payload):
+		path = self._path(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		# 先寫到暫存檔再改名, 避免同時寫入時讀到寫了一半的檔案
+		temp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+		with open(temp, 'wb') as fo:
+			fo.write(self.HEADER.pack(info.CRC, info.file_size, info.compress_type))
+			fo.write(payload)
+		os.replace(temp, path)
+
+class MemoryAssetCache(AssetCache):
+	''' 存在記憶體中的 AssetCache, 也快取 HTML 等產生的檔案
+	watch.py 重複寫出同一本書時使用, 內容沒有改變的章不必再壓縮; prune() 去掉上次之後沒有用到的資料 '''
+	generated = True
+	
+	def __init__(self):
+		self.entries = {} # key => (CRC, 原始大小, compress_type, 壓縮後的資料)
+		self.used = set()
+		self.hits = 0
+		self.misses = 0
+		
+	def get(self, key):
+		entry = self.entries.get(key)
+		if entry is None:
+			self.misses += 1
+		else:
+			self.hits += 1
+			self.used.add(key)
+		return entry
+		
+	def put(self, key, info, payload):
+		self.entries[key] = (info.CRC, info.file_size, info.compress_type, payload)
+		self.used.add(key)
+		
+	def prune(self):
+		for key in list(self.entries):
+			if key not in self.used:
+				del self.entries[key]
+		self.used = set()
+
+def is_asset(name):
+	''' 可以放進 AssetCache 的檔案: 不是每本書各自產生的 '''
+	return os.path.splitext(name)[1].lower() not in GENERATED_EXTENSIONS
+
+class RawZipFile:
+	''' 寫入已知 CRC 及大小的 zip entry (資料可以是已經壓縮好的), 只用公開的 zipfile.ZipInfo 記錄各 entry,
+	local file header、central directory 自己寫出, 不依賴 zipfile.ZipFile 的內部狀態
+	entry 數或大小超過 zip 的上限時, central directory 使用 zip64 格式 '''
+	LOCAL = struct.Struct('<4s2B4HL2L2H')
+	CENTRAL = struct.Struct('<4s4B4HL2L5H2L')
+	END = struct.Struct('<4s4H2LH')
+	END64 = struct.Struct('<4sQ2H2L4Q')
+	LOCATOR64 = struct.Struct('<4sLQL')
+	
+	def __init__(self, output):
+		self.own = isinstance(output, str)
+		self.fp = open(output, 'wb') if self.own else output
+		self.offset = 0 # 目前寫到的位置, 檔案物件不必支援 tell()
+		self.entries = [] # (ZipInfo, local file header 的位置)
+		
+	def _write(self, data):
+		self.fp.write(data)
+		self.offset += len(data)
+		
+	def start_entry(self, info):
+		''' 寫出 local file header, 之後以 write_data() 寫出 info.compress_size 個 byte 的資料 '''
+		if info.file_size >= 0xFFFFFFFF or info.compress_size >= 0xFFFFFFFF:
+			raise ValueError('zip entry 太大: {}'.format(info.filename))
+		name, flags = self._encode_name(info.filename)
+		self.entries.append((info, self.offset))
+		self._write(self.LOCAL.pack(b'PK\x03\x04', 20, 0, flags, info.compress_type, *self._dos_time(info),
+			info.CRC, info.compress_size, info.file_size, len(name), 0))
+		self._write(name)
+		
+	def write_data(self, data):
+		self._write(data)
+		
+	def write_entry(self, info, payload):
+		self.start_entry(info)
+		self._write(payload)
+		
+	@staticmethod
+	def _encode_name(name):
+		try:
+			return name.encode('ascii'), 0
+		except UnicodeEncodeError:
+			return name.encode('utf8'), 0x800 # 檔名是 UTF-8
+			
+	@staticmethod
+	def _dos_time(info):
+		y, m, d, hh, mm, ss = info.date_time
+		return (hh << 11) | (mm << 5) | (ss // 2), ((y - 1980) << 9) | (m << 5) | d
+		
+	def close(self):
+		''' 寫出 central directory '''
+		start = self.offset
+		for info, offset in self.entries:
+			name, flags = self._encode_name(info.filename)
+			extra = b''
+			if offset >= 0xFFFFFFFF:
+				extra = struct.pack('<2HQ', 1, 8, offset)
+				offset = 0xFFFFFFFF
+			version = 45 if extra else 20
+			self._write(self.CENTRAL.pack(b'PK\x01\x02', version, 3, version, 0, flags, info.compress_type,
+				*self._dos_time(info), info.CRC, info.compress_size, info.file_size,
+				len(name), len(extra), 0, 0, 0, info.external_attr, offset))
+			self._write(name)
+			self._write(extra)
+		size = self.offset - start
+		count = len(self.entries)
+		if count >= 0xFFFF or start >= 0xFFFFFFFF or size >= 0xFFFFFFFF:
+			end64 = self.offset
+			self._write(self.END64.pack(b'PK\x06\x06', self.END64.size - 12, 45, 45, 0, 0, count, count, size, start))
+			self._write(self.LOCATOR64.pack(b'PK\x06\x07', 0, end64, 1))
+			count = min(count, 0xFFFF)
+			size = min(size, 0xFFFFFFFF)
+			start = min(start, 0xFFFFFFFF)
+		self._write(self.END.pack(b'PK\x05\x06', 0, 0, count, count, size, start, 0))
+		if self.own:
+			self.fp.close()
+		else:
+			self.fp.flush()
+
+class ZipWriter:
+	''' 將 EPUB 中的檔案直接寫到 zip, 不經過暫存資料夾
+	output 可以是檔案路徑, 或是可寫入的檔案物件 (例如 io.BytesIO)
+	文字檔在 thread pool 中壓縮 (zlib 壓縮時會釋放 GIL), 寫入 zip 的順序仍與呼叫的順序相同
+	compress_level: XHTML, CSS, SVG 等檔案的 deflate 壓縮等級 (0-9, 0 表示不壓縮)
+	threads: 壓縮用的 thread 數, None 表示依 CPU 核心數
+	asset_cache: AssetCache, 內容相同的 CSS 等檔案使用之前壓縮好的資料 '''
+	def __init__(self, output, compress_level=COMPRESS_LEVEL, threads=None, asset_cache=None):
+		if isinstance(output, str):
+			folder = os.path.dirname(output)
+			if folder != '' and not os.path.exists(folder):
+				os.makedirs(folder)
+		self.zip = RawZipFile(output)
+		self.compress_level = compress_level
+		if threads is None:
+			threads = min(8, os.cpu_count() or 1)
+		self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+		self.pending = collections.deque() # 壓縮中的檔案, 依寫入 zip 的順序
+		self.asset_cache = asset_cache
+		
+	def _info(self, name):
+		info = zipfile.ZipInfo(name, time.localtime()[:6])
+		info.external_attr = 0o644 << 16
+		return info
+		
+	def write_text(self, name, text, compress=True):
+		self.write_bytes(name, text.encode('utf8'), compress)
+		
+	def write_bytes(self, name, data, compress=True):
+		level = 0
+		if compress and should_compress(name):
+			level = self.compress_level
+		if level > 0 and self.asset_cache is not None and (self.asset_cache.generated or is_asset(name)):
+			future = self._cached_entry(self._info(name), data, level)
+		else:
+			future = self.pool.submit(pack_entry, self._info(name), data, level)
+		self.pending.append(future)
+		self._write_pending(PENDING_LIMIT)
+		
+	def _cached_entry(self, info, data, level):
+		''' 從 asset_cache 取出壓縮好的資料, 沒有的話壓縮後存入 '''
+		cache = self.asset_cache
+		key = cache.key(data, level)
+		cached = cache.get(key)
+		if cached is None:
+			return self.pool.submit(pack_cached_entry, cache, key, info, data, level)
+		info.CRC, info.file_size, info.compress_type, payload = cached
+		info.compress_size = len(payload)
+		future = concurrent.futures.Future()
+		future.set_result((info, payload))
+		return future
+		
+	def write_chunks(self, name, chunks, compress=True):
+		''' chunks 是字串的 iterable, 邊產生邊壓縮, 不必先組成整個檔案 '''
+		level = 0
+		if compress and should_compress(name):
+			level = self.compress_level
+		future = concurrent.futures.Future()
+		future.set_result(pack_chunks(self._info(name), chunks, level))
+		self.pending.append(future)
+		self._write_pending(PENDING_LIMIT)
+		
+	def copy_file(self, name, src_path, compress=True):
+		if compress and should_compress(name):
+			with open(src_path, 'rb') as fi:
+				self.write_bytes(name, fi.read())
+			return
+		# 不壓縮的檔案 (圖片等) 分段複製, 大檔案不必整個讀進記憶體: 先算 CRC, 再寫出
+		self._write_pending(0)
+		info = self._info(name)
+		info.compress_type = zipfile.ZIP_STORED
+		crc = 0
+		size = 0
+		with open(src_path, 'rb') as fi:
+			for chunk in iter(lambda: fi.read(COPY_CHUNK), b''):
+				crc = zlib.crc32(chunk, crc)
+				size += len(chunk)
+			info.CRC = crc
+			info.file_size = info.compress_size = size
+			self.zip.start_entry(info)
+			fi.seek(0)
+			for chunk in iter(lambda: fi.read(COPY_CHUNK), b''):
+				self.zip.write_data(chunk)
+			
+	def _write_pending(self, limit):
+		''' 依序寫出已壓縮好的檔案, 直到壓縮中的檔案不超過 limit 個 '''
+		while len(self.pending) > 0 and (self.pending[0].done() or len(self.pending) > limit):
+			info, payload = self.pending.popleft().result()
+			self.zip.write_entry(info, payload)
+			
+	def close(self):
+		try:
+			self._write_pending(0)
+		finally:
+			self.pool.shutdown()
+		self.zip.close()
+
+def pack_chunks(info, chunks, level):
+	''' 同 pack_entry(), 但資料是逐段產生的字串, 只保留壓縮後的資料 '''
+	crc = 0
+	size = 0
+	parts = []
+	if level > 0:
+		c = zlib.compressobj(level, zlib.DEFLATED, -15)
+		info.compress_type = zipfile.ZIP_DEFLATED
+	else:
+		c = None
+		info.compress_type = zipfile.ZIP_STORED
+	for chunk in chunks:
+		data = chunk.encode('utf8')
+		crc = zlib.crc32(data, crc)
+		size += len(data)
+		if c is not None:
+			data = c.compress(data)
+		if len(data) > 0:
+			parts.append(data)
+	if c is not None:
+		parts.append(c.flush())
+	payload = b''.join(parts)
+	info.CRC = crc
+	info.file_size = size
+	info.compress_size = len(payload)
+	return info, payload
+
+def pack_cached_entry(cache, key, info, data, level):
+	''' 同 pack_entry(), 並將結果存入 AssetCache '''
+	info, payload = pack_entry(info, data, level)
+	cache.put(key, info, payload)
+	return info, payload
+
+def should_compress(name):
+	''' 本身已經壓縮過的檔案 (JPEG, PNG 等) 放進 zip 時不再壓縮 '''
+	return os.path.splitext(name)[1].lower() not in STORED_EXTENSIONS
+
+def pack_entry(info, data, level):
+	''' 設定 info 的 CRC 及大小, 傳回 (info, 要寫入 zip 的資料) '''
+	info.CRC = zlib.crc32(data)
+	info.file_size = len(data)
+	payload = data
+	info.compress_type = zipfile.ZIP_STORED
+	if level > 0:
+		c = zlib.compressobj(level, zlib.DEFLATED, -15)
+		compressed = c.compress(data) + c.flush()
+		# 壓縮後沒有變小就不壓縮
+		if len(compressed) < len(data):
+			payload = compressed
+			info.compress_type = zipfile.ZIP_DEFLATED
+	info.compress_size = len(payload)
+	return info, payload
 
 class EpubBook:
 	def __init__(self):
@@ -44,6 +408,19 @@ class EpubBook:
 		self.publisher = None
 		self.toc_depth = 0 # 目錄的深度, EPUB 2 目錄規格要用到, EPUB 3 就不需要
 		self.toc_style = 'none' # 控制目錄要不要自動加編號, 變數值同 CSS 的 list-style-type
+		self.started = False # 呼叫 start_book() 或 start_epub() 之後, add_html() 加入的 HTML 會直接寫出
+		self.writer = None # FolderWriter 或 ZipWriter
+		self.compress_level = COMPRESS_LEVEL # 直接寫 EPUB 時, XHTML, CSS 等檔案的壓縮等級
+		self.compress_threads = None # 直接寫 EPUB 時壓縮用的 thread 數, None 表示依 CPU 核心數
+		self.profiler = None # profiling.Profiler, 記錄寫出各部分的時間
+		self.image_optimizer = None # images.ImageOptimizer, 寫出圖片時先做最佳化
+		self.asset_cache = None # AssetCache, 直接寫 EPUB 時 CSS 等檔案使用之前壓縮好的資料
+		self.image_hashes = {} # 圖片內容的 hash => EpubItem, 內容相同的圖片只放一份
+		self.src_hashes = {} # 圖片來源路徑 => 內容的 hash
+		# add_html() 加入的 HTML 所用的 charset 宣告是依哪個版本產生的,
+		# 同一本書可以先後以不同的 epub_ver 寫出, 寫出時替換為 epub_ver 的 charset 宣告
+		self.html_ver = None
+		self.content_dir = 'OPS/' # HTML, 圖片, CSS 在 EPUB 中的資料夾
 		
 	def add_creator(self, name, role = 'aut'):
 		c = {'name': name, 'role': role}
@@ -64,8 +441,19 @@ class EpubBook:
 		self.items[dest_path] = item
 		
 	def add_image(self, src_path, dest_path):
+		''' 在電子書加入一個圖片, 傳回 EpubItem
+		有 image_optimizer 時, 電子書中的檔名可能與 dest_path 不同 (GIF 轉 PNG), 以傳回的 item.dest_path 為準 '''
+		if self.image_optimizer is not None:
+			dest_path = self.image_optimizer.dest_name(dest_path)
 		if dest_path in self.items:
 			return self.items[dest_path]
+		# 內容相同但檔名不同的圖片, 使用已加入的那一個
+		digest = self.src_hashes.get(src_path)
+		if digest is None:
+			digest = file_hash(src_path)
+			self.src_hashes[src_path] = digest
+		if digest in self.image_hashes:
+			return self.image_hashes[digest]
 		item = EpubItem()
 		if dest_path in ('cover.jpg', 'cover.png', 'cover.gif'):
 			item.id = 'cover-image'
@@ -73,15 +461,16 @@ class EpubBook:
 			item.id = 'image_%d' % (len(self.items) + 1)
 		item.src_path = src_path
 		item.dest_path = dest_path
-		if src_path.endswith('.jpg'):
+		if dest_path.endswith('.jpg'):
 			item.mime_type = 'image/jpeg'
-		elif src_path.endswith('.gif'):
+		elif dest_path.endswith('.gif'):
 			item.mime_type = 'image/gif'
-		elif src_path.endswith('.png'):
+		elif dest_path.endswith('.png'):
 			item.mime_type = 'image/png'
-		elif src_path.endswith('.svg'):
+		elif dest_path.endswith('.svg'):
 			item.mime_type = 'image/svg+xml'
 		self.items[dest_path] = item
+		self.image_hashes[digest] = item
 		return item
 
 	def add_html(self, src_path, dest_path, html=None, properties=None):
@@ -97,6 +486,10 @@ class EpubBook:
 		item.mime_type = 'application/xhtml+xml'
 		item.properties = properties
 		self.items[dest_path] = item
+		if self.started and html is not None:
+			self._write_html(item)
+			item.html = None
+			item.written = True
 		return item
 		
 	def add_toc_node(self, parent):
@@ -119,129 +512,148 @@ class EpubBook:
 	# _single_leading_underscore: weak "internal use" indicator. 
 	# E.g. from M import * does not import objects whose name starts with an underscore.
 	def _write_mimetype(self):
-		fout = open(os.path.join(self.root_dir, 'mimetype'), 'w')
-		fout.write('application/epub+zip')
-		fout.close()
+		# mimetype 必須是 zip 中的第一個檔案, 而且不壓縮
+		self.writer.write_text('mimetype', 'application/epub+zip', compress=False)
+		
+	def _write_html(self, item):
+		html = item.html
+		if self.html_ver is not None and self.html_ver != self.epub_ver:
+			html = html.replace(charset_declaration(self.html_ver), charset_declaration(self.epub_ver), 1)
+		self.writer.write_text(self.content_dir + item.dest_path, html)
 		
 	def _write_items(self):
 		for item in self.items.values():
+			if item.written:
+				continue
+			name = self.content_dir + item.dest_path
 			if item.html is None:
-				dest = os.path.join(self.root_dir, 'OPS', item.dest_path)
-				dest_folder = os.path.dirname(dest)
-				if not os.path.exists(dest_folder):
-					os.makedirs(dest_folder)
-				shutil.copyfile(item.src_path, dest)
+				if self.image_optimizer is not None and item.mime_type.startswith('image/'):
+					self.writer.write_bytes(name, self.image_optimizer.optimize(item.src_path, item.dest_path))
+				else:
+					self.writer.copy_file(name, item.src_path)
 			else:
-				path = os.path.join(self.root_dir, 'OPS', item.dest_path)
-				fout = open(path, 'w', encoding='utf8')
-				fout.write(item.html)
-				fout.close()
+				self._write_html(item)
 			
 	def _write_container_xml(self):
 		# container.xml 必須要實作在META-INF/ 之下，其內容是用來紀錄主要 EPUB 內容根檔案的mime type 與路徑
-		path = os.path.join(self.root_dir, 'META-INF', 'container.xml')
-		fout = open(path, 'w')
 		# <rootfile> 的 @full-path 屬性放的是 Package Document 的路徑
-		fout.write('''<?xml version="1.0" ?>
+		self.writer.write_text('META-INF/container.xml', '''<?xml version="1.0" ?>
 <container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
    <rootfiles>
       <rootfile full-path="OPS/content.opf" media-type="application/oebps-package+xml"/>
    </rootfiles>
 </container>''')
-		fout.close()
 		
 	def _write_content_OPF(self):
-		''' Package Document 
+		self.writer.write_chunks('OPS/content.opf', self._content_opf())
+		
+	def _content_opf(self):
+		''' Package Document, 逐段產生
 		規格: http://idpf.org/epub/30/spec/epub30-publications.html '''
-		s = '<?xml version="1.0" encoding="UTF-8"?>\n'
+		yield '<?xml version="1.0" encoding="UTF-8"?>\n'
 		if self.epub_ver == 2:
-			s += '<package version="2.0" xmlns="http://www.idpf.org/2007/opf" unique-identifier="BookId">\n'
+			yield '<package version="2.0" xmlns="http://www.idpf.org/2007/opf" unique-identifier="BookId">\n'
 		else:
-			s += '<package version="3.0" xmlns="http://www.idpf.org/2007/opf" unique-identifier="BookId">\n'
+			yield '<package version="3.0" xmlns="http://www.idpf.org/2007/opf" unique-identifier="BookId">\n'
 		
 		# metadate
 		if self.epub_ver == 2:
-			s += '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">\n'
+			yield '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">\n'
 		else:
-			s += '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
-		s += '<dc:identifier id="BookId">urn:uuid:{}</dc:identifier>\n'.format(self.uuid)
-		s += '<dc:title id="title">{}</dc:title>\n'.format(self.title)
+			yield '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+		yield '<dc:identifier id="BookId">urn:uuid:{}</dc:identifier>\n'.format(self.uuid)
+		yield '<dc:title id="title">{}</dc:title>\n'.format(self.title)
 		i = 0
 		for creator in self.creators:
 			i += 1
 			if self.epub_ver == 2:
-				s += '<dc:creator opf:role="{}">{}</dc:creator>\n'.format(creator['role'], creator['name'])
+				yield '<dc:creator opf:role="{}">{}</dc:creator>\n'.format(creator['role'], creator['name'])
 			else:
-				s += '<dc:creator id="creator{}">{}</dc:creator>\n'.format(i, creator['name'])
-				s += '<meta refines="#creator{}" property="role" scheme="marc:relators">{}</meta>\n'.format(i, creator['role'])
-				s += '<meta refines="#creator{0}" property="display-seq">{0}</meta>\n'.format(i)
+				yield '<dc:creator id="creator{}">{}</dc:creator>\n'.format(i, creator['name'])
+				yield '<meta refines="#creator{}" property="role" scheme="marc:relators">{}</meta>\n'.format(i, creator['role'])
+				yield '<meta refines="#creator{0}" property="display-seq">{0}</meta>\n'.format(i)
 			
 		for lang in self.lang:
-			s += '<dc:language>{}</dc:language>\n'.format(lang)
+			yield '<dc:language>{}</dc:language>\n'.format(lang)
 		if self.epub_ver > 2:
-			s += '<meta property="dcterms:modified">{}</meta>\n'.format(datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ'))
+			yield '<meta property="dcterms:modified">{}</meta>\n'.format(datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ'))
 		if self.publisher is not None:
-			s += '<dc:publisher>{}</dc:publisher>\n'.format(self.publisher)
-		s += '<dc:date>{}</dc:date>'.format(date.today())
-		s += '</metadata>\n'
+			yield '<dc:publisher>{}</dc:publisher>\n'.format(self.publisher)
+		yield '<dc:date>{}</dc:date>'.format(date.today())
+		yield '</metadata>\n'
 		
-		# manifest
-		s += '<manifest>\n'
+		# manifest, 同時記下 spine 要列的 HTML
+		yield '<manifest>\n'
 		if self.epub_ver == 2:
-			s += '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml" />\n'
+			yield '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml" />\n'
 		else:
-			s += '<item id="toc" href="toc.html" properties="nav" media-type="application/xhtml+xml"/>\n'
+			yield '<item id="toc" href="toc.html" properties="nav" media-type="application/xhtml+xml"/>\n'
+		spine = []
 		for item in self.items.values():
-			s += '<item'
 			if item.dest_path == 'cover.jpg':
-				s += ' properties="cover-image"'
+				properties = ' properties="cover-image"'
 			elif item.properties is not None:
-				s += ' properties="{}"'.format(item.properties)
-			s += ' id="{}" href="{}" media-type="{}" />\n'.format(item.id, item.dest_path, item.mime_type)
-		s += '</manifest>\n'
+				properties = ' properties="{}"'.format(item.properties)
+			else:
+				properties = ''
+			yield '<item{} id="{}" href="{}" media-type="{}" />\n'.format(properties, item.id, item.dest_path, item.mime_type)
+			if item.mime_type == 'application/xhtml+xml':
+				spine.append(item.id)
+		yield '</manifest>\n'
 		
 		# spine
 		# Package Document 的內容必須含有一個spine 區塊，內含一個或以上的<itemref> 元素。
 		# spine 的目的是用來描述當使用者一頁一頁向下翻時，資料的正確讀取順序。
 		if self.epub_ver == 2:
-			s += '<spine toc="ncx">\n'
+			yield '<spine toc="ncx">\n'
 		else:
-			s += '<spine>\n'
-			s += '<itemref idref="toc" />\n'
-		for item in self.items.values():
-			if item.mime_type == 'application/xhtml+xml':
-				s += '<itemref idref="{}" />'.format(item.id)
-		s+= '</spine>\n'
+			yield '<spine>\n'
+			yield '<itemref idref="toc" />\n'
+		for id in spine:
+			yield '<itemref idref="{}" />'.format(id)
+		yield '</spine>\n'
 		
-		s += '</package>'
-		
-		path = os.path.join(self.root_dir, 'OPS', 'content.opf')
-		with open(path, 'w', encoding='utf8') as fo:
-			fo.write(s)
+		yield '</package>'
 			
-	def _toc_node2html(self, node):
+	def _toc_node2html(self, root):
+		''' 逐段產生 EPUB 3 目錄的 <ol>, 不使用遞迴, 目錄很深也沒問題 '''
 		if self.toc_style == 'none':
-			style = ' style="list-style-type:none;margin-left:-2em"'
+			ol = '<ol style="list-style-type:none;margin-left:-2em">\n'
+			li = '<li style="margin-left:1em;text-indent:-1em">'
 		elif self.toc_style != '':
-			style = ' style="list-style-type:{};"'.format(self.toc_style)
+			ol = '<ol style="list-style-type:{};">\n'.format(self.toc_style)
+			li = '<li>'
 		else:
-			style = ''
-		r = ''
-		if node.title!='':
-			r += '<a href="{}">{}</a>'.format(node.href, node.title)
-		if len(node.children)>0:
-			r += '<ol{}>\n'.format(style)
-			for n in node.children:
-				if self.toc_style == 'none':
-					r += '<li style="margin-left:1em;text-indent:-1em">'
-				else:
-					r += '<li>'
-				r += self._toc_node2html(n) + '</li>\n'
-			r += '</ol>\n'
-		return r
+			ol = '<ol>\n'
+			li = '<li>'
+		if root.title != '':
+			yield '<a href="{}">{}</a>'.format(root.href, root.title)
+		if len(root.children) == 0:
+			return
+		yield ol
+		stack = [iter(root.children)]
+		while len(stack) > 0:
+			node = next(stack[-1], None)
+			if node is None:
+				stack.pop()
+				yield '</ol>\n'
+				if len(stack) > 0:
+					yield '</li>\n'
+				continue
+			yield li
+			if node.title != '':
+				yield '<a href="{}">{}</a>'.format(node.href, node.title)
+			if len(node.children) > 0:
+				yield ol
+				stack.append(iter(node.children))
+			else:
+				yield '</li>\n'
 
 	def _write_toc(self):
-		s = '''<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+		self.writer.write_chunks('OPS/toc.html', self._toc_html())
+		
+	def _toc_html(self):
+		yield '''<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
 <head>
 <meta charset="utf-8" />
 <title>{}</title>
@@ -249,30 +661,34 @@ class EpubBook:
 <body>
 <nav id="toc" epub:type="toc">
 <h1>Contents</h1>'''.format(self.title)
-		s += self._toc_node2html(self.toc_root)
-		s += '</nav></body></html>'
-		path = os.path.join(self.root_dir, 'OPS', 'toc.html')
-		fo = open(path, 'w', encoding='utf8')
-		fo.write(s)
-		fo.close()
+		yield from self._toc_node2html(self.toc_root)
+		yield '</nav></body></html>'
 
-	def _toc_node2ncx(self, node):
-		r = ''
-		if node.title!='':
-			r = '''<navPoint id="navPoint-{0}" playOrder="{0}">
+	def _toc_node2ncx(self, root):
+		''' 逐段產生 NCX 的 navPoint, 不使用遞迴 '''
+		stack = [iter([root])]
+		parents = []
+		while len(stack) > 0:
+			node = next(stack[-1], None)
+			if node is None:
+				stack.pop()
+				if len(parents) > 0 and parents.pop().title != '':
+					yield '</navPoint>\n'
+				continue
+			if node.title != '':
+				yield '''<navPoint id="navPoint-{0}" playOrder="{0}">
 	<navLabel>
 		<text>{1}</text>
 	</navLabel>
 	<content src="{2}" />\n'''.format(node.play_order, node.title, node.href)
-		if len(node.children)>0:
-			for n in node.children:
-				r += self._toc_node2ncx(n)
-		if node.title != '':
-			r += '</navPoint>\n'
-		return r
+			parents.append(node)
+			stack.append(iter(node.children))
 		
 	def _write_ncx(self):
-		s = '''<?xml version="1.0" encoding="utf-8" ?>
+		self.writer.write_chunks('OPS/toc.ncx', self._ncx())
+		
+	def _ncx(self):
+		yield '''<?xml version="1.0" encoding="utf-8" ?>
 <!DOCTYPE ncx PUBLIC "-//NISO//DTD ncx 2005-1//EN" "http://www.daisy.org/z3986/2005/ncx-2005-1.dtd">
 <ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" xml:lang="en" version="2005-1">
     <head>
@@ -285,33 +701,84 @@ class EpubBook:
         <text>{}</text>
     </docTitle>
     <navMap>\n'''.format(self.uuid, self.toc_depth, self.title)
-		s += self._toc_node2ncx(self.toc_root)
-		s += '    </navMap></ncx>'
-		path = os.path.join(self.root_dir, 'OPS', 'toc.ncx')
-		with open(path, 'w', encoding='utf8') as fo:
-			fo.write(s)
+		yield from self._toc_node2ncx(self.toc_root)
+		yield '    </navMap></ncx>'
 			
-	def create_book(self, root_dir):
+	def _phase(self, name):
+		if self.profiler is None:
+			return contextlib.nullcontext()
+		return self.profiler.phase(name)
+		
+	def start_book(self, root_dir):
+		''' 開始將電子書寫到資料夾 root_dir: 之後 add_html() 加入的 HTML 會立即寫出, 不留在記憶體中
+		最後仍要呼叫 create_book() 寫出其他檔案 '''
 		self.root_dir = root_dir
 		self.make_dirs()
+		self._start(FolderWriter(root_dir))
+		
+	def start_epub(self, output):
+		''' 開始將電子書直接寫到 EPUB 檔 output (路徑或檔案物件), 之後 add_html() 加入的 HTML 會立即寫出
+		最後仍要呼叫 create_epub() 寫出其他檔案 '''
+		self._start(ZipWriter(output, self.compress_level, self.compress_threads, self.asset_cache))
+		
+	def _start(self, writer):
+		self.writer = writer
+		self.started = True
 		self._write_mimetype()
-		self._write_items()
-		self._write_container_xml()
-		self._write_content_OPF()
-		if self.epub_ver == 2:
-			self._write_ncx()
-		else:
-			self._write_toc()
+		
+	def create_book(self, root_dir):
+		''' 將電子書的檔案寫到資料夾 root_dir, 再以 create_archive() 壓縮為 EPUB '''
+		if not self.started:
+			self.start_book(root_dir)
+		self._finish()
+		
+	def create_epub(self, output):
+		''' 將電子書直接寫成 EPUB 檔, output 可以是路徑或檔案物件 (例如 io.BytesIO) '''
+		if not self.started:
+			self.start_epub(output)
+		self._finish()
+		
+	def create_html(self, folder):
+		''' 將 HTML、圖片、CSS 直接寫到資料夾 folder, 不封裝為 EPUB (例如給網頁版閱讀器使用)
+		HTML 使用 EPUB 3 (HTML5) 的 charset 宣告, 目錄寫成 index.html '''
+		assert not self.started
+		epub_ver = self.epub_ver
+		self.epub_ver = 3
+		self.content_dir = ''
+		self.writer = FolderWriter(folder)
+		try:
+			with self._phase('items'):
+				self._write_items()
+			with self._phase('toc'):
+				self.writer.write_chunks('index.html', self._toc_html())
+			self.writer.close()
+		finally:
+			self.writer = None
+			self.content_dir = 'OPS/'
+			self.epub_ver = epub_ver
+		
+	def _finish(self):
+		with self._phase('items'):
+			self._write_items()
+		with self._phase('opf'):
+			self._write_container_xml()
+			self._write_content_OPF()
+		with self._phase('toc'):
+			if self.epub_ver == 2:
+				self._write_ncx()
+			else:
+				self._write_toc()
+		with self._phase('close'):
+			self.writer.close()
+		self.writer = None
+		self.started = False
 
-def check_epub(checkerPath, epubPath):
-	# 在 linux 下使用 subprocess.call 有問題, 改用 Popen
-	#subprocess.call(['java', '-jar', checkerPath, epubPath], shell = True)
-	
-	# 在 windows 下使用 subprocess.Popen 有問題
-	#p = subprocess.Popen("java -jar %s %s" %(checkerPath, epubPath), shell=True)
-	#sts = os.waitpid(p.pid, 0)
-	
-	os.system('java -jar ' + checkerPath + ' ' + epubPath)
+def file_hash(path):
+	h = hashlib.sha1()
+	with open(path, 'rb') as fi:
+		for chunk in iter(lambda: fi.read(65536), b''):
+			h.update(chunk)
+	return h.hexdigest()
 
 def append_folder_to_zip(folder, file_list):
 	files = os.listdir(folder)
@@ -322,19 +789,13 @@ def append_folder_to_zip(folder, file_list):
 		else:
 			file_list.append(path)
 
-def create_archive(root_dir, output_path):
-	folder = os.path.dirname(output_path)
-	if not os.path.exists(folder):
-		os.makedirs(folder)
-	
-	fout = zipfile.ZipFile(output_path, 'w')
-	cwd = os.getcwd()
-	os.chdir(root_dir)
-	fout.write('mimetype', compress_type = zipfile.ZIP_STORED)
-	fileList = []
-	fileList.append(os.path.join('META-INF', 'container.xml'))
-	append_folder_to_zip('OPS', fileList)
+def create_archive(root_dir, output_path, compress_level=COMPRESS_LEVEL, threads=None, asset_cache=None):
+	''' 將 create_book() 寫出的資料夾 root_dir 壓縮為 EPUB, 參數同 ZipWriter '''
+	writer = ZipWriter(output_path, compress_level, threads, asset_cache)
+	writer.copy_file('mimetype', os.path.join(root_dir, 'mimetype'), compress=False)
+	fileList = [os.path.join(root_dir, 'META-INF', 'container.xml')]
+	append_folder_to_zip(os.path.join(root_dir, 'OPS'), fileList)
 	for filePath in fileList:
-		fout.write(filePath, compress_type = zipfile.ZIP_DEFLATED)
-	fout.close()
-	os.chdir(cwd)
+		name = os.path.relpath(filePath, root_dir).replace(os.sep, '/')
+		writer.copy_file(name, filePath)
+	writer.close()
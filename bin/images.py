@@ -0,0 +1,129 @@
+# coding: utf8
+''' EPUB 圖片最佳化: 縮小尺寸、調整 JPEG 品質、GIF 轉 PNG、去掉 metadata
+需要 Pillow (pip install Pillow)
+處理結果存在快取資料夾中, key 是來源檔內容的 hash 及 profile, 來源圖片沒變就不會重新處理
+'''
+import hashlib
+import io
+import os
+try:
+	from PIL import Image
+except ImportError:
+	Image = None
+
+# 內建的 profile, config['image_profile'] 可以是這裡的名稱, 或是一個 dict
+PROFILES = {
+	# 一般電子書閱讀器
+	'ereader': {
+		'max_width': 1200,
+		'max_height': 1600,
+		'jpeg_quality': 80,
+		'gif_to_png': True,
+		'strip_metadata': True,
+	},
+	# 低階閱讀器, 檔案越小越好
+	'small': {
+		'max_width': 800,
+		'max_height': 1000,
+		'jpeg_quality': 65,
+		'gif_to_png': True,
+		'strip_metadata': True,
+	},
+}
+
+# profile 的預設值: 不縮小、不轉檔
+DEFAULT_PROFILE = {
+	'max_width': None,
+	'max_height': None,
+	'jpeg_quality': 85,
+	'gif_to_png': False,
+	'strip_metadata': False,
+}
+
+FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.gif': 'GIF'}
+
+class ImageOptimizer:
+	def __init__(self, profile, cache_folder=None):
+		''' profile: PROFILES 中的名稱, 或是 dict (沒有的 key 用 DEFAULT_PROFILE)
+		cache_folder: 處理結果的快取資料夾, None 表示不快取 '''
+		if Image is None:
+			raise ImportError('image_profile 需要 Pillow: pip install Pillow')
+		if isinstance(profile, str):
+			profile = PROFILES[profile]
+		self.profile = dict(DEFAULT_PROFILE)
+		self.profile.update(profile)
+		self.cache_folder = cache_folder
+		self.profile_key = repr(sorted(self.profile.items())).encode('utf8')
+
+	def dest_name(self, dest_path):
+		''' 處理後在 EPUB 中的檔名, GIF 轉 PNG 時副檔名會改變 '''
+		if self.profile['gif_to_png'] and dest_path.lower().endswith('.gif'):
+			return dest_path[:-4] + '.png'
+		return dest_path
+
+	def optimize(self, src_path, dest_path):
+		''' 傳回 src_path 處理後的內容 (bytes), dest_path 是 dest_name() 傳回的檔名 '''
+		with open(src_path, 'rb') as fi:
+			data = fi.read()
+		ext = os.path.splitext(dest_path)[1].lower()
+		if ext not in FORMATS:
+			return data
+
+		path = None
+		if self.cache_folder is not None:
+			h = hashlib.sha1(data)
+			h.update(self.profile_key)
+			h.update(ext.encode('utf8'))
+			key = h.hexdigest()
+			path = os.path.join(self.cache_folder, key[:2], key + ext)
+			if os.path.exists(path):
+				with open(path, 'rb') as fi:
+					return fi.read()
+
+		r = self._encode(data, FORMATS[ext], src_path.lower().endswith(ext))
+
+		if path is not None:
+			folder = os.path.dirname(path)
+			if not os.path.exists(folder):
+				os.makedirs(folder)
+			temp = '{}.{}.tmp'.format(path, os.getpid())
+			with open(temp, 'wb') as fo:
+				fo.write(r)
+			os.replace(temp, path)
+		return r
+
+	def _encode(self, data, format, same_format):
+		p = self.profile
+		img = Image.open(io.BytesIO(data))
+		animated = getattr(img, 'is_animated', False)
+		resized = False
+		max_w = p['max_width'] or img.width
+		max_h = p['max_height'] or img.height
+		if (img.width > max_w or img.height > max_h) and not animated:
+			img.thumbnail((max_w, max_h), Image.LANCZOS)
+			resized = True
+
+		options = {}
+		if not p['strip_metadata']:
+			for k in ('exif', 'icc_profile'):
+				if k in img.info:
+					options[k] = img.info[k]
+		if format == 'JPEG':
+			if img.mode not in ('RGB', 'L'):
+				img = img.convert('RGB')
+			options['quality'] = p['jpeg_quality']
+			options['optimize'] = True
+		elif format == 'PNG':
+			options['optimize'] = True
+			if animated:
+				options['save_all'] = True
+		elif format == 'GIF' and animated:
+			options['save_all'] = True
+
+		out = io.BytesIO()
+		img.save(out, format, **options)
+		r = out.getvalue()
+		# 格式沒變、沒縮小、不必去掉 metadata 時, 如果沒有變小就用原檔
+		if same_format and not resized and not p['strip_metadata'] and len(r) >= len(data):
+			return data
+		return r
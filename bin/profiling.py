@@ -0,0 +1,119 @@
+# coding: utf8
+''' 轉換過程的效能紀錄
+config['profile'] 有設定時, XmlToEpub.convert() 記錄各階段的時間 (wall, CPU)、各標記 handler 的呼叫次數與累計時間、
+每一章的轉換時間與大小, 以及 (config['profile_memory'] 為 True 時) tracemalloc 的記憶體用量高峰,
+convert() 傳回 report() 的 dict; config['profile'] 是路徑時, 同時寫成 JSON 檔, 方便比較不同版本的效能。
+'''
+import collections
+import contextlib
+import json
+import os
+import time
+import tracemalloc
+
+class Profiler:
+	def __init__(self, memory=False):
+		self.memory = memory # 是否以 tracemalloc 記錄記憶體用量, 會讓轉換變慢
+		self.phases = collections.OrderedDict() # 階段名稱 => [次數, wall, cpu], 巢狀的階段以 . 連接
+		self.stack = [] # 目前所在的階段
+		self.handlers = {} # 標記 => [次數, 累計秒數], 包含內層標記的時間
+		self.chapters = [] # 每一章的 dict
+		self.counters = collections.Counter()
+		self.started = None
+		self.wall = 0
+		self.cpu = 0
+		self.memory_peak = None
+		self.trace_memory = False
+
+	def start(self):
+		self.started = (time.perf_counter(), time.process_time())
+		if self.memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+			self.trace_memory = True
+
+	def stop(self):
+		self.wall = time.perf_counter() - self.started[0]
+		self.cpu = time.process_time() - self.started[1]
+		if self.trace_memory:
+			self.memory_peak = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+			self.trace_memory = False
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		''' 記錄一個階段的時間: with profiler.phase('parse'): ... '''
+		self.stack.append(name)
+		key = '.'.join(self.stack)
+		# 在開始時加入, 外層的階段排在內層之前
+		r = self.phases.get(key)
+		if r is None:
+			r = self.phases[key] = [0, 0.0, 0.0]
+		wall = time.perf_counter()
+		cpu = time.process_time()
+		try:
+			yield
+		finally:
+			r[0] += 1
+			r[1] += time.perf_counter() - wall
+			r[2] += time.process_time() - cpu
+			self.stack.pop()
+
+	def wrap_handler(self, tag, func):
+		''' 傳回記錄呼叫次數及時間的 handler '''
+		stat = self.handlers.setdefault(tag, [0, 0.0])
+		perf_counter = time.perf_counter
+		def handler(e, mode='html'):
+			t = perf_counter()
+			try:
+				func(e, mode)
+			finally:
+				stat[0] += 1
+				stat[1] += perf_counter() - t
+		return handler
+
+	def add_chapter(self, chapter, files, seconds, size):
+		self.chapters.append({'chapter': chapter, 'files': files, 'seconds': seconds, 'size': size, 'pid': os.getpid()})
+
+	def count(self, name, n=1):
+		self.counters[name] += n
+
+	def take_worker_stats(self):
+		''' worker process 中: 取出並清除目前累積的 handler 及各章紀錄, 傳回主 process 以 merge() 合併 '''
+		handlers = dict((tag, tuple(stat)) for tag, stat in self.handlers.items() if stat[0] > 0)
+		for stat in self.handlers.values():
+			stat[0] = 0
+			stat[1] = 0.0
+		chapters = self.chapters
+		self.chapters = []
+		return {'handlers': handlers, 'chapters': chapters}
+
+	def merge(self, stats):
+		for tag, (calls, seconds) in stats['handlers'].items():
+			stat = self.handlers.setdefault(tag, [0, 0.0])
+			stat[0] += calls
+			stat[1] += seconds
+		self.chapters.extend(stats['chapters'])
+
+	def report(self):
+		''' 傳回可以轉為 JSON 的 dict '''
+		handlers = [{'tag': tag, 'calls': calls, 'seconds': seconds}
+			for tag, (calls, seconds) in self.handlers.items() if calls > 0]
+		handlers.sort(key=lambda h: h['seconds'], reverse=True)
+		chapters = sorted(self.chapters, key=lambda c: c['chapter'])
+		return {
+			'wall': self.wall,
+			'cpu': self.cpu,
+			'phases': [{'name': name, 'calls': calls, 'wall': wall, 'cpu': cpu}
+				for name, (calls, wall, cpu) in self.phases.items()],
+			'handlers': handlers,
+			'chapters': chapters,
+			'counters': dict(self.counters),
+			'memory_peak': self.memory_peak,
+		}
+
+	def write(self, path):
+		folder = os.path.dirname(path)
+		if folder != '' and not os.path.exists(folder):
+			os.makedirs(folder)
+		with open(path, 'w', encoding='utf8') as fo:
+			json.dump(self.report(), fo, ensure_ascii=False, indent=1)
@@ -0,0 +1,247 @@
+# coding: utf8
+''' 以各種轉換方式轉換範例及合成的書, 檢查結果與預設 (逐章轉換, 直接寫出 EPUB) 的 EPUB 相同
+用法:
+	python run-ModeTest.py
+檢查的方式: temp_folder、streaming、workers、cache_folder 及 chapter_cache (轉換兩次)、asset_cache、
+lxml-etree、convert_bytes、targets、split_size、watch.py (SourceTree 只重新 parse 改變的檔案),
+以及 zip64 的 central directory。
+比較時忽略 uuid 及日期; split_size 會分割 HTML, 只比較全書的文字及連結是否正確。
+全部通過時 exit code 為 0, 否則列出失敗的項目, exit code 為 1。
+'''
+import io
+import os
+import re
+import sys
+import tempfile
+import zipfile
+import zlib
+from lxml import etree
+import benchmark
+import epub
+import validate
+import watch
+import x2epub
+
+EXAMPLES = '../examples/'
+BOOKS = {
+	'example1': {'xml': EXAMPLES + 'example1/simple.xml'},
+	'example2': {'xml': EXAMPLES + 'example2/mixed.xml', 'graphic_base': EXAMPLES + 'example2/graphic'},
+	'example3': {'xml': EXAMPLES + 'example3/1-1-6.xml', 'cover_page': EXAMPLES + 'example3/cover.jpg',
+		'graphic_base': EXAMPLES + 'example3/graphic', 'css': EXAMPLES + 'example3/shengyen.css'},
+	'TestEpubReader': {'xml': EXAMPLES + 'Test-EPUB-Reader/TestEpubReader.xml',
+		'css': EXAMPLES + 'Test-EPUB-Reader/TestEpubReader.css'},
+}
+SYNTHETIC_SIZE = 300 * 1000 # 合成的書的大小, 有多章、註解、缺字、圖片
+SPLIT_SIZE = 3000
+XHTML = '{http://www.w3.org/1999/xhtml}'
+
+class ModeTest:
+	def __init__(self, folder):
+		self.folder = folder
+		self.count = 0
+		self.failures = []
+
+	def check(self, name, ok, detail=''):
+		print('{} {}'.format('ok  ' if ok else 'FAIL', name), flush=True)
+		if not ok:
+			if detail:
+				print('\t' + str(detail)[:500])
+			self.failures.append(name)
+
+	def same(self, name, expected, actual):
+		''' 比較兩個 EPUB (路徑或 bytes) 的內容, mimetype 以外的檔案順序可以不同 '''
+		a = read_epub(expected)
+		b = read_epub(actual)
+		detail = ''
+		if a[0][0] != 'mimetype' or b[0][0] != 'mimetype':
+			detail = 'mimetype 不是第一個檔案'
+		elif sorted(n for n, data in a) != sorted(n for n, data in b):
+			detail = '檔案不同: {} / {}'.format(sorted(n for n, data in a), sorted(n for n, data in b))
+		else:
+			for (n, x), (m, y) in zip(sorted(a), sorted(b)):
+				if x != y:
+					detail = '{} 的內容不同'.format(n)
+					break
+		self.check(name, detail == '', detail)
+
+	def convert(self, config, **options):
+		''' 轉換一次, 傳回 EPUB 的路徑 '''
+		self.count += 1
+		config = dict(config)
+		config.update(options)
+		config.setdefault('epub_path', os.path.join(self.folder, 'epub', '{}.epub'.format(self.count)))
+		x2epub.XmlToEpub(config).convert()
+		return config['epub_path']
+
+	def path(self, name):
+		return os.path.join(self.folder, name)
+
+def normalize(data):
+	s = data.decode('utf8')
+	s = re.sub(r'urn:uuid:[0-9a-f-]+', 'UUID', s)
+	s = re.sub(r'\d{4}-\d\d-\d\d(T\d\d:\d\d:\d\dZ)?', 'DATE', s)
+	return s.encode('utf8')
+
+def read_epub(epub_file):
+	''' 傳回 [(檔名, 內容)], 文字檔去掉 uuid 及日期 '''
+	if isinstance(epub_file, bytes):
+		epub_file = io.BytesIO(epub_file)
+	members = []
+	with zipfile.ZipFile(epub_file) as zf:
+		for name in zf.namelist():
+			data = zf.read(name)
+			if name.endswith(('.opf', '.ncx', '.htm', '.html', '.xml')):
+				data = normalize(data)
+			members.append((name, data))
+	return members
+
+def book_text(epub_path):
+	''' 依 spine 的順序, 全書 HTML 的 body 文字 (不含空白) 及章節末註解的 list
+	分割的 HTML 各自有章節末註解, 所以註解另外比較 '''
+	with zipfile.ZipFile(epub_path) as zf:
+		opf = etree.fromstring(zf.read('OPS/content.opf'))
+		ns = {'opf': 'http://www.idpf.org/2007/opf'}
+		hrefs = dict((item.get('id'), item.get('href')) for item in opf.iterfind('.//opf:manifest/opf:item', ns))
+		text = []
+		notes = []
+		for itemref in opf.iterfind('.//opf:spine/opf:itemref', ns):
+			html = etree.fromstring(zf.read('OPS/' + hrefs[itemref.get('idref')]))
+			body = html.find(XHTML + 'body')
+			for p in body.findall('.//{}p[@class="note"]'.format(XHTML)):
+				notes.append(''.join(p.itertext()))
+				p.getparent().remove(p)
+			text.append(''.join(''.join(body.itertext()).split()))
+	return ''.join(text), notes
+
+def test_book(t, name, config):
+	base = t.convert(config)
+	t.same(name + ' temp_folder', base, t.convert(config, temp_folder=t.path('temp')))
+	t.same(name + ' compress_threads=1', base, t.convert(config, compress_threads=1))
+	t.same(name + ' streaming', base, t.convert(config, streaming=True))
+	t.same(name + ' workers=2', base, t.convert(config, workers=2))
+
+	cache_folder = t.path('cache-' + name)
+	t.same(name + ' cache_folder (第一次)', base, t.convert(config, cache_folder=cache_folder))
+	t.same(name + ' cache_folder (使用 cache)', base, t.convert(config, cache_folder=cache_folder))
+	t.same(name + ' cache_folder + workers=2', base, t.convert(config, cache_folder=cache_folder, workers=2))
+	chapter_cache = {}
+	t.convert(config, chapter_cache=chapter_cache)
+	t.same(name + ' chapter_cache', base, t.convert(config, chapter_cache=chapter_cache))
+	asset_cache = epub.MemoryAssetCache()
+	t.convert(config, asset_cache=asset_cache)
+	t.same(name + ' asset_cache', base, t.convert(config, asset_cache=asset_cache))
+
+	# 呼叫者提供的 tree 及 bytes
+	tree = etree.parse(config['xml'])
+	tree.xinclude()
+	options = dict(config)
+	del options['xml']
+	for k in ('graphic_base', 'glyph_base'):
+		options.setdefault(k, os.path.dirname(config['xml']))
+	t.same(name + ' lxml-etree', base, t.convert(options, **{'lxml-etree': tree}))
+	with open(config['xml'], 'rb') as fi:
+		t.same(name + ' convert_bytes', base, x2epub.convert_bytes(fi.read(), config))
+
+	# 一次轉換寫出多個 EPUB 及 HTML 資料夾
+	targets = {'epub3': t.path(name + '-3.epub'), 'epub2': t.path(name + '-2.epub'), 'html': t.path(name + '-html')}
+	t.convert(config, targets=targets)
+	t.same(name + ' targets epub3', base, targets['epub3'])
+	t.same(name + ' targets epub2', t.convert(config, epub_ver=2), targets['epub2'])
+	folder = targets['html']
+	members = dict(read_epub(base))
+	different = []
+	for n in os.listdir(folder):
+		if os.path.isfile(os.path.join(folder, n)) and n != 'index.html':
+			with open(os.path.join(folder, n), 'rb') as fi:
+				data = fi.read()
+			if n.endswith(('.htm', '.html')):
+				data = normalize(data)
+			if members.get('OPS/' + n) != data:
+				different.append(n)
+	t.check(name + ' targets html', len(different) == 0, different)
+
+	split = t.convert(config, split_size=SPLIT_SIZE)
+	problems = [p for p in validate.precheck(split) if p.level == 'ERROR']
+	t.check(name + ' split_size precheck', len(problems) == 0, problems)
+	t.check(name + ' split_size 文字相同', book_text(split) == book_text(base))
+
+def test_callable_cache(t, config):
+	''' handle_text 改變時, cache 中的各章不能再使用 '''
+	cache_folder = t.path('cache-handle-text')
+	first = t.convert(config, cache_folder=cache_folder, handle_text=lambda s: s.replace('段', 'AAA'))
+	second = t.convert(config, cache_folder=cache_folder, handle_text=lambda s: s.replace('段', 'BBB'))
+	expected = t.convert(config, handle_text=lambda s: s.replace('段', 'BBB'))
+	t.same('handle_text 改變常數之後不使用 cache', expected, second)
+	t.check('handle_text 的改變有影響輸出', read_epub(first) != read_epub(second))
+	t.convert(config, cache_folder=cache_folder, handle_text=make_replace('段', 'CCC'))
+	fourth = t.convert(config, cache_folder=cache_folder, handle_text=make_replace('段', 'DDD'))
+	t.same('handle_text 改變 closure 之後不使用 cache', t.convert(config, handle_text=make_replace('段', 'DDD')), fourth)
+
+def make_replace(old, new):
+	def replace(s):
+		return s.replace(old, new)
+	return replace
+
+INCLUDE_BOOK = '''<?xml version="1.0" encoding="UTF-8"?>
+<TEI xmlns:xi="http://www.w3.org/2001/XInclude"><teiHeader><fileDesc><titleStmt><title>測試</title><author>測試</author></titleStmt></fileDesc></teiHeader>
+<text><body><xi:include href="part1.xml"/><xi:include href="part2.xml"/></body></text></TEI>'''
+INCLUDE_PART = '<div><head>第{0}章</head><p>第{0}章的內容{1}<note place="bottom">註解</note></p></div>'
+
+def write(path, s):
+	with open(path, 'w', encoding='utf8') as fo:
+		fo.write(s)
+
+def test_watch(t):
+	''' watch.py 修改 xi:include 引用的檔案之後, 結果與重新轉換相同 '''
+	folder = t.path('watch')
+	os.makedirs(folder)
+	xml = os.path.join(folder, 'book.xml')
+	write(xml, INCLUDE_BOOK)
+	write(os.path.join(folder, 'part1.xml'), INCLUDE_PART.format(1, ''))
+	part2 = os.path.join(folder, 'part2.xml')
+	write(part2, INCLUDE_PART.format(2, ''))
+	config = {'xml': xml, 'epub_path': t.path('watch.epub')}
+	watcher = watch.Watcher(config)
+	t.check('watch 第一次轉換', watcher.build() is not None)
+	t.same('watch 第一次轉換', t.convert({'xml': xml}), config['epub_path'])
+	write(part2, INCLUDE_PART.format(2, '(修改)'))
+	t.check('watch 修改之後轉換', watcher.build([os.path.abspath(part2)]) is not None)
+	t.same('watch 修改之後轉換', t.convert({'xml': xml}), config['epub_path'])
+
+def test_zip64(t):
+	''' entry 數超過 0xFFFF 時寫出 zip64 的 central directory '''
+	buf = io.BytesIO()
+	z = epub.RawZipFile(buf)
+	count = 0xFFFF + 1
+	for i in range(count):
+		data = str(i).encode('ascii')
+		info = zipfile.ZipInfo('{}.txt'.format(i), date_time=(2020, 1, 1, 0, 0, 0))
+		info.compress_type = zipfile.ZIP_STORED
+		info.CRC = zlib.crc32(data)
+		info.compress_size = info.file_size = len(data)
+		z.write_entry(info, data)
+	z.close()
+	with zipfile.ZipFile(io.BytesIO(buf.getvalue())) as zf:
+		names = zf.namelist()
+		ok = len(names) == count and zf.testzip() is None and zf.read('{}.txt'.format(count - 1)) == str(count - 1).encode('ascii')
+	t.check('zip64 central directory', ok, len(names))
+
+def main():
+	with tempfile.TemporaryDirectory(prefix='x2epub-mode-') as folder:
+		t = ModeTest(folder)
+		books = dict(BOOKS)
+		xml, chapters = benchmark.prepare(t.path('synthetic'), SYNTHETIC_SIZE, {})
+		books['synthetic'] = {'xml': xml}
+		for name, config in books.items():
+			test_book(t, name, config)
+		test_callable_cache(t, BOOKS['example1'])
+		test_watch(t)
+		test_zip64(t)
+	if len(t.failures) > 0:
+		print('{} 項失敗'.format(len(t.failures)))
+		return 1
+	print('全部通過')
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
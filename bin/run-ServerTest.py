@@ -0,0 +1,179 @@
+# coding: utf8
+''' 在本機測試 server.py: 以系統指定的 port 啟動服務, 送出各種 request, 檢查傳回的結果
+用法:
+	python run-ServerTest.py
+全部通過時 exit code 為 0, 否則列出失敗的項目, exit code 為 1。
+除了一般的轉換, 也檢查上傳的 XML 不能以 xi:include、graphic 讀取 server 上 (zip 之外) 的檔案。
+'''
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import zipfile
+import server
+
+EXAMPLES = '../examples/'
+XI = 'xmlns:xi="http://www.w3.org/2001/XInclude"'
+SECRET = 'server-test-secret'
+
+class ServerTest:
+	def __init__(self, base):
+		self.base = base
+		self.failures = []
+
+	def post(self, path, data, content_type='application/xml'):
+		''' 傳回 (status, Content-Type, body) '''
+		request = urllib.request.Request(self.base + path, data=data, headers={'Content-Type': content_type})
+		try:
+			with urllib.request.urlopen(request) as f:
+				return f.status, f.headers.get('Content-Type'), f.read()
+		except urllib.error.HTTPError as e:
+			return e.code, e.headers.get('Content-Type'), e.read()
+
+	def get(self, path):
+		return self.post(path, None)
+
+	def check(self, name, ok, detail=''):
+		print('{} {}'.format('ok  ' if ok else 'FAIL', name), flush=True)
+		if not ok:
+			if detail:
+				print('\t' + str(detail)[:500])
+			self.failures.append(name)
+
+	def check_epub(self, name, result):
+		code, content_type, body = result
+		ok = code == 200 and content_type == 'application/epub+zip'
+		if ok:
+			with zipfile.ZipFile(io.BytesIO(body)) as zf:
+				ok = zf.testzip() is None and zf.namelist()[0] == 'mimetype'
+				ok = ok and not any(SECRET.encode('utf8') in zf.read(n) for n in zf.namelist())
+		self.check(name, ok, body)
+
+	def check_error(self, name, result, expected=400):
+		code, content_type, body = result
+		ok = code == expected and content_type.startswith('application/json') and SECRET.encode('utf8') not in body
+		self.check(name, ok, '{} {}'.format(code, body.decode('utf8', 'replace')))
+
+def read(path):
+	with open(path, 'rb') as fi:
+		return fi.read()
+
+def make_zip(files):
+	''' files: zip 中的路徑 => bytes '''
+	buf = io.BytesIO()
+	with zipfile.ZipFile(buf, 'w') as zf:
+		for name, data in files.items():
+			zf.writestr(name, data)
+	return buf.getvalue()
+
+def folder_files(folder):
+	files = {}
+	for root, dirs, names in os.walk(folder):
+		for name in names:
+			path = os.path.join(root, name)
+			files[os.path.relpath(path, folder).replace(os.sep, '/')] = read(path)
+	return files
+
+def tei(body, header=''):
+	return '''<?xml version="1.0" encoding="UTF-8"?>
+<TEI {}><teiHeader><fileDesc><titleStmt><title>測試</title><author>測試</author></titleStmt></fileDesc>{}</teiHeader>
+<text><body><div><head>第一章</head><p>{}</p></div></body></text></TEI>'''.format(XI, header, body).encode('utf8')
+
+def run_tests(t, secret_path):
+	simple = read(EXAMPLES + 'example1/simple.xml')
+	t.check_epub('上傳 XML', t.post('/convert?epub_ver=2', simple))
+	t.check_epub('上傳含圖片的 zip', t.post('/convert?css=shengyen.css&graphic_base=graphic&cover_page=cover.jpg',
+		make_zip(folder_files(EXAMPLES + 'example3')), 'application/zip'))
+	example2 = folder_files(EXAMPLES + 'example2')
+	t.check_epub('上傳 zip, graphic_base 預設為 XML 所在的資料夾', t.post('/convert?graphic_base=graphic',
+		make_zip(example2), 'application/zip'))
+
+	# 上傳單一 XML 時沒有圖片, 也不能讀取 server 上的檔案
+	t.check_error('上傳 XML 中有 graphic', t.post('/convert', example2['mixed.xml']))
+	t.check_error('上傳 XML 以 xi:include 讀取 server 上的檔案',
+		t.post('/convert', tei('<xi:include href="{}" parse="text"/>'.format(secret_path))))
+	t.check_error('上傳 XML 以 xi:include (file URL) 讀取 server 上的檔案',
+		t.post('/convert', tei('<xi:include href="file://{}" parse="text"/>'.format(secret_path))))
+	t.check_error('上傳 XML 以 graphic 讀取 server 上的檔案', t.post('/convert', tei('<graphic url="{}"/>'.format(secret_path))))
+	char_decl = '<encodingDesc><charDecl><char id="CB1"><graphic url="{}"/></char></charDecl></encodingDesc>'.format(secret_path)
+	t.check_error('上傳 XML 以缺字讀取 server 上的檔案', t.post('/convert', tei('<g ref="#CB1"/>', char_decl)))
+
+	# zip 中的 XML 只能引用 zip 之中的檔案
+	rel = os.path.relpath(secret_path, tempfile.gettempdir()).replace(os.sep, '/')
+	outside = '../' * 8 + secret_path.lstrip('/')
+	for name, body in [
+		('zip 中 xi:include 絕對路徑', '<xi:include href="{}" parse="text"/>'.format(secret_path)),
+		('zip 中 xi:include ..', '<xi:include href="../{}" parse="text"/>'.format(rel)),
+		('zip 中 xi:include 的檔案再 xi:include zip 之外的檔案', '<xi:include href="part.xml"/>'),
+		('zip 中 graphic 絕對路徑', '<graphic url="{}"/>'.format(secret_path)),
+		('zip 中 graphic ..', '<graphic url="{}"/>'.format(outside)),
+		]:
+		part = '<p {}><xi:include href="{}" parse="text"/></p>'.format(XI, outside).encode('utf8')
+		t.check_error(name, t.post('/convert', make_zip({'book.xml': tei(body), 'part.xml': part}), 'application/zip'))
+	t.check_error('zip 中的 css 在 zip 之外', t.post('/convert?css=../x.css', make_zip(example2), 'application/zip'))
+
+	# 參數及格式錯誤
+	t.check_error('request 不能設定 epub_path', t.post('/convert?epub_path=/tmp/x.epub', simple))
+	t.check_error('request 不能設定 huge_tree', t.post('/convert?huge_tree=1', simple))
+	t.check_error('上傳 XML 時不能設定 graphic_base', t.post('/convert?graphic_base=/etc', simple))
+	t.check_error('XML 格式錯誤', t.post('/convert', b'<TEI><broken'))
+	t.check_error('不支援的路徑', t.get('/nothing'), 404)
+
+	# async
+	code, content_type, body = t.post('/convert?async=1', simple)
+	t.check('async 傳回 202', code == 202, body)
+	if code == 202:
+		job = json.loads(body.decode('utf8'))['job']
+		for i in range(100):
+			result = t.get('/jobs/' + job)
+			if result[0] != 202:
+				break
+			time.sleep(0.1)
+		t.check_epub('async 取回 EPUB', result)
+		t.check_error('取回之後 job 即刪除', t.get('/jobs/' + job), 404)
+	code, content_type, body = t.get('/status')
+	t.check('status', code == 200 and json.loads(body.decode('utf8'))['pending'] == 0, body)
+
+def run_crash_tests(t, service):
+	''' worker process 異常結束之後, 之後的 request 仍然可以轉換 '''
+	crash = service.pool.submit(os._exit, 1)
+	try:
+		crash.result()
+	except Exception:
+		pass
+	simple = read(EXAMPLES + 'example1/simple.xml')
+	t.check_epub('worker 異常結束後重建', t.post('/convert', simple))
+	code, content_type, body = t.get('/status')
+	t.check('重建後 status', code == 200 and json.loads(body.decode('utf8'))['pending'] == 0, body)
+
+def main():
+	service = server.ConversionService(2, 2)
+	service.warm_up()
+	httpd = server.make_server(service, port=0)
+	threading.Thread(target=httpd.serve_forever, daemon=True).start()
+	t = ServerTest('http://127.0.0.1:{}'.format(httpd.server_address[1]))
+	with tempfile.TemporaryDirectory(prefix='x2epub-test-') as folder:
+		# server 上不應該被讀取的檔案
+		secret_path = os.path.join(folder, 'secret.txt')
+		with open(secret_path, 'w', encoding='utf8') as fo:
+			fo.write(SECRET)
+		try:
+			run_tests(t, os.path.abspath(secret_path))
+			run_crash_tests(t, service)
+		finally:
+			httpd.shutdown()
+			httpd.server_close()
+			service.shutdown()
+	if len(t.failures) > 0:
+		print('{} 項失敗'.format(len(t.failures)))
+		return 1
+	print('全部通過')
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -1,4 +1,6 @@
 ﻿# coding: utf_8_sig
+import sys
+import watch
 import x2epub
 
 config = {
@@ -10,5 +12,8 @@ config = {
 	'epub_validator': r'./epubcheck-3.0/epubcheck-3.0.jar', #optional,驗證檔, 環境中必須已經設好java
 }
 
-converter = x2epub.XmlToEpub(config)
-converter.convert()
+if '--watch' in sys.argv: # 存檔時自動重新轉換, 見 watch.py
+	watch.watch(config)
+else:
+	converter = x2epub.XmlToEpub(config)
+	converter.convert()
@@ -0,0 +1,350 @@
+# coding: utf8
+''' 本機 HTTP 轉換服務
+用法:
+	python server.py [--port 8000] [-j 4] [--queue 8] [--defaults defaults.json]
+
+worker process 啟動時就先載入 lxml、x2epub, 之後每次轉換不必重新啟動 Python。
+
+POST /convert
+	內容是 TEI XML, 或是包含 XML 及圖片、CSS 等檔案的 zip (Content-Type: application/zip)
+	config 以 query string 設定, 例如 /convert?epub_ver=2&publisher=...
+	zip 中有多個 XML 時, 以 xml=路徑 指定主檔, css 等路徑以 zip 的根目錄為基準
+	預設等轉換完成後傳回 EPUB; 加上 async=1 時立即傳回 202 及 job id
+GET /jobs/<id>
+	轉換完成時傳回 EPUB (之後 job 即刪除), 尚未完成時傳回 202, 失敗時傳回錯誤訊息
+GET /status
+	worker 數、排隊中的工作數
+
+同時轉換的數量為 worker 數, 另外最多 --queue 個排隊, 超過時傳回 503, 請稍後再試。
+預設只接受本機 (127.0.0.1) 的連線。
+'''
+import argparse
+import concurrent.futures
+import http.server
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urllib.parse
+import uuid
+import zipfile
+from lxml import etree
+import batch
+import images
+import x2epub
+
+logger = logging.getLogger('x2epub.server')
+
+# request 可以設定的 config key, 其他的 (例如 epub_path, cache_folder) 只能由 --defaults 設定
+# huge_tree 會取消 libxml2 對上傳內容的限制, 也只能由 --defaults 設定
+OPTION_KEYS = ('epub_ver', 'convert_lb_to_br', 'remove_comments', 'remove_pis',
+	'publisher', 'after_copyright', 'image_profile')
+# 只有上傳 zip 時才能設定的路徑, 以 zip 的根目錄為基準
+ZIP_PATH_KEYS = ('xml', 'css', 'cover_page', 'license_template', 'graphic_base', 'glyph_base')
+
+MAX_BODY = 200 * 1024 * 1024 # 上傳內容的大小上限
+JOB_TTL = 3600 # 完成後沒有取回的 job 保留的秒數
+
+class RequestError(Exception):
+	''' request 的內容有誤, 傳回 400 '''
+	pass
+
+def _warm_worker():
+	''' worker process 啟動時先做好準備, 之後的轉換不必再付這些成本 '''
+	x2epub.get_parser()
+	x2epub.converter_version()
+
+def _ping():
+	return os.getpid()
+
+def convert_job(data, is_zip, config, paths=None):
+	''' 在 worker process 中轉換, 傳回 EPUB 的 bytes; paths 是 request 中以 zip 根目錄為基準的路徑 '''
+	try:
+		if is_zip:
+			return convert_zip(data, config, paths or {})
+		return convert_xml(data, config)
+	except (etree.XMLSyntaxError, etree.XIncludeError) as e:
+		raise RequestError('XML 格式錯誤: ' + str(e))
+	except x2epub.SandboxError as e:
+		raise RequestError(str(e))
+
+def convert_xml(data, config):
+	''' 上傳單一 XML 時以空的暫存資料夾為 sandbox, 不能以 xi:include、graphic、缺字讀取 server 上的檔案 '''
+	with tempfile.TemporaryDirectory(prefix='x2epub-') as folder:
+		config = dict(config)
+		config.pop('xml', None)
+		config['sandbox'] = config['graphic_base'] = config['glyph_base'] = folder
+		return x2epub.convert_bytes(data, config)
+
+def convert_zip(data, config, paths):
+	''' xi:include、graphic、缺字都只能引用 zip 之中的檔案 '''
+	with tempfile.TemporaryDirectory(prefix='x2epub-') as folder:
+		extract_zip(data, folder)
+		config = dict(config)
+		config['sandbox'] = folder
+		for k, path in paths.items():
+			config[k] = inside_folder(folder, path)
+		if 'xml' not in config:
+			config['xml'] = find_main_xml(folder)
+		with open(config['xml'], 'rb') as fi:
+			return x2epub.convert_bytes(fi.read(), config)
+
+def extract_zip(data, folder):
+	try:
+		zf = zipfile.ZipFile(io.BytesIO(data))
+	except zipfile.BadZipFile:
+		raise RequestError('不是正確的 zip 檔')
+	with zf:
+		for name in zf.namelist():
+			inside_folder(folder, name)
+		zf.extractall(folder)
+
+def inside_folder(folder, path):
+	''' 傳回 folder 之下的 path, path 跑到 folder 之外時 raise RequestError '''
+	r = os.path.normpath(os.path.join(folder, path))
+	if os.path.isabs(path) or os.path.commonpath([folder, r]) != folder:
+		raise RequestError('路徑不在 zip 之中: ' + path)
+	return r
+
+def find_main_xml(folder):
+	''' zip 的根目錄只有一個 XML 時, 就是要轉換的主檔 '''
+	names = [n for n in os.listdir(folder) if n.lower().endswith('.xml')]
+	if len(names) != 1:
+		raise RequestError('zip 的根目錄必須正好有一個 XML, 或以 xml= 指定主檔')
+	return os.path.join(folder, names[0])
+
+def make_config(defaults, query, is_zip):
+	''' 由 --defaults 及 query string 產生 config, 傳回 (config, zip 之中的路徑) '''
+	options = {}
+	for k, values in query.items():
+		if k in ZIP_PATH_KEYS and not is_zip:
+			raise RequestError(k + ' 只能在上傳 zip 時使用')
+		if k not in OPTION_KEYS and k not in ZIP_PATH_KEYS:
+			raise RequestError('不支援的參數: ' + k)
+		options[k] = values[-1]
+	try:
+		options = batch.convert_csv_row(options)
+	except ValueError as e:
+		raise RequestError(str(e))
+	if 'image_profile' in options and options['image_profile'] not in images.PROFILES:
+		raise RequestError('不支援的 image_profile: ' + options['image_profile'])
+	# 路徑在 zip 解開之後才能決定
+	paths = {k: options.pop(k) for k in ZIP_PATH_KEYS if k in options}
+	config = dict(defaults)
+	for k in ('xml', 'graphic_base', 'glyph_base'):
+		# 這些是一本書的設定, 不使用 --defaults 中的 server 上的路徑
+		config.pop(k, None)
+	config.update(options)
+	return config, paths
+
+def is_true(query, key):
+	return query.pop(key, ['0'])[-1].lower() in ('1', 'true', 'yes')
+
+class ConversionService:
+	''' 管理 worker process 及 job, 可以不經由 HTTP 直接使用 '''
+	def __init__(self, workers=None, queue_size=8, defaults=None):
+		self.workers = workers or os.cpu_count() or 1
+		self.queue_size = queue_size
+		self.defaults = defaults or {}
+		self.pool = self.make_pool()
+		# 轉換中及排隊中的工作數上限
+		self.slots = threading.BoundedSemaphore(self.workers + queue_size)
+		self.pending = 0
+		self.jobs = {} # job id => (future, 建立時間)
+		self.lock = threading.Lock()
+
+	def make_pool(self):
+		return concurrent.futures.ProcessPoolExecutor(self.workers, initializer=_warm_worker)
+
+	def warm_up(self):
+		''' 先啟動所有 worker process, 第一個 request 就不必等待 '''
+		futures = [self.pool.submit(_ping) for i in range(self.workers)]
+		concurrent.futures.wait(futures)
+
+	def submit(self, data, is_zip, query):
+		''' 送出一個轉換工作, 傳回 future; 排隊已滿時傳回 None '''
+		config, paths = make_config(self.defaults, query, is_zip)
+		if not self.slots.acquire(blocking=False):
+			return None
+		with self.lock:
+			self.pending += 1
+		try:
+			future = self.pool_submit(convert_job, data, is_zip, config, paths)
+		except Exception:
+			self._release(None)
+			raise
+		future.add_done_callback(self._release)
+		return future
+
+	def pool_submit(self, *args):
+		''' 送到 worker process; worker 異常結束而 pool 已不能使用 (BrokenProcessPool) 時, 重建 pool 再送一次 '''
+		pool = self.pool
+		try:
+			return pool.submit(*args)
+		except concurrent.futures.BrokenExecutor:
+			logger.warning('worker process 異常結束, 重新建立')
+			with self.lock:
+				if self.pool is pool:
+					self.pool = self.make_pool()
+			pool.shutdown(wait=False)
+			return self.pool.submit(*args)
+
+	def _release(self, future):
+		with self.lock:
+			self.pending -= 1
+		self.slots.release()
+
+	def add_job(self, future):
+		job_id = uuid.uuid4().hex
+		now = time.time()
+		with self.lock:
+			for k, (f, t) in list(self.jobs.items()):
+				if f.done() and now - t > JOB_TTL:
+					del self.jobs[k]
+			self.jobs[job_id] = (future, now)
+		return job_id
+
+	def get_job(self, job_id):
+		with self.lock:
+			job = self.jobs.get(job_id)
+		if job is None:
+			return None
+		return job[0]
+
+	def remove_job(self, job_id):
+		with self.lock:
+			self.jobs.pop(job_id, None)
+
+	def status(self):
+		with self.lock:
+			return {'workers': self.workers, 'queue_size': self.queue_size, 'pending': self.pending, 'jobs': len(self.jobs)}
+
+	def shutdown(self):
+		self.pool.shutdown()
+
+class Handler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_POST(self):
+		url = urllib.parse.urlsplit(self.path)
+		if url.path != '/convert':
+			return self.send_json(404, {'error': 'not found'})
+		length = int(self.headers.get('Content-Length', 0))
+		if length <= 0:
+			return self.send_json(400, {'error': '沒有內容'})
+		if length > MAX_BODY:
+			return self.send_json(413, {'error': '內容太大'})
+		data = self.rfile.read(length)
+
+		query = urllib.parse.parse_qs(url.query)
+		is_async = is_true(query, 'async')
+		content_type = self.headers.get('Content-Type', '')
+		is_zip = content_type.startswith('application/zip') or data[:4] == b'PK\x03\x04'
+		service = self.server.service
+		try:
+			future = service.submit(data, is_zip, query)
+		except RequestError as e:
+			return self.send_json(400, {'error': str(e)})
+		except Exception:
+			logger.exception('無法送出轉換工作')
+			return self.send_json(500, {'error': traceback.format_exc()})
+		if future is None:
+			return self.send_json(503, {'error': '排隊的工作已滿, 請稍後再試'}, {'Retry-After': '5'})
+
+		if is_async:
+			job_id = service.add_job(future)
+			return self.send_json(202, {'job': job_id, 'url': '/jobs/' + job_id})
+		self.send_result(future)
+
+	def do_GET(self):
+		path = urllib.parse.urlsplit(self.path).path
+		service = self.server.service
+		if path == '/status':
+			return self.send_json(200, service.status())
+		if path.startswith('/jobs/'):
+			job_id = path[6:]
+			future = service.get_job(job_id)
+			if future is None:
+				return self.send_json(404, {'error': '沒有這個 job'})
+			if not future.done():
+				return self.send_json(202, {'job': job_id, 'status': 'running'})
+			service.remove_job(job_id)
+			return self.send_result(future)
+		self.send_json(404, {'error': 'not found'})
+
+	def send_result(self, future):
+		''' 等待 future 完成, 傳回 EPUB 或錯誤訊息 '''
+		try:
+			data = future.result()
+		except RequestError as e:
+			return self.send_json(400, {'error': str(e)})
+		except Exception:
+			logger.exception('轉換失敗')
+			return self.send_json(500, {'error': traceback.format_exc()})
+		self.send_bytes(200, data, 'application/epub+zip')
+
+	def send_json(self, code, data, headers=None):
+		body = json.dumps(data, ensure_ascii=False).encode('utf8')
+		self.send_bytes(code, body, 'application/json; charset=utf-8', headers)
+
+	def send_bytes(self, code, body, content_type, headers=None):
+		self.send_response(code)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		if headers is not None:
+			for k, v in headers.items():
+				self.send_header(k, v)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		logger.info('%s %s', self.address_string(), format % args)
+
+def make_server(service, host='127.0.0.1', port=8000):
+	''' 建立 HTTP server, port 為 0 時由系統指定 (server.server_address[1]) '''
+	server = http.server.ThreadingHTTPServer((host, port), Handler)
+	server.daemon_threads = True
+	server.service = service
+	return server
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='本機 XML 轉 EPUB 服務')
+	parser.add_argument('--host', default='127.0.0.1', help='預設只接受本機連線')
+	parser.add_argument('--port', type=int, default=8000)
+	parser.add_argument('-j', '--jobs', type=int, default=None, help='worker process 數, 預設為 CPU 核心數')
+	parser.add_argument('--queue', type=int, default=8, help='worker 都在忙時最多排隊的工作數')
+	parser.add_argument('--defaults', help='JSON 格式的共用設定, 例如 css, license_template, cache_folder')
+	parser.add_argument('-v', '--verbose', action='store_true', help='輸出每個 request 及轉換過程的訊息')
+	args = parser.parse_args(argv)
+	logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+		format='%(asctime)s %(processName)s %(name)s: %(message)s')
+
+	defaults = {}
+	if args.defaults is not None:
+		with open(args.defaults, 'r', encoding='utf-8-sig') as fi:
+			defaults = json.load(fi)
+		base = os.path.dirname(os.path.abspath(args.defaults))
+		for k in batch.PATH_KEYS:
+			if isinstance(defaults.get(k), str):
+				defaults[k] = os.path.join(base, defaults[k])
+
+	service = ConversionService(args.jobs, args.queue, defaults)
+	service.warm_up()
+	server = make_server(service, args.host, args.port)
+	print('http://{}:{}/ ({} workers)'.format(args.host, server.server_address[1], service.workers), flush=True)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		service.shutdown()
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,287 @@
+# coding: utf8
+''' EPUB 驗證
+precheck(): 不需要 Java 的快速檢查, 可以檢查 EPUB 檔或 create_book() 寫出的資料夾 (封裝之前)
+	XHTML 是否 well-formed、重複的 id、連結及註解錨點是否存在、manifest/spine 與實際檔案是否一致
+run_epubcheck(), check_many(): 執行 epubcheck, 多本書同時驗證, 傳回結構化的結果
+用法:
+	python validate.py a.epub b.epub ... [--epubcheck epubcheck-3.0.1/epubcheck-3.0.1.jar] [-j 4] [--json]
+'''
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import posixpath
+import re
+import subprocess
+import sys
+import urllib.parse
+import zipfile
+from lxml import etree
+
+OPF_NS = '{http://www.idpf.org/2007/opf}'
+CONTAINER_NS = '{urn:oasis:names:tc:opendocument:xmlns:container}'
+XHTML_TYPE = 'application/xhtml+xml'
+NCX_TYPE = 'application/x-dtbncx+xml'
+
+# level: 'ERROR' 或 'WARNING'; file: EPUB 中的路徑; line: 行號, 不知道時為 None
+Problem = collections.namedtuple('Problem', 'level file line message')
+# ok: 沒有 ERROR; returncode: epubcheck 的結束代碼, 只做 precheck 時為 None; output: epubcheck 的輸出
+Result = collections.namedtuple('Result', 'path ok problems returncode output')
+
+# epubcheck 3: "ERROR: book.epub/OPS/1.htm(12,5): message"
+# epubcheck 4: "ERROR(RSC-005): book.epub/OPS/1.htm(12,5): message"
+EPUBCHECK_LINE = re.compile(r'^(FATAL|ERROR|WARNING)(?:\([A-Z]+-\d+\))?: (.*?)(?:\((-?\d+),(-?\d+)\))?: (.*)$')
+
+class Package:
+	''' 以相同的方式讀取 EPUB 檔 (zip) 或資料夾中的檔案, 路徑一律以 / 分隔 '''
+	def __init__(self, path):
+		self.zip = None
+		if isinstance(path, str) and os.path.isdir(path):
+			self.root_dir = path
+			self.names = []
+			for folder, dirs, files in os.walk(path):
+				for f in files:
+					self.names.append(os.path.relpath(os.path.join(folder, f), path).replace(os.sep, '/'))
+		else:
+			self.zip = zipfile.ZipFile(path)
+			self.names = self.zip.namelist()
+		self.name_set = set(self.names)
+
+	def read(self, name):
+		if self.zip is not None:
+			return self.zip.read(name)
+		with open(os.path.join(self.root_dir, *name.split('/')), 'rb') as fi:
+			return fi.read()
+
+	def close(self):
+		if self.zip is not None:
+			self.zip.close()
+
+def precheck(path):
+	''' 檢查 EPUB 檔 (路徑或檔案物件) 或資料夾, 傳回 Problem 的 list '''
+	package = Package(path)
+	try:
+		return Checker(package).run()
+	finally:
+		package.close()
+
+class Checker:
+	def __init__(self, package):
+		self.package = package
+		self.problems = []
+		self.parser = etree.XMLParser(resolve_entities=False, no_network=True, load_dtd=False)
+		self.ids = {} # XHTML 檔名 => 其中的 id
+
+	def error(self, file, message, line=None):
+		self.problems.append(Problem('ERROR', file, line, message))
+
+	def warning(self, file, message, line=None):
+		self.problems.append(Problem('WARNING', file, line, message))
+
+	def parse(self, name):
+		''' parse EPUB 中的 XML 檔, 有錯誤時傳回 None '''
+		if name not in self.package.name_set:
+			self.error(name, '檔案不存在')
+			return None
+		try:
+			return etree.fromstring(self.package.read(name), self.parser)
+		except etree.XMLSyntaxError as e:
+			self.error(name, 'XML 格式錯誤: ' + e.msg, e.lineno)
+			return None
+
+	def run(self):
+		self.check_mimetype()
+		opf_path = self.check_container()
+		if opf_path is None:
+			return self.problems
+		opf = self.parse(opf_path)
+		if opf is None:
+			return self.problems
+		items = self.check_manifest(opf, opf_path)
+		self.check_spine(opf, opf_path, items)
+
+		# 先讀入所有 XHTML 的 id, 再檢查連結
+		docs = []
+		for id, (href, media_type) in items.items():
+			if media_type in (XHTML_TYPE, NCX_TYPE) and href in self.package.name_set:
+				root = self.parse(href)
+				if root is not None:
+					docs.append((href, root))
+					if media_type == XHTML_TYPE:
+						self.ids[href] = self.collect_ids(href, root)
+		for href, root in docs:
+			self.check_links(href, root)
+		return self.problems
+
+	def check_mimetype(self):
+		p = self.package
+		if 'mimetype' not in p.name_set:
+			self.error('mimetype', '沒有 mimetype 檔')
+			return
+		if p.read('mimetype') != b'application/epub+zip':
+			self.error('mimetype', 'mimetype 的內容必須是 application/epub+zip')
+		if p.zip is not None:
+			if p.names[0] != 'mimetype':
+				self.error('mimetype', 'mimetype 必須是 zip 中的第一個檔案')
+			if p.zip.getinfo('mimetype').compress_type != zipfile.ZIP_STORED:
+				self.error('mimetype', 'mimetype 不可以壓縮')
+
+	def check_container(self):
+		''' 傳回 OPF 的路徑 '''
+		name = 'META-INF/container.xml'
+		root = self.parse(name)
+		if root is None:
+			return None
+		rootfile = root.find('.//' + CONTAINER_NS + 'rootfile')
+		if rootfile is None or rootfile.get('full-path') is None:
+			self.error(name, '沒有 rootfile')
+			return None
+		return rootfile.get('full-path')
+
+	def check_manifest(self, opf, opf_path):
+		''' 傳回 id => (EPUB 中的路徑, media-type) '''
+		items = collections.OrderedDict()
+		base = posixpath.dirname(opf_path)
+		for e in opf.iter(OPF_NS + 'item'):
+			id = e.get('id')
+			href = posixpath.normpath(posixpath.join(base, urllib.parse.unquote(e.get('href', ''))))
+			if id in items:
+				self.error(opf_path, 'manifest 中重複的 id: {}'.format(id), e.sourceline)
+			if href not in self.package.name_set:
+				self.error(opf_path, 'manifest 中的檔案不存在: {}'.format(href), e.sourceline)
+			items[id] = (href, e.get('media-type'))
+		listed = set(href for href, media_type in items.values())
+		for name in self.package.names:
+			if name == 'mimetype' or name == opf_path or name.startswith('META-INF/'):
+				continue
+			if name not in listed:
+				self.warning(name, '檔案沒有列在 manifest 中')
+		return items
+
+	def check_spine(self, opf, opf_path, items):
+		spine = opf.find(OPF_NS + 'spine')
+		if spine is None:
+			self.error(opf_path, '沒有 spine')
+			return
+		toc = spine.get('toc')
+		if toc is not None and toc not in items:
+			self.error(opf_path, 'spine 的 toc 不在 manifest 中: ' + toc, spine.sourceline)
+		for e in spine.iter(OPF_NS + 'itemref'):
+			idref = e.get('idref')
+			if idref not in items:
+				self.error(opf_path, 'spine 中的 idref 不在 manifest 中: {}'.format(idref), e.sourceline)
+			elif items[idref][1] != XHTML_TYPE:
+				self.warning(opf_path, 'spine 中的項目不是 XHTML: {}'.format(idref), e.sourceline)
+
+	def collect_ids(self, name, root):
+		ids = set()
+		for e in root.iter(tag=etree.Element):
+			id = e.get('id')
+			if id is None:
+				continue
+			if id in ids:
+				self.error(name, '重複的 id: ' + id, e.sourceline)
+			ids.add(id)
+		return ids
+
+	def check_links(self, name, root):
+		base = posixpath.dirname(name)
+		for e in root.iter(tag=etree.Element):
+			for att in ('href', 'src'):
+				url = e.get(att)
+				if url is not None:
+					self.check_link(name, base, url, e.sourceline)
+
+	def check_link(self, name, base, url, line):
+		parts = urllib.parse.urlsplit(url)
+		if parts.scheme != '' or parts.netloc != '':
+			return # 外部連結
+		if parts.path == '':
+			target = name
+		else:
+			target = posixpath.normpath(posixpath.join(base, urllib.parse.unquote(parts.path)))
+			if target not in self.package.name_set:
+				self.error(name, '連結的檔案不存在: ' + url, line)
+				return
+		if parts.fragment != '' and target in self.ids:
+			if parts.fragment not in self.ids[target]:
+				self.error(name, '連結的錨點不存在: ' + url, line)
+
+def run_epubcheck(checker_path, epub_path):
+	''' 以 epubcheck 驗證一本書, 傳回 Result '''
+	try:
+		p = subprocess.run(['java', '-jar', checker_path, epub_path], stdout=subprocess.PIPE,
+			stderr=subprocess.STDOUT, universal_newlines=True)
+	except OSError as e:
+		# 沒有安裝 Java
+		return Result(epub_path, False, [Problem('ERROR', epub_path, None, str(e))], None, '')
+	problems = parse_epubcheck_output(p.stdout, epub_path)
+	ok = p.returncode == 0 and all(x.level == 'WARNING' for x in problems)
+	return Result(epub_path, ok, problems, p.returncode, p.stdout)
+
+def parse_epubcheck_output(output, epub_path):
+	problems = []
+	prefix = epub_path + '/'
+	for line in output.splitlines():
+		m = EPUBCHECK_LINE.match(line.strip())
+		if m is None:
+			continue
+		level, file, row, col, message = m.groups()
+		if file.startswith(prefix):
+			file = file[len(prefix):]
+		if level == 'FATAL':
+			level = 'ERROR'
+		problems.append(Problem(level, file, int(row) if row is not None else None, message))
+	return problems
+
+def check_many(epub_paths, checker_path=None, jobs=None, pre=True):
+	''' 同時驗證多本書, 依 epub_paths 的順序傳回 Result 的 list
+	pre 為 True 時先做 precheck, 沒通過的書就不必再啟動 epubcheck
+	checker_path 為 None 時只做 precheck '''
+	def check(path):
+		problems = []
+		if pre:
+			try:
+				problems = precheck(path)
+			except (OSError, zipfile.BadZipFile) as e:
+				problems = [Problem('ERROR', path, None, str(e))]
+			if any(x.level == 'ERROR' for x in problems):
+				return Result(path, False, problems, None, '')
+		if checker_path is None:
+			return Result(path, True, problems, None, '')
+		r = run_epubcheck(checker_path, path)
+		return r._replace(problems=problems + r.problems)
+	# 每本書各自啟動一個 java process, thread 只負責等待
+	with concurrent.futures.ThreadPoolExecutor(jobs or os.cpu_count() or 1) as pool:
+		return list(pool.map(check, epub_paths))
+
+def format_result(r):
+	''' Result 的文字說明: 第一行為 ok 或 FAIL 及路徑, 之後每行一個問題 '''
+	lines = ['{} {}'.format('ok' if r.ok else 'FAIL', r.path)]
+	for p in r.problems:
+		line = '' if p.line is None else '({})'.format(p.line)
+		lines.append('\t{} {}{}: {}'.format(p.level, p.file, line, p.message))
+	return '\n'.join(lines)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='驗證 EPUB')
+	parser.add_argument('epub', nargs='+', help='EPUB 檔或 create_book() 寫出的資料夾')
+	parser.add_argument('--epubcheck', help='epubcheck 的 jar 檔, 沒有設定時只做 precheck')
+	parser.add_argument('-j', '--jobs', type=int, default=None, help='同時執行的 epubcheck 數, 預設為 CPU 核心數')
+	parser.add_argument('--json', action='store_true', help='以 JSON 輸出結果')
+	args = parser.parse_args(argv)
+
+	results = check_many(args.epub, args.epubcheck, args.jobs)
+	if args.json:
+		data = [{'path': r.path, 'ok': r.ok, 'returncode': r.returncode, 'problems': [p._asdict() for p in r.problems]} for r in results]
+		print(json.dumps(data, ensure_ascii=False, indent=1))
+	else:
+		for r in results:
+			print(format_result(r))
+	if all(r.ok for r in results):
+		return 0
+	return 1
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,285 @@
+# coding: utf8
+''' 監看 XML 及相關檔案, 存檔時自動重新產生 EPUB (或預覽用的 HTML 資料夾)
+用法:
+	python watch.py book.json [--preview ../output/preview] [--interval 0.3]
+	python run-exp1.py --watch
+
+book.json 是一本書的 config (與 x2epub.XmlToEpub 相同), 路徑以 JSON 檔所在的資料夾為基準。
+監看的檔案: xml 及其中 xi:include 引用的檔案 (遞迴)、css、cover_page、license_template、
+graphic_base 及 glyph_base 資料夾 (不含輸出的位置)。
+
+Python、lxml、程式的 hash 等都留在記憶體中, 不必每次重新啟動;
+各章的轉換結果也保留在記憶體中 (x2epub.ChapterCache), 只有 XML 改變的章才重新轉換,
+只改了 CSS、圖片或版權頁時, 各章都直接使用之前的結果, 只重新寫出;
+寫出 EPUB 時, 內容沒變的檔案直接使用上次壓縮好的資料 (epub.MemoryAssetCache)。
+xml 及 xi:include 引用的檔案各自 parse 後保留在記憶體中 (SourceTree), 只重新 parse 改變了的檔案。
+有 --preview 時寫出不封裝的 HTML 資料夾 (不必壓縮, 比較快), 否則寫出 config 中的 EPUB。
+監看時各章在同一個 process 中轉換 (不使用 workers), 也不執行 epub_validator。
+graphic_base 及 glyph_base 資料夾每 FOLDER_INTERVAL 秒才檢查一次。
+
+限制: 每次存檔仍要走訪整本書的 XML (計算各章快取的 key) 並重新寫出所有檔案,
+一本書分成多個 xi:include 的檔案時, 38MB 的書改一章約 0.6 秒;
+整本書在同一個 XML 檔時每次都要重新 parse, 約 1.3 秒。
+'''
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from lxml import etree
+import batch
+import epub
+import x2epub
+
+logger = logging.getLogger('x2epub.watch')
+
+INTERVAL = 0.5 # 檢查檔案是否改變的間隔秒數
+FOLDER_INTERVAL = 2.0 # 檢查 graphic_base, glyph_base 資料夾的間隔秒數, 走訪資料夾比檢查單一檔案慢
+# config 中監看的檔案及資料夾
+FILE_KEYS = ('css', 'cover_page', 'license_template')
+FOLDER_KEYS = ('graphic_base', 'glyph_base')
+# config 中輸出的位置, 監看資料夾時略過
+OUTPUT_KEYS = ('epub_path', 'temp_folder', 'cache_folder', 'image_cache', 'asset_cache')
+
+def include_files(xml):
+	''' xml 及其中 xi:include 引用的檔案 (遞迴), XML 有錯 (例如存檔到一半) 時只傳回讀得到的部分 '''
+	files = []
+	stack = [os.path.abspath(xml)]
+	while len(stack) > 0:
+		path = stack.pop()
+		if path in files:
+			continue
+		files.append(path)
+		try:
+			for event, e in etree.iterparse(path, tag=x2epub.XINCLUDE, huge_tree=True):
+				href = e.get('href')
+				if href is not None and e.get('parse', 'xml') == 'xml':
+					stack.append(os.path.join(os.path.dirname(path), href))
+		except (OSError, etree.XMLSyntaxError):
+			pass
+	return files
+
+class IncludeError(Exception):
+	''' SourceTree 不支援的 xi:include, 改為每次 parse 整本書 '''
+	pass
+
+class SourceTree:
+	''' xml 及其中 xi:include 引用的檔案組合成的 tree, 與 tree.xinclude() 後去掉 namespace 相同
+	各檔案的 root 元素保留在 tree 中, 之後只重新 parse 改變了的檔案, 替換 tree 中該檔案的部分
+	只支援引用整個 XML 檔 (沒有 parse="text"、xpointer、fallback), 且每個檔案只引用一次 '''
+	def __init__(self, xml, parser):
+		self.xml = os.path.abspath(xml)
+		self.parser = parser
+		self.roots = {} # 路徑 => 該檔案在 tree 中的 root 元素
+		self.includes = {} # 路徑 => 其中 xi:include 引用的檔案路徑
+
+	def files(self):
+		return list(self.roots)
+
+	def update(self, changed):
+		''' 重新 parse changed 中的檔案 (第一次時全部), 傳回組合好的 tree '''
+		self.loaded = set()
+		try:
+			root = self.load(self.xml, set(changed))
+		except Exception:
+			# 可能只替換了一部分, 下次全部重新 parse
+			self.roots = {}
+			self.includes = {}
+			raise
+		# 沒有引用到的檔案不再保留
+		for path in list(self.roots):
+			if path not in self.loaded:
+				del self.roots[path]
+				del self.includes[path]
+		return root.getroottree()
+
+	def load(self, path, changed):
+		''' 傳回 path 在 tree 中的 root 元素 '''
+		if path in self.loaded:
+			raise IncludeError('{} 被引用了不只一次'.format(path))
+		self.loaded.add(path)
+		root = self.roots.get(path)
+		if root is not None and path not in changed:
+			for child in self.includes[path]:
+				old = self.roots[child]
+				new = self.load(child, changed)
+				if new is not old:
+					new.tail = old.tail
+					old.getparent().replace(old, new)
+			return root
+		root = etree.parse(path, self.parser).getroot()
+		elements = list(root.iter(x2epub.XINCLUDE))
+		x2epub.strip_subtree_namespaces(root)
+		includes = []
+		for e in elements:
+			href = e.get('href')
+			if not href or e.get('parse', 'xml') != 'xml' or e.get('xpointer') is not None or len(e) > 0 or e is root:
+				raise IncludeError('{} 中有不支援的 xi:include'.format(path))
+			child = os.path.normpath(os.path.join(os.path.dirname(path), href))
+			new = self.load(child, changed)
+			new.tail = e.tail
+			e.getparent().replace(e, new)
+			includes.append(child)
+		self.roots[path] = root
+		self.includes[path] = includes
+		return root
+
+def file_state(path):
+	try:
+		st = os.stat(path)
+	except OSError:
+		return None
+	return (st.st_mtime_ns, st.st_size)
+
+class Watcher:
+	def __init__(self, config, preview=None):
+		self.config = dict(config)
+		self.config.pop('workers', None)
+		self.config.pop('epub_validator', None)
+		if preview is not None:
+			self.config['targets'] = {'html': preview}
+		self.chapter_cache = {} # 各章的轉換結果, 多次轉換之間保留
+		self.config['chapter_cache'] = self.chapter_cache
+		self.asset_cache = epub.MemoryAssetCache() # 壓縮好的各章 HTML 等, 內容沒變的不必再壓縮
+		self.config['asset_cache'] = self.asset_cache
+		outputs = [self.config.get(k) for k in OUTPUT_KEYS]
+		outputs.extend(self.config.get('targets', {}).values())
+		self.outputs = [os.path.abspath(p) for p in outputs if isinstance(p, str)]
+		# graphic_base, glyph_base 預設都是 XML 所在的資料夾; 以 SourceTree 轉換時 config 中沒有 xml
+		for k in FOLDER_KEYS:
+			self.config.setdefault(k, os.path.dirname(self.config['xml']))
+		self.source = None
+		if not self.config.get('streaming', False):
+			parser = x2epub.get_parser(self.config.get('huge_tree', False), self.config.get('remove_comments', True),
+				self.config.get('remove_pis', True))
+			self.source = SourceTree(self.config['xml'], parser)
+		self.sources = [] # XML 及 xi:include 引用的檔案
+		self.state = None # 路徑 => (mtime, size), 第一次檢查之前是 None
+		self.folder_state = None # graphic_base, glyph_base 資料夾中的檔案, 每 FOLDER_INTERVAL 秒更新
+		self.folder_time = 0
+		self.builds = 0
+
+	def is_output(self, path):
+		return any(path == p or path.startswith(p + os.sep) for p in self.outputs)
+
+	def snapshot(self):
+		''' 所有監看的檔案的 (mtime, size) '''
+		state = {}
+		for path in self.sources:
+			state[path] = file_state(path)
+		for k in FILE_KEYS:
+			if k in self.config:
+				path = os.path.abspath(self.config[k])
+				state[path] = file_state(path)
+		now = time.monotonic()
+		if self.folder_state is None or now - self.folder_time >= FOLDER_INTERVAL:
+			self.folder_state = self.folder_snapshot()
+			self.folder_time = now
+		for path, s in self.folder_state.items():
+			state.setdefault(path, s)
+		return state
+
+	def folder_snapshot(self):
+		state = {}
+		folders = set(os.path.abspath(self.config[k]) for k in FOLDER_KEYS)
+		for folder in folders:
+			for root, dirs, files in os.walk(folder):
+				dirs[:] = [d for d in dirs if not self.is_output(os.path.join(root, d))]
+				for f in files:
+					path = os.path.join(root, f)
+					if not self.is_output(path):
+						state[path] = file_state(path)
+		return state
+
+	def changed(self, state):
+		''' 與上次相比改變了的檔案 '''
+		if self.state is None:
+			return list(state)
+		return [path for path in set(state) | set(self.state) if state.get(path) != self.state.get(path)]
+
+	def build(self, changed=()):
+		''' 轉換一次, 傳回秒數; 失敗時記錄錯誤, 傳回 None '''
+		t = time.perf_counter()
+		config = dict(self.config)
+		try:
+			if self.source is not None:
+				try:
+					tree = self.source.update(changed)
+				except IncludeError as e:
+					logger.warning('%s, 每次都重新 parse 整本書', e)
+					self.source = None
+				else:
+					del config['xml']
+					config['lxml-etree'] = tree
+			converter = x2epub.XmlToEpub(config)
+			if converter.convert() is False:
+				logger.error('config 中沒有 xml')
+				return None
+		except Exception:
+			logger.exception('轉換失敗')
+			return None
+		# 只保留這次用到的各章結果, 記憶體用量不會隨修改次數增加
+		if converter.cache is not None:
+			for key in list(self.chapter_cache):
+				if key not in converter.cache.used:
+					del self.chapter_cache[key]
+		self.asset_cache.prune()
+		self.builds += 1
+		return time.perf_counter() - t
+
+	def source_files(self):
+		''' XML 及 xi:include 引用的檔案 '''
+		if self.source is not None and len(self.source.roots) > 0:
+			return self.source.files()
+		return include_files(self.config['xml'])
+
+	def update(self):
+		''' 檢查檔案, 有改變 (或第一次) 時重新轉換, 傳回改變的檔案 '''
+		state = self.snapshot()
+		changed = self.changed(state)
+		if self.state is not None and len(changed) == 0:
+			return []
+		self.state = state
+		seconds = self.build(changed)
+		if len(self.sources) == 0 or any(path in self.sources for path in changed):
+			# XML 改變時 xi:include 引用的檔案可能改變, 新的檔案加入監看
+			self.sources = self.source_files()
+			for path in self.sources:
+				if path not in self.state:
+					self.state[path] = file_state(path)
+		if seconds is not None:
+			logger.info('%d 個檔案改變, 轉換 %.2f 秒', len(changed), seconds)
+		return changed
+
+	def run(self, interval=INTERVAL):
+		''' 持續監看, 直到 Ctrl-C '''
+		while True:
+			self.update()
+			time.sleep(interval)
+
+def watch(config, preview=None, interval=INTERVAL):
+	''' 監看 config 中的檔案, 改變時重新轉換, 直到 Ctrl-C; run-*.py 以 --watch 執行時使用 '''
+	if not logging.getLogger().hasHandlers():
+		logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%H:%M:%S')
+	watcher = Watcher(config, preview)
+	try:
+		watcher.run(interval)
+	except KeyboardInterrupt:
+		pass
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='監看 XML, 存檔時自動重新產生 EPUB')
+	parser.add_argument('config', help='JSON 格式的一本書的 config')
+	parser.add_argument('--preview', help='寫出不封裝的 HTML 資料夾, 不產生 EPUB')
+	parser.add_argument('--interval', type=float, default=INTERVAL, help='檢查檔案的間隔秒數')
+	args = parser.parse_args(argv)
+	with open(args.config, 'r', encoding='utf-8-sig') as fi:
+		config = json.load(fi)
+	base = os.path.dirname(os.path.abspath(args.config))
+	config = batch.make_configs({}, [config], base)[0]
+	watch(config, args.preview, args.interval)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -3,22 +3,56 @@
 作者: 周邦信, 2013.10.22-11.19
 環境:
 	MS Windows 8.1
-	Python 3.3.2
-	lxml 3.2.3
+	Python 3.7 以上
+	lxml 4.2 以上
 '''
-import argparse, collections
+import argparse
+import concurrent.futures
+import contextlib
+import copy
 import datetime
+import functools
+import hashlib
+import io
+import logging
 import os
+import pickle
 import re
 import sys
 import shutil
+import time
+import types
+import urllib.parse
+import urllib.request
 from string import Template
 from lxml import etree
 import epub
+import images
+import profiling
+import validate
+
+# 轉換過程的訊息, 預設不輸出, 要看的話可以 logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger('x2epub')
+logger.addHandler(logging.NullHandler())
 
 IGNORE_SPACE = ('table', 'row')
+XINCLUDE = '{http://www.w3.org/2001/XInclude}include'
+HTML_ID = re.compile(r' id="([^"]+)"')
+LOCAL_HREF = re.compile(r'href="#([^"]+)"')
+SVG_SRC = re.compile(r'src="[^"]*\.svg"')
+_parsers = {} # get_parser() 建立的 parser, key 是 parser 設定
+_converter_version = None # converter_version() 的結果
+LOCAL = 'local' # XmlToEpub.traverse_chapters() 中表示在主 process 轉換的一章
+# 不影響各章轉換結果的 config key, 不列入章快取的 key
+CACHE_IGNORE_KEYS = ('xml', 'lxml-etree', 'epub_path', 'temp_folder', 'epub_validator', 'workers', 
+	'cache_folder', 'streaming', 'huge_tree', 'remove_comments', 'remove_pis', 'cover_page', 'publisher', 
+	'license_template', 'image_cache', 'compress_level', 'compress_threads', 'precheck', 'profile', 'profile_memory',
+	'handle_text_batch', 'targets', 'chapter_cache', 'asset_cache', 'sandbox') # handle_text_batch 的結果已在章的 XML 中
+TEXT_BATCH_SIZE = 4096 # 每次傳給 handle_text_batch 的文字節點數
+TARGET_FORMATS = {'epub3': 3, 'epub2': 2, 'html': None} # config['targets'] 的格式 => EPUB 版本, None 是 HTML 資料夾
 
 class HtmlClass:
+	__slots__ = ('classes',)
 	def __init__(self, c=None):
 		self.classes = []
 		if c is not None:
@@ -29,29 +63,117 @@ class HtmlClass:
 		return ' '.join(self.classes)
 		
 class MyNode:
+	__slots__ = ('tag', 'att', 'content')
 	def __init__(self, tag=None):
 		self.tag = tag
-		self.att = collections.OrderedDict()
+		self.att = [] # (key, value) list, 保持屬性設定的順序
 		self.content = ''
 		
 	def set(self, key, value):
-		self.att[key] = value
+		att = self.att
+		for i in range(len(att)):
+			if att[i][0] == key:
+				att[i] = (key, value)
+				return
+		att.append((key, value))
+		
+	def _attributes(self):
+		return ''.join([' {}="{}"'.format(k, v) for k, v in self.att])
+		
+	def start_tag(self):
+		return '<{}{}>'.format(self.tag, self._attributes())
+		
+	def empty_tag(self):
+		return '<{}{}/>'.format(self.tag, self._attributes())
+		
+	def end_tag(self):
+		return '</{}>'.format(self.tag)
 		
 	def __str__(self):
-		r = '<' + self.tag
-		for k, v in self.att.items():
-			r += ' {}="{}"'.format(k, v)
 		if self.content == '':
-			r += '/>'
-		else:
-			r += '>' + self.content + '</{}>'.format(self.tag)
-		return r
+			return self.empty_tag()
+		return self.start_tag() + self.content + self.end_tag()
+
+class StructureIndex:
+	''' 走訪一次 XML tree, 記錄 handler 需要的結構資訊, 
+	handler 查表即可, 不必在每個節點重新搜尋子樹 '''
+	__slots__ = ('lg_containers', 'div_heads', 'block_quotes')
+	def __init__(self, root):
+		self.lg_containers = set() # 子孫中有 lg 的元素
+		self.div_heads = {} # div => 第一個 head 子元素
+		self.block_quotes = set() # 有 p 或 lg 子元素的 quote
+		for e in root.iter('lg', 'head', 'p'):
+			parent = e.getparent()
+			if parent is None:
+				continue
+			if e.tag == 'head':
+				if parent.tag == 'div' and parent not in self.div_heads:
+					self.div_heads[parent] = e
+				continue
+			if parent.tag == 'quote':
+				self.block_quotes.add(parent)
+			if e.tag == 'lg':
+				# 上層已記錄過的話, 更上層也一定已記錄
+				while parent is not None and parent not in self.lg_containers:
+					self.lg_containers.add(parent)
+					parent = parent.getparent()
+					
+	def contains_lg(self, e):
+		return e in self.lg_containers
+		
+	def head_of(self, div):
+		return self.div_heads.get(div)
+		
+	def is_block_quote(self, quote):
+		return quote in self.block_quotes
 
 class XmlToEpub:
+	# TEI 標記 與 處理函式名稱 的對照表, 處理函式的參數為 (e, mode)
+	# 不在表中的標記只轉換其內容
+	HANDLERS = {
+		'bibl': 'handle_bibl',
+		'byline': 'handle_byline',
+		'cell': 'handle_cell',
+		'cit': 'handle_cit',
+		'div': 'handle_div',
+		'emph': 'handle_emph',
+		'figure': 'handle_figure',
+		'front': 'handle_front',
+		'g': 'handle_g',
+		'graphic': 'handle_graphic',
+		'head': 'handle_head',
+		'item': 'handle_item',
+		'l': 'handle_l',
+		'label': 'handle_label',
+		'lb': 'handle_lb',
+		'lg': 'handle_lg',
+		'list': 'handle_list',
+		'note': 'handle_note',
+		'opener': 'handle_opener',
+		'p': 'handle_p',
+		'placeName': 'handle_placeName',
+		'q': 'handle_q',
+		'quote': 'handle_quote',
+		'ref': 'handle_ref',
+		'row': 'handle_row',
+		'seg': 'handle_seg',
+		'supplied': 'handle_supplied',
+		'table': 'handle_table',
+		'term': 'handle_term',
+		'title': 'handle_title',
+	}
+	
 	def __init__(self, config):
 		self.config = config
 		self.config.setdefault('convert_lb_to_br', True) # 預設 lb 標記會換行
 		self.config.setdefault('epub_ver', 3) # 預設 EPUB version 3
+		self.config.setdefault('workers', 1) # 同時轉換各章的 process 數, 預設逐章轉換
+		self.config.setdefault('precheck', False) # 產生 EPUB 時以 validate.precheck() 檢查
+		
+		# XML parser 設定
+		self.config.setdefault('huge_tree', False) # 非常大的 XML 要設為 True
+		self.config.setdefault('remove_comments', True) # handle_node 本來就會略過註解
+		self.config.setdefault('remove_pis', True)
 		
 		# graphic_base
 		# 圖片的來源位置，預設與來源 XML 同一目錄
@@ -64,49 +186,157 @@ class XmlToEpub:
 		if 'xml' in config:
 			self.config.setdefault('glyph_base', os.path.dirname(config['xml']))
 		
+		# sandbox
+		# 設定為資料夾時, 圖片、缺字字圖的 url 不能是絕對路徑或含 .., 檔案必須在這個資料夾之中
+		# 轉換不可信任的 XML (例如 server.py 收到的上傳) 時使用
+		
 		self.div_level = 0
 		self.chapter = 0
 		self.counter_note = 0
 		self.head_count = 0
 		self.list_level = 0
 		self.anchors = set()
+		self.bottom_notes = []
 		self.chars = {}
+		self.glyphs = {} # 缺字 id => (來源路徑, url, 是否為 svg), handle_g 使用
 		self.properties = set()
+		self.out = [] # 轉換結果的輸出, handler 將 HTML 片段 append 到這個 list
+		self.cache = None # 設定 cache_folder 時為 ChapterCache
+		
+		# 分割過大的章, 見 add_split_chapter()
+		self.split_size = self.config.get('split_size') # 一章 HTML 的字數上限, None 表示不分割
+		self.chapter_out = None # 正在轉換的一章的輸出, 只在 split_size 有設定時使用
+		self.chapter_div = None
+		self.div_nodes = [] # 一章中目前開啟的 div
+		self.split_marks = [] # 可以分割的位置: (在 chapter_out 中的位置, 當時開啟的 div)
+		self.chapter_toc_nodes = [] # 一章中 href 指向本章的目錄節點
+		self.problems = [] # precheck 找到的問題, validate.Problem 的 list, 多個 targets 時包含各個 EPUB 的問題
+		self.validation = None # 設定 epub_validator 時為 epubcheck 的結果 validate.Result, 多個 targets 時是最後一個 EPUB 的結果
+		
+		# 圖片最佳化
+		self.image_optimizer = None
+		if 'image_profile' in config:
+			image_cache = config.get('image_cache')
+			if image_cache is None and 'cache_folder' in config:
+				image_cache = os.path.join(config['cache_folder'], 'images')
+			self.image_optimizer = images.ImageOptimizer(config['image_profile'], image_cache)
+		
+		# 壓縮好的 CSS、缺字圖等, 多本書共用, 見 epub.AssetCache
+		self.asset_cache = None
+		asset_cache = config.get('asset_cache')
+		if asset_cache is None and 'cache_folder' in config:
+			asset_cache = os.path.join(config['cache_folder'], 'assets')
+		if isinstance(asset_cache, epub.AssetCache):
+			self.asset_cache = asset_cache
+		elif asset_cache is not None:
+			self.asset_cache = epub.AssetCache(asset_cache)
+		self.lang_stack = ['zh'] # 由 handle_node 維護, 最後一個是目前元素的語言
+		
+		# 輸出: 轉換一次, 寫出多個 EPUB 或 HTML 資料夾
+		for format in self.config.get('targets', {}):
+			if format not in TARGET_FORMATS:
+				raise ValueError('不支援的 target: {}'.format(format))
+		if 'targets' in self.config and self.config.get('streaming', False):
+			raise ValueError('streaming 時不能設定 targets')
+		
+		# 效能紀錄, 見 profiling.py
+		self.profiler = None
+		if config.get('profile'):
+			self.profiler = profiling.Profiler(config.get('profile_memory', False))
+		
+		# tag => handler, 每個 converter 建立一次
+		self.handlers = {}
+		self.custom_tags = set() # 自訂 handler 的標記, 目錄標題也交給 handler 轉換
+		for tag, name in self.HANDLERS.items():
+			self.handlers[tag] = getattr(self, name)
+			if getattr(type(self), name) is not getattr(XmlToEpub, name):
+				self.custom_tags.add(tag) # 繼承後改寫的 handler
+			if self.profiler is not None:
+				self.handlers[tag] = self.profiler.wrap_handler(tag, self.handlers[tag])
+		for tag, func in config.get('handlers', {}).items():
+			self.set_handler(tag, func)
+		
+		# 文字處理: text_map 的替換、HTML 跳脫、移除換行、handle_text callback, 每次轉換只建立一次
+		self.process_text = make_text_processor(config.get('text_map'), config.get('handle_text'))
 		
 	def handle_text(self, s):
 		if s is None: return ''
-		s = s.replace('&', '&amp;')
-		s = s.replace('\n', '')
-		if 'handle_text' in self.config:
-			func = self.config['handle_text']
-			s = func(s)
-		return s
+		return self.process_text(s)
+		
+	def batch_text(self, e):
+		''' 有設定 handle_text_batch 時, 在轉換 e 之前先以它處理 e 之中所有的文字 '''
+		func = self.config.get('handle_text_batch')
+		if func is not None:
+			with self.phase('text_batch'):
+				apply_text_batch(e, func)
+		
+	def write(self, s):
+		''' 將一段 HTML 寫到目前的輸出 (self.out), 空字串不寫 '''
+		if s != '':
+			self.out.append(s)
+			
+	def reserve(self):
+		''' 先在輸出中保留一個位置, 待內容輸出後再以 close_node() 填入起始標記 '''
+		self.out.append('')
+		return len(self.out) - 1
+		
+	def close_node(self, i, node):
+		''' 填入 reserve() 保留位置的起始標記並輸出結束標記, 沒有內容時輸出空標記 <tag/> '''
+		out = self.out
+		if len(out) == i + 1:
+			out[i] = node.empty_tag()
+		else:
+			out[i] = node.start_tag()
+			out.append(node.end_tag())
+			
+	def write_node(self, node, e, mode='html'):
+		''' 輸出 node, 以 e 的內容做為 node 的內容 '''
+		i = self.reserve()
+		self.traverse(e, mode)
+		self.close_node(i, node)
+		
+	def capture(self, e, mode='html'):
+		''' 將 e 的內容轉換為字串傳回, 不寫到目前的輸出 '''
+		out = self.out
+		self.out = []
+		self.traverse(e, mode)
+		r = ''.join(self.out)
+		self.out = out
+		return r
+		
+	def capture_node(self, e, mode='html'):
+		''' 將 e 轉換為字串傳回, 不寫到目前的輸出 '''
+		out = self.out
+		self.out = []
+		self.handle_node(e, mode)
+		r = ''.join(self.out)
+		self.out = out
+		return r
 	
 	def traverse(self, node, mode='html'):
-		r=''
-		if node.tag not in IGNORE_SPACE:
-			r += self.handle_text(node.text)
-		for n in node.iterchildren(): 
-			r += self.handle_node(n, mode)
-			if node.tag not in IGNORE_SPACE:
-				r += self.handle_text(n.tail)
-		return r
+		''' 將 node 的內容轉換後寫到目前的輸出 '''
+		if node.tag in IGNORE_SPACE:
+			for n in node.iterchildren(): 
+				self.handle_node(n, mode)
+		else:
+			self.write(self.handle_text(node.text))
+			for n in node.iterchildren(): 
+				self.handle_node(n, mode)
+				self.write(self.handle_text(n.tail))
 		
-	def handle_bibl(self, e):
-		parent = e.getparent()
+	def handle_bibl(self, e, mode='html'):
 		rend = e.get('rend')
-		content = self.traverse(e)
-		if rend is None:
-			return content
-		if 'display:block' in rend:
-			class1 = 'bibl'
-			if e.get('lang')=='zh':
-				class1 = 'bibl_zh'
-			return '<p style="{}" class="{}">{}</p>'.format(rend, class1, content)
-		else:
-			return content
+		if (rend is None) or ('display:block' not in rend):
+			self.traverse(e)
+			return
+		class1 = 'bibl'
+		if self.current_lang()=='zh':
+			class1 = 'bibl_zh'
+		self.write('<p style="{}" class="{}">'.format(rend, class1))
+		self.traverse(e)
+		self.write('</p>')
 			
-	def handle_cell(self, e):
+	def handle_cell(self, e, mode='html'):
 		n = MyNode('td')
 		rend = e.get('rend')
 		if rend is not None:
@@ -115,125 +345,260 @@ class XmlToEpub:
 			n.set('rowspan', e.get('rows'))
 		if 'cols' in e.attrib:
 			n.set('colspan', e.get('cols'))
-		n.content = self.traverse(e)
-		return str(n)
+		self.write_node(n, e)
 		
-	def handle_cit(self, e):
+	def handle_cit(self, e, mode='html'):
 		rend = e.get('rend')
-		content = self.traverse(e)
 		if rend is None:
-			r = content
+			self.traverse(e)
 		elif 'display:block' in rend:
-			r = '<div class="cit">{}</div>\n'.format(content)
+			self.write('<div class="cit">')
+			self.traverse(e)
+			self.write('</div>\n')
 		else:
-			r = '<span style="{}">{}</span>'.format(rend, content)
-		return r
+			self.write('<span style="{}">'.format(rend))
+			self.traverse(e)
+			self.write('</span>')
 		
-	def handle_div(self, e):
+	def handle_div(self, e, mode='html'):
 		parent = e.getparent()
 		self.div_level += 1
-		head = e.find('head')
+		head = self.index.head_of(e)
 		if head is not None:
 			node = self.book.add_toc_node(self.current_toc_node[-1])
 			self.current_toc_node.append(node)
 			if self.div_level > self.book.toc_depth:
 				self.book.toc_depth = self.div_level
+				
+		node = MyNode('div')
+		rend = e.get('rend')
+		if rend is not None:
+			node.set('style', rend)
+			
+		rendition = e.get('rendition')
+		if rendition is not None:
+			node.set('class', rendition)
+			
 		if parent.tag!='front' and self.div_level == 1:
 			self.chapter += 1
-			self.bottom_notes = ''
+			self.bottom_notes = []
 			self.counter_note = 0
 			self.anchors = set()
 			self.properties = set()
-			content = self.traverse(e)
-			if (e.get('type')=='copyright') and ('after_copyright' in self.config):
-				content += self.config['after_copyright']
-			r = '<html xmlns="http://www.w3.org/1999/xhtml">\n<head>\n'
-			r += self.charset_declaration + '\n'
-			r += '<title>{}</title>\n'.format(self.book.title)
+			
+			# 每一章各自輸出到一個 list, 最後一次 join 成 HTML 檔
+			out = self.out
+			self.out = []
+			self.write('<html xmlns="http://www.w3.org/1999/xhtml">\n<head>\n')
+			self.write(self.charset_declaration + '\n')
+			self.write('<title>{}</title>\n'.format(self.book.title))
 			if 'css' in self.config:
-				r += '<link rel="stylesheet" type="text/css" href="{}" />\n'.format(self.css_filename)
-			r += '</head>\n<body>\n'
+				self.write('<link rel="stylesheet" type="text/css" href="{}" />\n'.format(self.css_filename))
+			self.write('</head>\n<body>\n')
 			
-			node = MyNode('div')
-			rend = e.get('rend')
-			if rend is not None:
-				node.set('style', rend)
-				
-			rendition = e.get('rendition')
-			if rendition is not None:
-				node.set('class', rendition)
-				
-			node.content = content
-			r += str(node)
-			if self.bottom_notes != '':
-				r += '<div>' + self.bottom_notes + '</div>\n'
-			r += '</body></html>'
+			if self.profiler is not None:
+				started = time.perf_counter()
+			i = self.reserve()
+			if self.split_size is not None:
+				self.chapter_div = e
+				self.chapter_out = self.out
+				self.div_nodes = [node]
+				self.split_marks = []
+				self.chapter_toc_nodes = []
+			self.traverse(e)
+			if (e.get('type')=='copyright') and ('after_copyright' in self.config):
+				self.write(self.config['after_copyright'])
+			self.close_node(i, node)
+			self.chapter_out = None
 			
 			fn = '{}.htm'.format(self.chapter)
-			if len(self.properties) > 0:
-				properties = ' '.join(self.properties)
+			if self.split_size is not None and sum(len(s) for s in self.out) > self.split_size:
+				files = self.add_split_chapter(i, fn)
 			else:
-				properties = None
-			self.book.add_html('', fn, r, properties=properties)
+				if len(self.bottom_notes) > 0:
+					self.write('<div>' + ''.join(self.bottom_notes) + '</div>\n')
+				self.write('</body></html>')
+				html = ''.join(self.out)
+				self.book.add_html('', fn, html, properties=self.html_properties())
+				files = [(fn, html)]
+			if self.profiler is not None:
+				self.profiler.add_chapter(self.chapter, [name for name, html in files], 
+					time.perf_counter() - started, sum(len(html.encode('utf8')) for name, html in files))
+			self.out = out
 		else:
-			node = MyNode('div')
-			rend = e.get('rend')
-			if rend is not None:
-				node.set('style', rend)
-				
-			rendition = e.get('rendition')
-			if rendition is not None:
-				node.set('class', rendition)
-				
-			node.content = self.traverse(e)
-			r = str(node)
+			self.mark_split(e)
+			if self.chapter_out is not None:
+				self.div_nodes.append(node)
+				self.write_node(node, e)
+				self.div_nodes.pop()
+			else:
+				self.write_node(node, e)
 		self.div_level -= 1
 		if head is not None:
 			self.current_toc_node.pop()
-		return r
 		
-	def handle_figure(self, e):
+	def html_properties(self, html=None):
+		''' 一章的 properties (manifest 中的 item 屬性)
+		分割一章時, 只有用到 SVG 的部分才有 svg 屬性 '''
+		properties = set(self.properties)
+		if html is not None and 'svg' in properties and SVG_SRC.search(html) is None:
+			properties.remove('svg')
+		if len(properties) > 0:
+			return ' '.join(properties)
+		return None
+		
+	def mark_split(self, e):
+		''' 記錄 e 之前可以分割一章的位置, 只在 e 與一章的 div 之間都是 div 時才能分割 '''
+		if self.chapter_out is None or self.out is not self.chapter_out:
+			return
+		a = e.getparent()
+		while a is not self.chapter_div:
+			if a.tag != 'div':
+				return
+			a = a.getparent()
+		self.split_marks.append((len(self.out), tuple(self.div_nodes)))
+		
+	def add_split_chapter(self, i, fn):
+		''' 一章的 HTML 超過 split_size 時, 在 mark_split() 記錄的位置分割為多個 HTML 檔
+		第一個檔名不變 (例如 3.htm), 之後為 3_2.htm, 3_3.htm...
+		分割處的外層 div 在前一個檔案結束, 在下一個檔案重新開始;
+		註解放在註解錨點所在的檔案, 連結及目錄的 href 指向 id 所在的檔案
+		傳回 [(檔名, HTML)] '''
+		out = self.out
+		head = ''.join(out[:i])
+		# 依 split_size 選擇分割位置: (開始位置, 開始時重新開啟的 div)
+		starts = [(i, ())]
+		size = 0
+		last = None
+		pos = i
+		for mark in self.split_marks + [(len(out), ())]:
+			size += sum(len(s) for s in out[pos:mark[0]])
+			pos = mark[0]
+			if size > self.split_size and last is not None and last[0] > starts[-1][0]:
+				starts.append(last)
+				size = sum(len(s) for s in out[last[0]:pos])
+			last = mark
+		
+		parts = []
+		for k, (start, nodes) in enumerate(starts):
+			if k + 1 < len(starts):
+				end, end_nodes = starts[k + 1]
+			else:
+				end, end_nodes = len(out), ()
+			body = ''.join(n.start_tag() for n in nodes)
+			body += ''.join(out[start:end])
+			body += ''.join(n.end_tag() for n in reversed(end_nodes))
+			name = fn if k == 0 else '{}_{}.htm'.format(self.chapter, k + 1)
+			parts.append([name, body, []])
+		
+		# 註解放在錨點所在的檔案, 找不到錨點時放在最後一個檔案
+		for note in self.bottom_notes:
+			mo = re.match(r'<p id="([^"]*)"', note)
+			target = parts[-1]
+			if mo is not None:
+				a_id = 'id="noteAnchor_{}"'.format(mo.group(1))
+				for part in parts:
+					if a_id in part[1]:
+						target = part
+						break
+			target[2].append(note)
+		
+		locations = {}
+		for name, body, notes in parts:
+			for id in HTML_ID.findall(body + ''.join(notes)):
+				locations[id] = name
+		
+		def relink(name, html):
+			def repl(mo):
+				target = locations.get(mo.group(1), name)
+				if target == name:
+					return mo.group(0)
+				return 'href="{}#{}"'.format(target, mo.group(1))
+			return LOCAL_HREF.sub(repl, html)
+		
+		files = []
+		for name, body, notes in parts:
+			html = head + relink(name, body)
+			if len(notes) > 0:
+				html += '<div>' + relink(name, ''.join(notes)) + '</div>\n'
+			html += '</body></html>'
+			self.book.add_html('', name, html, properties=self.html_properties(html))
+			files.append((name, html))
+		
+		prefix = fn + '#'
+		for node in self.chapter_toc_nodes:
+			if node.href.startswith(prefix):
+				id = node.href[len(prefix):]
+				node.href = '{}#{}'.format(locations.get(id, fn), id)
+		return files
+		
+	def handle_figure(self, e, mode='html'):
 		rend = e.get('rend', 'text-align:center')
-		content = self.traverse(e)
-		r = '<div style="{}">{}</div>\n'.format(rend, content)
-		return r
+		self.write('<div style="{}">'.format(rend))
+		self.traverse(e)
+		self.write('</div>\n')
 		
-	def handle_front(self, e):
-		r = '<html xmlns="http://www.w3.org/1999/xhtml">\n<head>\n'
-		r += self.charset_declaration + '\n'
-		r += '<title>{}</title>\n'.format(self.book.title)
+	def handle_front(self, e, mode='html'):
+		out = self.out
+		self.out = []
+		self.write('<html xmlns="http://www.w3.org/1999/xhtml">\n<head>\n')
+		self.write(self.charset_declaration + '\n')
+		self.write('<title>{}</title>\n'.format(self.book.title))
 		if self.css_filename is not None:
-			r += '<link rel="stylesheet" type="text/css" href="{}" />\n'.format(self.css_filename)
-		r += '</head>\n<body>\n<div>\n' + self.traverse(e) + '</div></body></html>'
+			self.write('<link rel="stylesheet" type="text/css" href="{}" />\n'.format(self.css_filename))
+		self.write('</head>\n<body>\n<div>\n')
+		self.traverse(e)
+		self.write('</div></body></html>')
 		
 		fn = 'front.htm'
-		self.book.add_html('', fn, r)
-		return r
+		self.book.add_html('', fn, ''.join(self.out))
+		self.out = out
 		
-	def handle_g(self, e):
+	def handle_g(self, e, mode='html'):
 		ref = e.get('ref')
 		id = ref[1:]
-		url = self.chars[id]
-		if url.endswith('.svg'):
+		glyph = self.glyphs.get(id)
+		if glyph is None:
+			# 每個缺字只解析一次
+			url = self.chars[id]
+			src = self.source_path('glyph_base', url)
+			logger.debug('glyph %s: %s', id, src)
+			glyph = (src, url, url.endswith('.svg'))
+			self.glyphs[id] = glyph
+		src, url, svg = glyph
+		if svg:
 			self.properties.add('svg')
-		r = '<img class="glyph" src="{}" width="18" />'.format(url)
-		src = os.path.join(self.config['glyph_base'], url)
-		print(191, src)
-		self.book.add_image(src, url)
-		return r
+		item = self.book.add_image(src, url)
+		self.write('<img class="glyph" src="{}" width="18" />'.format(item.dest_path))
+		
+	def source_path(self, key, url):
+		''' 圖片、缺字字圖的來源路徑, 以 config[key] 為基準
+		有 sandbox 時 url 不能是絕對路徑或含 .., 檔案也必須在 sandbox 之中 '''
+		base = self.config.get(key)
+		if base is None:
+			raise ValueError('沒有設定 {}, 找不到 {}'.format(key, url))
+		sandbox = self.config.get('sandbox')
+		if sandbox is None:
+			return os.path.join(base, url)
+		if os.path.isabs(url) or '..' in re.split(r'[\\/]', url):
+			raise SandboxError('不允許的路徑: ' + url)
+		path = sandbox_path(sandbox, os.path.join(base, url))
+		if not os.path.isfile(path):
+			raise SandboxError('找不到檔案: ' + url)
+		return path
 		
-	def handle_graphic(self, e):
+	def handle_graphic(self, e, mode='html'):
 		url = e.get('url')
 		rend = e.get('rend')
 		
 		if url.endswith('.svg'):
 			self.properties.add('svg')
 			
-		src = os.path.join(self.config['graphic_base'], e.get('url'))
-		self.book.add_image(src, url)
+		src = self.source_path('graphic_base', url)
+		item = self.book.add_image(src, url)
 		
 		node = MyNode('img')
-		node.set('src', url)
+		node.set('src', item.dest_path)
 		node.set('alt', '')
 		if rend is not None:
 			node.set('style', rend)
@@ -252,12 +617,16 @@ class XmlToEpub:
 			if mo.group(2) != '':
 				node.set('unit', mo.group(2))
 
-		r = str(node)
-		return r
+		self.write(node.empty_tag())
 		
-	def handle_head(self, e):
-		head = self.traverse(e)
+	def handle_head(self, e, mode='html'):
 		parent = e.getparent()
+		i = self.reserve()
+		if parent.tag == 'div' and e.get('type') != 'sub':
+			# 內文與目錄標題在同一次走訪中產生
+			toc_title = self.traverse_toc(e)
+		else:
+			self.traverse(e)
 		rend = e.get('rend', '')
 		node = MyNode()
 		if parent.tag == 'div':
@@ -268,20 +637,13 @@ class XmlToEpub:
 				else:
 					node.tag = 'h{}'.format(self.div_level+1)
 			else:
-				self.head_count += 1
-				toc_node = self.current_toc_node[-1]
-				if e.get('lang') == 'en' and toc_node.title != '':
-					toc_node.title += ' '
-				toc_node.title += self.traverse(e, 'toc')
-				if toc_node.href == '':
-					toc_node.href = '{}.htm#a_{}'.format(self.chapter, self.head_count)
-					toc_node.play_order = self.head_count
+				id = self.add_head_toc(e, toc_title)
 				if self.div_level > 6:
 					node.tag = 'p'
 					node.set('class', 'head')
 				else:
 					node.tag = 'h{}'.format(self.div_level)
-				node.set('id', 'a_{}'.format(self.head_count))
+				node.set('id', id)
 		elif parent.tag == 'table':
 			node.tag = 'caption'
 		elif parent.tag == 'figure':
@@ -292,25 +654,70 @@ class XmlToEpub:
 			node.set('class', 'head')
 		if rend != '':
 			node.set('style', rend)
-		node.content = head
-		return str(node)
+		self.close_node(i, node)
+		
+	def traverse_toc(self, node):
+		''' 與 traverse() 相同, 並傳回 toc 模式的結果 (目錄標題)
+		seg、lb 在 toc 模式不輸出, 不含 ref、note 及自訂 handler 的子元素直接使用 html 模式的結果;
+		其他子元素的結果與轉換的狀態有關 (例如 noteAnchor 第二次出現時不給 id),
+		等 html 模式都轉換完, 再以 toc 模式另外轉換 '''
+		out = self.out
+		text = self.handle_text(node.text)
+		self.write(text)
+		toc = [text]
+		again = [] # (在 toc 中的位置, 子元素)
+		for n in node.iterchildren():
+			start = len(out)
+			self.handle_node(n, 'html')
+			tag = n.tag
+			if tag == 'seg' or tag == 'lb':
+				pass
+			elif self.is_toc_stateful(n):
+				again.append((len(toc), n))
+				toc.append('')
+			else:
+				toc.extend(out[start:])
+			text = self.handle_text(n.tail)
+			self.write(text)
+			toc.append(text)
+		for i, n in again:
+			toc[i] = self.capture_node(n, 'toc')
+		return ''.join(toc)
+		
+	def is_toc_stateful(self, e):
+		''' e 在 toc 模式的結果是否可能與 html 模式不同 (以 lxml 的 iter 在 C 中尋找) '''
+		return next(e.iter('ref', 'note', *self.custom_tags), None) is not None
+		
+	def add_head_toc(self, e, title):
+		''' div 的 head (type 不是 sub) 加入目錄標題 (toc 模式的 head 內容), 傳回 head 的 id '''
+		self.head_count += 1
+		toc_node = self.current_toc_node[-1]
+		if self.current_lang() == 'en' and toc_node.title != '':
+			toc_node.title += ' '
+		toc_node.title += title
+		if toc_node.href == '':
+			toc_node.href = '{}.htm#a_{}'.format(self.chapter, self.head_count)
+			toc_node.play_order = self.head_count
+			if self.chapter_out is not None:
+				self.chapter_toc_nodes.append(toc_node)
+		return 'a_{}'.format(self.head_count)
 		
-	def handle_label(self, e):
+	def handle_label(self, e, mode='html'):
 		rend = e.get('rend', '')
 		node = MyNode('div')
 		node.set('class', 'label')
 		if rend != '':
 			node.set('style', rend)
-		node.content = self.traverse(e)
-		return str(node)
+		self.write_node(node, e)
 		
-	def handle_lg(self, e):
+	def handle_lg(self, e, mode='html'):
+		self.mark_split(e)
 		c = HtmlClass('lg')
 		if 'rendition' in e.attrib:
 			c.add(e.get('rendition'))
 			
 		parent = e.getparent()
-		if parent.tag=='quote' and e.get('lang')=='zh':
+		if parent.tag=='quote' and self.current_lang()=='zh':
 			c.add('quote_zh')
 			
 		node = MyNode('div')
@@ -318,45 +725,41 @@ class XmlToEpub:
 		rend = e.get('rend')
 		if rend is not None:
 			node.set('style', rend)
-		node.content = self.traverse(e)
-		return str(node)
+		self.write_node(node, e)
 		
-	def handle_list(self, e):
+	def handle_list(self, e, mode='html'):
 		self.list_level += 1
 		
 		node = MyNode()
 		rend = e.get('rend')
 		if rend is not None:
 			node.set('style', rend)
-		node.content = self.traverse(e)
 		
 		type = e.get('type')
 		if type=='ordered':
 			node.tag = 'ol'
-			r = str(node)
 		elif type=='bulleted':
 			node.tag = 'ul'
-			r = str(node)
 		else:
 			node.tag = 'div'
 			node.set('class', 'list')
-			r = str(node)
+		self.write_node(node, e)
 			
 		self.list_level -= 1
-		return r
 		
-	def handle_note(self, e, mode):
+	def handle_note(self, e, mode='html'):
 		place = e.get('place', '')
-		r = ''
-		content = self.traverse(e)
 		if place == 'inline':
-			r = '<span class="inline_note">' + content + '</span>'
+			self.write('<span class="inline_note">')
+			self.traverse(e)
+			self.write('</span>')
 		elif place == 'inline2':  # 雙行夾註
-			r = '<span class="inline_note2">' + content + '</span>'
+			self.write('<span class="inline_note2">')
+			self.traverse(e)
+			self.write('</span>')
 		elif place == 'bottom':
-			if mode=='toc':
-				r = ''
-			else:
+			content = self.capture(e)
+			if mode!='toc':
 				id = e.get('id')
 				n = e.get('n')
 				if id is None:
@@ -365,9 +768,9 @@ class XmlToEpub:
 						n = str(self.counter_note)
 					id = 'n' + n
 				id = id.replace('*', 'star')
-				self.bottom_notes += '<p id="{}" class="note"><a href="#noteAnchor_{}">{}</a> {}</p>\n'.format(id, id, n, content)
+				self.bottom_notes.append('<p id="{}" class="note"><a href="#noteAnchor_{}">{}</a> {}</p>\n'.format(id, id, n, content))
 				a_id = 'noteAnchor_{}'.format(id)
-				r = '<a id="{}" href="#{}" class="noteAnchor">{}</a>'.format(a_id, id, n)
+				self.write('<a id="{}" href="#{}" class="noteAnchor">{}</a>'.format(a_id, id, n))
 				self.anchors.add(a_id)
 		else:
 			id = e.get('id')
@@ -379,13 +782,12 @@ class XmlToEpub:
 					href = '#noteAnchor_{}'.format(id)
 					node.set('href', href)
 					node.content = n
-					r = str(node) + ' '
+					self.write(str(node) + ' ')
 				else:
-					r = str(node)
-			r += content
-		return r
+					self.write(str(node))
+			self.traverse(e)
 		
-	def handle_opener(self, e):
+	def handle_opener(self, e, mode='html'):
 		node = MyNode('p')
 		rend = e.get('rend', '')
 		if rend != '':
@@ -397,13 +799,13 @@ class XmlToEpub:
 			node.set('class', c)
 		else:
 			node.set('class', 'opener')
-		node.content = self.traverse(e)
-		r = str(node) + '\n'
-		return r
+		self.write_node(node, e)
+		self.write('\n')
 		
-	def handle_p(self, e):
+	def handle_p(self, e, mode='html'):
+		self.mark_split(e)
 		# 賢度法師《華嚴經十地品淺釋》p. 332, <p> 包 <lg>
-		if has_descendant(e, 'lg'):
+		if self.index.contains_lg(e):
 			tag = 'div'
 		else:
 			tag = 'p'
@@ -416,67 +818,64 @@ class XmlToEpub:
 			if c.startswith('#'):
 				c = c[1:]
 			node.set('class', c)
-		node.content = self.traverse(e)
-		r = str(node) + '\n'
-		return r
+		self.write_node(node, e)
+		self.write('\n')
 		
-	def handle_quote(self, e):
+	def handle_quote(self, e, mode='html'):
 		rend = e.get('rend', '')
 		c = HtmlClass('quote')
-		lang = e.get('lang')
-		if lang is None or lang=='zh':
+		if self.current_lang()=='zh':
 			c.add('quote_zh')
 		node = MyNode('p')
 		node.set('class', c)
 		if ('display:block' in rend) or ('display:inline-block' in rend):
 			node.tag = 'div'
 		else:
-			if (e.find('p') is None) and (e.find('lg') is None):
-				node.tag = 'span'
-			else:
+			if self.index.is_block_quote(e):
 				node.tag = 'div'
+			else:
+				node.tag = 'span'
 		if rend != '':
 			node.set('style', rend)
-		node.content = self.traverse(e)
-		r = str(node)
-		return r
+		self.write_node(node, e)
 		
-	def handle_ref(self, e):
-		content = self.traverse(e)
+	def handle_ref(self, e, mode='html'):
+		i = self.reserve()
+		self.traverse(e)
 		if e.get('type')=='noteAnchor':
 			target = e.get('target')
 			a_id = 'noteAnchor_{}'.format(target[1:])
 			# 如果相同的 target 已出現過, 就不給 ID, 避免 ID 重複
 			if a_id in self.anchors:
-				r = '<a href="{}" class="noteAnchor">{}</a>'.format(target, content)
+				self.out[i] = '<a href="{}" class="noteAnchor">'.format(target)
 			else:
 				self.anchors.add(a_id)
-				r = '<a id="{}" href="{}" class="noteAnchor">{}</a>'.format(a_id, target, content)
+				self.out[i] = '<a id="{}" href="{}" class="noteAnchor">'.format(a_id, target)
 		else:
-			r = '<a href="{}">{}</a>'.format(e.get('target'), content)
-		return r
+			self.out[i] = '<a href="{}">'.format(e.get('target'))
+		self.write('</a>')
 		
-	def handle_seg(self, e, mode):
+	def handle_seg(self, e, mode='html'):
 		if mode=='toc':
-			return ''
+			return
 		node = MyNode('span')
 		if 'rend' in e.attrib:
 			node.set('style', e.get('rend'))
 		if 'rendition' in e.attrib:
 			node.set('class', e.get('rendition'))
-		node.content = self.traverse(e)
-		if e.get('rendition') == 'ruby_base' and  node.content == ' ':
-			node.content = '　'
-		r = str(node)
-		return r
+		i = self.reserve()
+		self.traverse(e)
+		if e.get('rendition') == 'ruby_base' and ''.join(self.out[i+1:]) == ' ':
+			del self.out[i+1:]
+			self.write('　')
+		self.close_node(i, node)
 		
-	def handle_supplied(self,e):
+	def handle_supplied(self, e, mode='html'):
 		node = MyNode('span')
 		node.set('class', 'supplied')
-		node.content = self.traverse(e)
-		return str(node)
+		self.write_node(node, e)
 		
-	def handle_table(self, e):
+	def handle_table(self, e, mode='html'):
 		rend = e.get('rend')
 		rendition = e.get('rendition')
 		node = MyNode('table')
@@ -486,139 +885,141 @@ class XmlToEpub:
 			node.set('style', rend)
 		if rendition is not None:
 			node.set('class', rendition)
-		node.content = self.traverse(e)
-		return str(node)
+		self.write_node(node, e)
 		
-	def handle_title(self, e):
+	def handle_title(self, e, mode='html'):
 		rend = e.get('rend')
-		content = self.traverse(e)
 		if rend is None:
-			lang = e.get('lang')
-			if lang is None:
-				r = content
+			if self.current_lang() in ('en', 'pi'):
+				self.write('<span style="font-style:italic">')
+				self.traverse(e)
+				self.write('</span>')
 			else:
-				if lang in ('en', 'pi'):
-					r = '<span style="font-style:italic">{}</span>'.format(content)
-				else:
-					r = content
+				self.traverse(e)
 		else:
-			r = '<span style="{}">{}</span>'.format(rend, content)
-		return r
+			self.write('<span style="{}">'.format(rend))
+			self.traverse(e)
+			self.write('</span>')
 		
-	def handle_node(self, e, mode):
-		tag=e.tag
-		if tag==etree.Comment: return ''
-		parent = e.getparent()
-		if 'lang' not in e.attrib:
-			lang = parent.get('lang', 'zh')
-			e.set('lang', lang)
-		r = ''
-		if tag=='bibl': 
-			r = self.handle_bibl(e)
-		elif tag=='byline': 
-			rend = e.get('rend')
-			if rend is None:
-				r = '<p class="byline">'
-			else:
-				r = '<p class="byline" style="{}">'.format(rend)
-			r += self.traverse(e) + '</p>\n'
-		elif tag=='cell': 
-			r = self.handle_cell(e)
-		elif tag=='cit':
-			r = self.handle_cit(e)
-		elif tag=='div':
-			r = self.handle_div(e)
-		elif tag=='emph':
-			r = '<span class="emph">{}</span>'.format(self.traverse(e))
-		elif tag=='figure':
-			r = self.handle_figure(e)
-		elif tag=='front':
-			r = self.handle_front(e)
-		elif tag=='g': 
-			r = self.handle_g(e)
-		elif tag=='graphic': 
-			r = self.handle_graphic(e)
-		elif tag=='head': 
-			r = self.handle_head(e)
-		elif tag=='item':
-			rend = e.get('rend')
-			if parent.get('type') is None:
-				if rend is None:
-					r += '<div class="item">' + self.traverse(e) + '</div>'
-				else:
-					r += '<div style="{}">{}</div>'.format(rend, self.traverse(e))
-			else:
-				node = MyNode('li')
-				node.content = self.traverse(e)
-				if rend is not None:
-					node.set('style', rend)
-				r += str(node)
-		elif tag=='l':
-			r += self.traverse(e)
-			next = e.getnext()
-			if (next is not None) and (next.tag in ('l', 'lb', 'pb')):
-				r += '<br/>\n'
-		elif tag=='label':
-			r = self.handle_label(e)
-		elif tag=='lb':
-			type = e.get('type', '')
-			if mode=='html':
-				if type=='always-newline':
-					r = '<br/>'
-				elif parent.tag != 'table':
-					if self.config['convert_lb_to_br']:
-						r = '<br/>'
-		elif tag=='lg':
-			r = self.handle_lg(e)
-		elif tag=='list':
-			r = self.handle_list(e)
-		elif tag=='note':
-			r = self.handle_note(e, mode)
-		elif tag=='opener': 
-			r = self.handle_opener(e)
-		elif tag=='p': 
-			r = self.handle_p(e)
-		elif tag=='placeName': 
-			rend = e.get('rend')
-			if rend is None:
-				r = self.traverse(e)
-			else:
-				r = '<span style="{}">{}</span>'.format(rend, self.traverse(e))
-		elif tag=='q': 
-			rend = e.get('rend')
-			if rend is None:
-				r = '<span class="quote">' + self.traverse(e) + '</span>'
-			elif 'display:block' in rend:
-				r = '<p class="quote">{}</p>\n'.format(self.traverse(e))
-			else:
-				r = '<span class="quote" style="{}">{}</span>'.format(rend, self.traverse(e))
-		elif tag=='quote':
-			r = self.handle_quote(e)
-		elif tag=='ref':
-			r = self.handle_ref(e)
-		elif tag=='row': 
-			r = '<tr>' + self.traverse(e) + '</tr>\n'
-		elif tag=='seg': 
-			r = self.handle_seg(e, mode)
-		elif tag=='supplied':
-			r = self.handle_supplied(e)
-		elif tag=='table': 
-			r = self.handle_table(e)
-		elif tag=='term': 
-			rend = e.get('rend')
+	def handle_byline(self, e, mode='html'):
+		rend = e.get('rend')
+		if rend is None:
+			self.write('<p class="byline">')
+		else:
+			self.write('<p class="byline" style="{}">'.format(rend))
+		self.traverse(e)
+		self.write('</p>\n')
+		
+	def handle_emph(self, e, mode='html'):
+		self.write('<span class="emph">')
+		self.traverse(e)
+		self.write('</span>')
+		
+	def handle_item(self, e, mode='html'):
+		rend = e.get('rend')
+		if e.getparent().get('type') is None:
 			if rend is None:
-				r = self.traverse(e)
+				self.write('<div class="item">')
 			else:
-				r = '<span style="{}">{}</span>'.format(rend, self.traverse(e))
-		elif tag=='text':
-			if e.get('lang') is None:
-				e.set('lang', 'zh')
-			r = self.traverse(e)
-		elif tag=='title': 
-			r = self.handle_title(e)
-		else: 
-			r = self.traverse(e)
-		return r
+				self.write('<div style="{}">'.format(rend))
+			self.traverse(e)
+			self.write('</div>')
+		else:
+			node = MyNode('li')
+			if rend is not None:
+				node.set('style', rend)
+			self.write_node(node, e)
+			
+	def handle_l(self, e, mode='html'):
+		self.traverse(e)
+		next = e.getnext()
+		if (next is not None) and (next.tag in ('l', 'lb', 'pb')):
+			self.write('<br/>\n')
+			
+	def handle_lb(self, e, mode='html'):
+		type = e.get('type', '')
+		if mode=='html':
+			if type=='always-newline':
+				self.write('<br/>')
+			elif e.getparent().tag != 'table':
+				if self.config['convert_lb_to_br']:
+					self.write('<br/>')
+					
+	def handle_placeName(self, e, mode='html'):
+		rend = e.get('rend')
+		if rend is None:
+			self.traverse(e)
+		else:
+			self.write('<span style="{}">'.format(rend))
+			self.traverse(e)
+			self.write('</span>')
+			
+	def handle_q(self, e, mode='html'):
+		rend = e.get('rend')
+		if rend is None:
+			self.write('<span class="quote">')
+			self.traverse(e)
+			self.write('</span>')
+		elif 'display:block' in rend:
+			self.write('<p class="quote">')
+			self.traverse(e)
+			self.write('</p>\n')
+		else:
+			self.write('<span class="quote" style="{}">'.format(rend))
+			self.traverse(e)
+			self.write('</span>')
+			
+	def handle_row(self, e, mode='html'):
+		self.write('<tr>')
+		self.traverse(e)
+		self.write('</tr>\n')
+		
+	def handle_term(self, e, mode='html'):
+		rend = e.get('rend')
+		if rend is None:
+			self.traverse(e)
+		else:
+			self.write('<span style="{}">'.format(rend))
+			self.traverse(e)
+			self.write('</span>')
+			
+	def current_lang(self):
+		''' 目前元素的語言: 元素的 xml:lang, 沒有的話繼承上層元素的語言 '''
+		return self.lang_stack[-1]
+		
+	def set_handler(self, tag, func):
+		''' 設定 TEI 標記 tag 的處理函式, 可以處理自訂標記或取代內建的處理方式
+		func(converter, e, mode) 將 e 轉換後以 converter.write() 寫到輸出,
+		e 的內容可以用 converter.traverse(e) 轉換 '''
+		handler = types.MethodType(func, self)
+		self.custom_tags.add(tag)
+		if self.profiler is not None:
+			handler = self.profiler.wrap_handler(tag, handler)
+		self.handlers[tag] = handler
+		
+	def count(self, name):
+		if self.profiler is not None:
+			self.profiler.count(name)
+		
+	def phase(self, name):
+		''' 有設定 profile 時記錄一個階段的時間, 用法: with self.phase('parse'): ... '''
+		if self.profiler is None:
+			return contextlib.nullcontext()
+		return self.profiler.phase(name)
+		
+	def handle_node(self, e, mode):
+		''' 轉換一個元素, 結果寫到目前的輸出 '''
+		tag=e.tag
+		if tag is etree.Comment or tag is etree.PI: return
+		# 沒有 xml:lang 就繼承上層元素的語言, 不修改 XML tree
+		lang_stack = self.lang_stack
+		lang_stack.append(e.get('lang', lang_stack[-1]))
+		handler = self.handlers.get(tag)
+		if handler is None:
+			self.traverse(e)
+		else:
+			handler(e, mode)
+		lang_stack.pop()
 		
 	def get_author(self):
 		root = self.root
@@ -681,25 +1082,12 @@ class XmlToEpub:
 		node.href = 'license.htm'
 		node.play_order = self.head_count
 		
-	def convert(self):
-		if 'xml' in self.config:
-			tree = etree.parse(self.config['xml'])
-			tree.xinclude()
-			tree = strip_namespaces(tree)
-		elif 'lxml-etree' in self.config:
-			tree = self.config['lxml-etree']
-		else:
-			return False
-		root = tree.getroot()
+	def prepare_book(self, root):
+		''' 依 teiHeader 建立 EpubBook: 書名、作者、封面、CSS、缺字資訊 '''
 		self.root = root
 
-		self.book = epub.EpubBook()
-		self.book.epub_ver = self.config['epub_ver']
-		if self.book.epub_ver == 3:
-			# 避開 epub validate 時產生的問題
-			self.charset_declaration = '<meta charset="utf-8" />'
-		else:
-			self.charset_declaration = '<meta http-equiv="Content-Type" content="text/html; charset=utf-8" />'
+		self.book = self.new_book()
+		self.charset_declaration = epub.charset_declaration(self.book.epub_ver)
 		self.book.title = root.findtext('.//titleStmt/title')
 		
 		if 'publisher' in self.config:
@@ -728,25 +1116,713 @@ class XmlToEpub:
 				graphic = e.find('graphic')
 				url = graphic.get('url')
 				self.chars[id] = url
-				print(id, url)
+				logger.debug('charDecl %s: %s', id, url)
 		self.current_toc_node = [self.book.toc_root]
 		self.list_level = 0
 		
-		text_node = root.find('.//text')
-		self.traverse(text_node)
+		if 'cache_folder' in self.config or 'chapter_cache' in self.config:
+			try:
+				self.cache = ChapterCache(self.config.get('cache_folder'), self.config, self.render_state(), 
+					self.config.get('chapter_cache'), self.custom_methods())
+			except DigestError as e:
+				# 無法確定結果是否改變, 寧可不用快取, 也不要用到舊的結果
+				logger.warning('%s, 不使用章快取', e)
+		
+	def custom_methods(self):
+		''' 繼承後改寫的方法, name => 函式, 也是章快取 key 的一部分 '''
+		methods = {}
+		for cls in type(self).__mro__:
+			if cls is XmlToEpub:
+				break
+			for name, v in vars(cls).items():
+				v = getattr(type(self), name)
+				if name not in methods and callable(v):
+					methods[name] = v
+		return methods
 		
+	def new_book(self):
+		book = epub.EpubBook()
+		book.epub_ver = self.config['epub_ver']
+		book.html_ver = book.epub_ver
+		book.image_optimizer = self.image_optimizer
+		book.asset_cache = self.asset_cache
+		book.compress_level = self.config.get('compress_level', epub.COMPRESS_LEVEL)
+		book.compress_threads = self.config.get('compress_threads')
+		book.profiler = self.profiler
+		return book
+		
+	def targets(self):
+		''' 要寫出的 (格式, 路徑) list: config['targets'], 沒有設定的話是 config['epub_path'] 一個 EPUB '''
+		if 'targets' in self.config:
+			return list(self.config['targets'].items())
+		return [('epub{}'.format(self.config['epub_ver']), self.config['epub_path'])]
+		
+	def finish_book(self):
+		''' 加入版權頁, 依 targets 寫出各個 EPUB 或 HTML 資料夾, EPUB 寫出後驗證
+		各章的 HTML 及目錄只轉換一次, 不同版本的 EPUB 只在寫出時有差異 (見 EpubBook.html_ver) '''
 		if 'license_template' in self.config:
-			self.add_license_page()
+			with self.phase('license'):
+				self.add_license_page()
+		
+		epub_ver = self.book.epub_ver
+		for format, path in self.targets():
+			if TARGET_FORMATS[format] is None:
+				with self.phase('html'):
+					self.book.create_html(path)
+			else:
+				self.book.epub_ver = TARGET_FORMATS[format]
+				self.write_epub(path)
+		self.book.epub_ver = epub_ver
+		if self.asset_cache is not None and self.profiler is not None:
+			self.profiler.count('asset_cache_hits', self.asset_cache.hits)
+			self.profiler.count('asset_cache_misses', self.asset_cache.misses)
+		
+	def write_epub(self, epub_path):
+		''' 寫出 EPUB 並驗證 '''
+		if 'temp_folder' in self.config:
+			temp = self.config['temp_folder']
+			if not self.book.started:
+				if os.path.exists(temp):
+					clear_folder(temp)
+			with self.phase('write'):
+				self.book.create_book(temp)
+			# 封裝之前先檢查
+			if self.config['precheck']:
+				with self.phase('precheck'):
+					self.run_precheck(temp)
+			with self.phase('archive'):
+				epub.create_archive(temp, epub_path, self.book.compress_level, self.book.compress_threads, 
+					self.book.asset_cache)
+		else:
+			with self.phase('write'):
+				self.book.create_epub(epub_path)
+			if self.config['precheck'] and isinstance(epub_path, str):
+				with self.phase('precheck'):
+					self.run_precheck(epub_path)
+		
+		# epub_path 是檔案物件時無法以 epubcheck 驗證
+		if 'epub_validator' in self.config and isinstance(epub_path, str):
+			with self.phase('validate'):
+				self.validation = validate.run_epubcheck(self.config['epub_validator'], epub_path)
+			self.log_problems(self.validation.problems)
+			# 與過去直接執行 epubcheck 一樣, 驗證結果一定要讓使用者看到
+			print(validate.format_result(self.validation), flush=True)
 		
-		temp = self.config['temp_folder']
-		if os.path.exists(temp):
+	def run_precheck(self, path):
+		problems = validate.precheck(path)
+		self.problems.extend(problems)
+		self.log_problems(problems)
+		
+	def log_problems(self, problems):
+		for p in problems:
+			if p.level == 'ERROR':
+				logger.error('%s(%s): %s', p.file, p.line, p.message)
+			else:
+				logger.warning('%s(%s): %s', p.file, p.line, p.message)
+		
+	def parser_options(self):
+		c = self.config
+		return {'huge_tree': c['huge_tree'], 'remove_comments': c['remove_comments'], 'remove_pis': c['remove_pis']}
+		
+	def get_parser(self):
+		return get_parser(**self.parser_options())
+		
+	def convert(self):
+		''' 轉換為 EPUB; 有設定 profile 時傳回效能紀錄 (profiling.Profiler.report()) '''
+		if self.profiler is None:
+			return self.convert_document()
+		self.profiler.start()
+		try:
+			r = self.convert_document()
+		finally:
+			self.profiler.stop()
+		if r is False:
+			return r
+		if isinstance(self.config['profile'], str):
+			self.profiler.write(self.config['profile'])
+		return self.profiler.report()
+		
+	def convert_document(self):
+		if 'xml' in self.config:
+			if self.config.get('streaming', False):
+				return self.convert_streaming()
+			with self.phase('parse'):
+				tree = etree.parse(self.config['xml'], self.get_parser())
+			with self.phase('xinclude'):
+				tree.xinclude()
+			with self.phase('strip_namespaces'):
+				tree = strip_namespaces(tree)
+		elif 'lxml-etree' in self.config:
+			tree = self.config['lxml-etree']
+			has_namespace = tree.getroot().tag[0] == '{'
+			if has_namespace or 'handle_text_batch' in self.config:
+				# 不修改呼叫者的 tree, 在複本上去掉 namespace 及以 handle_text_batch 改寫文字
+				with self.phase('copy_tree'):
+					tree = copy.deepcopy(tree)
+			if has_namespace:
+				with self.phase('strip_namespaces'):
+					tree = strip_namespaces(tree)
+		else:
+			return False
+		root = tree.getroot()
+		with self.phase('prepare'):
+			self.prepare_book(root)
+			text_node = root.find('.//text')
+			self.batch_text(text_node)
+			self.index = StructureIndex(text_node)
+		
+		with self.phase('traverse'):
+			if self.config['workers'] > 1 or self.cache is not None:
+				self.traverse_chapters(text_node)
+			else:
+				self.out = []
+				self.lang_stack = [text_node.get('lang', 'zh')]
+				self.traverse(text_node)
+		
+		with self.phase('finish'):
+			self.finish_book()
+		
+	def render_state(self):
+		''' 轉換一章所需的全書資訊, 傳給 worker process, 也是章快取 key 的一部分 '''
+		return {
+			'title': self.book.title,
+			'epub_ver': self.book.epub_ver,
+			'charset_declaration': self.charset_declaration,
+			'css_filename': self.css_filename,
+			'chars': self.chars,
+		}
+		
+	def traverse_chapters(self, text_node):
+		''' 逐一轉換 text 下的元素, 每一章 (body, back 下的 div) 使用快取, 或以多個 process 同時轉換
+		各章之間只有 chapter, head_count 兩個計數器有關聯, 先數出每一章開始時的值,
+		各章轉換完後再依文件順序把 HTML、圖片、目錄合併回 self.book, 結果與逐章轉換相同 '''
+		text_lang = text_node.get('lang', 'zh')
+		pool = None
+		if self.config['workers'] > 1:
+			config = dict(self.config)
+			config.pop('lxml-etree', None)
+			config.pop('handle_text_batch', None) # 已經處理過, 不必是可以 pickle 的函式
+			config.pop('targets', None) # 可能有檔案物件
+			pool = concurrent.futures.ProcessPoolExecutor(self.config['workers'], 
+				initializer=_init_worker, initargs=(config, self.render_state()))
+		try:
+			# units: (element, lang, 該章開始時的 chapter, head_count, 快取 key, job)
+			# job: 不是一章時為 None, 否則為快取的結果或 worker 的 Future, 或 LOCAL 表示到時在這裡轉換
+			units = []
+			chapter = 0
+			head_count = 0
+			for c in text_node.iterchildren(tag=etree.Element):
+				if c.tag not in ('body', 'back'):
+					units.append((c, text_lang, 0, 0, None, None))
+					head_count += count_toc_heads(c)
+					continue
+				lang = c.get('lang', text_lang)
+				for d in c.iterchildren(tag=etree.Element):
+					if d.tag == 'div':
+						data = etree.tostring(d, encoding='unicode', with_tail=False)
+						key = None
+						job = None
+						if self.cache is not None:
+							key = self.cache.key(data, c.tag, lang, chapter, head_count)
+							job = self.cache.get(key)
+						if job is None:
+							if pool is None:
+								job = LOCAL
+							else:
+								job = pool.submit(_render_chapter, data, c.tag, lang, chapter, head_count)
+						units.append((d, lang, chapter, head_count, key, job))
+						chapter += 1
+					else:
+						units.append((d, lang, 0, 0, None, None))
+					head_count += count_toc_heads(d)
+					
+			for e, lang, chapter, head_count, key, job in units:
+				is_future = isinstance(job, concurrent.futures.Future)
+				if job is None or self.chapter != chapter or self.head_count != head_count:
+					# 不是一章, 或預估的計數器不對, 就在這裡轉換
+					if is_future:
+						job.cancel()
+					self.lang_stack = [lang]
+					self.out = []
+					self.handle_node(e, 'html')
+					continue
+				if is_future:
+					result, stats = job.result()
+					if stats is not None:
+						self.profiler.merge(stats)
+					self.count('chapters_parallel')
+				elif job is LOCAL:
+					result = self.render_chapter(e, lang)
+					self.count('chapters_local')
+				else:
+					result = job
+					self.count('chapters_cached')
+				if key is not None and result is not job:
+					self.cache.put(key, result)
+				self.merge_chapter(result)
+		finally:
+			if pool is not None:
+				pool.shutdown()
+		self.out = []
+		
+	def render_chapter(self, div, lang):
+		''' 在一個新的 EpubBook 中轉換一章, 傳回 merge_chapter() 需要的結果, 不影響 self.book
+		一章用到的圖片都會列在結果中, 不論前面的章是否已加過 '''
+		book = self.book
+		current_toc_node = self.current_toc_node
+		self.book = self.new_book()
+		self.book.title = book.title
+		self.current_toc_node = [self.book.toc_root]
+		self.lang_stack = [lang]
+		self.out = []
+		self.handle_node(div, 'html')
+		self.out = []
+		result = (list(self.book.items.values()), self.book.toc_root.children, self.book.toc_depth, 
+			self.chapter, self.head_count)
+		self.book = book
+		self.current_toc_node = current_toc_node
+		return result
+		
+	def cached_chapter(self, div, parent_tag, lang):
+		''' 從快取取得一章的轉換結果, 沒有的話就轉換並存入快取 '''
+		data = etree.tostring(div, encoding='unicode', with_tail=False)
+		key = self.cache.key(data, parent_tag, lang, self.chapter, self.head_count)
+		result = self.cache.get(key)
+		if result is None:
+			result = self.render_chapter(div, lang)
+			self.cache.put(key, result)
+			self.count('chapters_local')
+		else:
+			self.count('chapters_cached')
+		return result
+		
+	def merge_chapter(self, result):
+		''' 將 render_chapter() 的結果依序加入 self.book '''
+		items, toc_nodes, toc_depth, self.chapter, self.head_count = result
+		# 圖片與前面各章的圖片內容相同時, self.book 中的檔名可能不同, HTML 中的參照要跟著改
+		# 一章的 HTML 在該章的圖片之後加入
+		renames = {}
+		for item in items:
+			if item.html is None:
+				image = self.book.add_image(item.src_path, item.dest_path)
+				if image.dest_path != item.dest_path:
+					renames[item.dest_path] = image.dest_path
+			else:
+				html = item.html
+				for old, new in renames.items():
+					html = html.replace('src="{}"'.format(old), 'src="{}"'.format(new))
+				self.book.add_html(item.src_path, item.dest_path, html, properties=item.properties)
+		self.current_toc_node[-1].children.extend(toc_nodes)
+		if toc_depth > self.book.toc_depth:
+			self.book.toc_depth = toc_depth
+		
+	def convert_streaming(self):
+		''' 逐章轉換, 記憶體用量不隨書的大小增加
+		teiHeader 讀完時先建立 EpubBook, 之後 front 以及 body, back 下的每個元素 (一般是一章的 div)
+		讀完就轉換, HTML 直接寫到 EPUB (或 temp_folder), 再從記憶體中清除 '''
+		temp = self.config.get('temp_folder')
+		if temp is not None and os.path.exists(temp):
 			clear_folder(temp)
-		self.book.create_book(temp)
+		
+		with self.phase('stream'):
+			self.stream_document(temp)
+		with self.phase('finish'):
+			self.finish_book()
+		
+	def stream_document(self, temp):
+		''' 以 iterparse 讀取 XML, 逐章轉換 '''
+		root = None
+		level = 0 # TEI: 1, teiHeader, text: 2, front, body, back: 3
+		text_lang = 'zh'
+		parent_lang = 'zh'
+		options = self.parser_options()
+		for event, e in etree.iterparse(self.config['xml'], events=('start', 'end'), **options):
+			if event == 'start':
+				level += 1
+				if level == 1:
+					root = e
+				if level <= 3:
+					strip_element_namespace(e)
+					if level == 2 and e.tag == 'text':
+						text_lang = e.get('lang', 'zh')
+					elif level == 3:
+						parent_lang = e.get('lang', text_lang)
+				continue
+			
+			level -= 1
+			if level == 1 and e.tag == 'teiHeader':
+				strip_subtree_namespaces(e)
+				with self.phase('prepare'):
+					self.prepare_book(root)
+				if temp is None:
+					self.book.start_epub(self.config['epub_path'])
+				else:
+					self.book.start_book(temp)
+			elif level == 2 and e.tag == 'front':
+				self.lang_stack = [text_lang]
+				self.stream_node(e)
+			elif level == 3 and e.getparent().tag in ('body', 'back'):
+				if e.tag == XINCLUDE:
+					e = self.load_include(e)
+				self.lang_stack = [parent_lang]
+				self.stream_node(e, e.getparent().tag)
+				# 已轉換的元素從樹中移除
+				while e.getprevious() is not None:
+					del e.getparent()[0]
+		
+	def load_include(self, e):
+		''' 讀入 body 下的 xi:include 所引用的檔案, 取代 xi:include 元素 '''
+		path = os.path.join(os.path.dirname(self.config['xml']), e.get('href'))
+		tree = etree.parse(path, self.get_parser())
+		tree.xinclude()
+		node = tree.getroot()
+		e.getparent().replace(e, node)
+		return node
+		
+	def stream_node(self, e, parent_tag=None):
+		''' streaming 模式: 轉換一個讀完的元素, 然後清除它的內容
+		parent_tag 是 body 或 back 時, e 如果是 div 就是一章, 可以使用快取 '''
+		etree.XInclude()(e)
+		strip_subtree_namespaces(e)
+		self.batch_text(e)
+		self.index = StructureIndex(e)
+		if self.cache is not None and parent_tag is not None and e.tag == 'div':
+			self.merge_chapter(self.cached_chapter(e, parent_tag, self.lang_stack[-1]))
+		else:
+			self.out = []
+			self.handle_node(e, 'html')
+			self.out = []
+		e.clear()
 
-		epub.create_archive(temp, self.config['epub_path'])
-		if 'epub_validator' in self.config:
-			epub.check_epub(self.config['epub_validator'], self.config['epub_path'])
+class ChapterCache:
+	''' 各章轉換結果的快取, 存在 folder 中, 或存在 memory (dict, 多次轉換之間保留在記憶體中, 見 watch.py)
+	key 包含該章的 XML、開始時的計數器、影響轉換結果的 config、全書資訊及程式本身,
+	只改了一章時, 其他章就不必重新轉換 '''
+	def __init__(self, folder, config, state, memory=None, methods=None):
+		self.folder = folder
+		self.memory = memory # key => pickle 後的結果, 每次取出都是新的物件
+		self.used = set() # 這次轉換用到的 key
+		h = hashlib.sha1()
+		h.update(converter_version())
+		h.update(repr(digest_value(dict((k, v) for k, v in config.items() if k not in CACHE_IGNORE_KEYS))).encode('utf8'))
+		h.update(repr(digest_value(state)).encode('utf8'))
+		h.update(repr(digest_value(methods or {})).encode('utf8'))
+		self.base = h
+		
+	def key(self, data, parent_tag, lang, chapter, head_count):
+		h = self.base.copy()
+		h.update(repr((parent_tag, lang, chapter, head_count)).encode('utf8'))
+		h.update(data.encode('utf8'))
+		return h.hexdigest()
+		
+	def _path(self, key):
+		return os.path.join(self.folder, key[:2], key + '.pickle')
+		
+	def get(self, key):
+		self.used.add(key)
+		if self.memory is not None:
+			data = self.memory.get(key)
+			if data is not None:
+				return pickle.loads(data)
+		if self.folder is None:
+			return None
+		path = self._path(key)
+		if not os.path.exists(path):
+			return None
+		try:
+			with open(path, 'rb') as fi:
+				return pickle.load(fi)
+		except Exception:
+			# 損壞的快取檔當作沒有快取
+			return None
+			
+	def put(self, key, result):
+		self.used.add(key)
+		if self.memory is not None:
+			self.memory[key] = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+		if self.folder is None:
+			return
+		path = self._path(key)
+		folder = os.path.dirname(path)
+		if not os.path.exists(folder):
+			os.makedirs(folder)
+		# 先寫到暫存檔再改名, 避免同時轉換時讀到寫了一半的檔案
+		temp = '{}.{}.tmp'.format(path, os.getpid())
+		with open(temp, 'wb') as fo:
+			pickle.dump(result, fo, pickle.HIGHEST_PROTOCOL)
+		os.replace(temp, path)
+
+def converter_version():
+	''' 程式本身 (x2epub.py, epub.py) 的 hash, 程式改變時快取就失效 '''
+	global _converter_version
+	if _converter_version is None:
+		h = hashlib.sha1()
+		for path in (__file__, epub.__file__):
+			with open(path, 'rb') as fi:
+				h.update(fi.read())
+		_converter_version = h.digest()
+	return _converter_version
+
+class DigestError(ValueError):
+	''' config 中的值無法轉為可以比較的形式, 不能用來判斷章快取是否有效 '''
+	pass
+
+def digest_value(v, seen=None):
+	''' 將 config 的值轉為可以比較的形式
+	函式包含 bytecode、常數 (含內層函式)、預設參數、closure 及引用的全域變數的值,
+	無法確定內容的 callable (例如有 __call__ 的物件) raise DigestError '''
+	if seen is None:
+		seen = set()
+	if isinstance(v, dict):
+		return tuple(sorted((repr(k), digest_value(x, seen)) for k, x in v.items()))
+	if isinstance(v, (list, tuple)):
+		return (type(v).__name__,) + tuple(digest_value(x, seen) for x in v)
+	if isinstance(v, (set, frozenset)):
+		return (type(v).__name__,) + tuple(sorted(repr(digest_value(x, seen)) for x in v))
+	if isinstance(v, types.ModuleType):
+		return ('module', v.__name__)
+	if isinstance(v, types.CodeType):
+		return digest_code(v, seen)
+	if not callable(v):
+		return repr(v)
+	if isinstance(v, types.FunctionType):
+		return digest_function(v, seen)
+	if isinstance(v, types.MethodType):
+		if not isinstance(v.__self__, type):
+			raise DigestError('無法比較 {!r} 的物件狀態'.format(v))
+		return ('method', v.__self__.__module__, v.__self__.__qualname__, digest_value(v.__func__, seen))
+	if isinstance(v, functools.partial):
+		return ('partial', digest_value(v.func, seen), digest_value(v.args, seen), digest_value(v.keywords, seen))
+	if isinstance(v, type):
+		return ('type', v.__module__, v.__qualname__)
+	if isinstance(v, (types.BuiltinFunctionType, types.MethodDescriptorType, types.WrapperDescriptorType,
+			types.MethodWrapperType, types.ClassMethodDescriptorType)):
+		owner = getattr(v, '__self__', None)
+		if owner is not None and not isinstance(owner, (types.ModuleType, type)):
+			owner = digest_value(owner, seen) # 例如 'abc'.upper
+		elif owner is not None:
+			owner = digest_value(owner, seen)
+		return ('builtin', getattr(v, '__module__', None), v.__qualname__, owner)
+	raise DigestError('無法比較 {!r}'.format(v))
 
+def digest_function(f, seen):
+	if f in seen: # 遞迴呼叫的函式
+		return ('function', f.__module__, f.__qualname__)
+	seen.add(f)
+	cells = []
+	for cell in f.__closure__ or ():
+		try:
+			cells.append(digest_value(cell.cell_contents, seen))
+		except ValueError: # 還沒有值的 cell
+			cells.append(None)
+	# 引用的全域變數 (名稱在 co_names 中), 改了常數或呼叫的函式, 結果也會不同
+	names = set()
+	collect_names(f.__code__, names)
+	globals_ = []
+	for name in sorted(names):
+		if name in f.__globals__:
+			globals_.append((name, digest_value(f.__globals__[name], seen)))
+	return ('function', f.__module__, f.__qualname__, digest_code(f.__code__, seen),
+		digest_value(f.__defaults__, seen), digest_value(f.__kwdefaults__, seen), tuple(cells), tuple(globals_))
+
+def digest_code(code, seen):
+	consts = tuple(digest_value(c, seen) for c in code.co_consts)
+	return (hashlib.sha1(code.co_code).hexdigest(), code.co_names, consts)
+
+def collect_names(code, names):
+	''' code 及其中內層函式的 co_names '''
+	names.update(code.co_names)
+	for c in code.co_consts:
+		if isinstance(c, types.CodeType):
+			collect_names(c, names)
+
+_worker = None # 在 worker process 中轉換各章的 XmlToEpub
+
+def _init_worker(config, state):
+	global _worker
+	_worker = XmlToEpub(config)
+	_worker.chars = state['chars']
+	_worker.charset_declaration = state['charset_declaration']
+	_worker.css_filename = state['css_filename']
+	_worker.book = _worker.new_book()
+	_worker.book.title = state['title']
+	
+def _render_chapter(data, parent_tag, lang, chapter, head_count):
+	''' 在 worker process 中轉換一章, 傳回 (XmlToEpub.merge_chapter() 需要的結果, 效能紀錄) '''
+	c = _worker
+	parent = etree.Element(parent_tag)
+	div = etree.fromstring(data)
+	parent.append(div)
+	c.index = StructureIndex(parent)
+	c.chapter = chapter
+	c.head_count = head_count
+	c.div_level = 0
+	c.list_level = 0
+	c.current_toc_node = [c.book.toc_root]
+	result = c.render_chapter(div, lang)
+	# 傳回 worker 中的效能紀錄, 由主 process 合併
+	stats = None
+	if c.profiler is not None:
+		stats = c.profiler.take_worker_stats()
+	return result, stats
+
+def make_text_processor(text_map=None, callback=None):
+	''' 傳回處理一個文字節點的函式: 先依 text_map (字串 => 字串) 替換, 再將 & < > 跳脫、移除換行, 最後呼叫 callback
+	text_map 的所有 key 編譯為一個 regex, 一次替換完; 跳脫只在有這些字元時才做 replace,
+	中文為主的文字大多不含這些字元, 比 str.translate 逐字查表快很多 '''
+	pattern = None
+	if text_map:
+		keys = sorted(text_map, key=len, reverse=True) # 較長的 key 優先
+		pattern = re.compile('|'.join(re.escape(k) for k in keys))
+		get = text_map.__getitem__
+		replace = lambda m: get(m.group())
+	def process(s):
+		if pattern is not None:
+			s = pattern.sub(replace, s)
+		if '&' in s:
+			s = s.replace('&', '&amp;')
+		if '<' in s:
+			s = s.replace('<', '&lt;')
+		if '>' in s:
+			s = s.replace('>', '&gt;')
+		if '\n' in s:
+			s = s.replace('\n', '')
+		if callback is not None:
+			s = callback(s)
+		return s
+	return process
+
+def apply_text_batch(e, func, size=TEXT_BATCH_SIZE):
+	''' 將 e 之中 (不含 e.tail) 的文字節點分批傳給 func(list of str), 以傳回的 list 取代原來的文字 '''
+	nodes = [] # (元素, 是否為 tail)
+	texts = []
+	def flush():
+		result = func(texts)
+		if len(result) != len(texts):
+			raise ValueError('handle_text_batch 傳回 {} 個字串, 應為 {} 個'.format(len(result), len(texts)))
+		for (n, is_tail), s in zip(nodes, result):
+			if is_tail:
+				n.tail = s
+			else:
+				n.text = s
+		del nodes[:]
+		del texts[:]
+	for n in e.iter():
+		if isinstance(n.tag, str) and n.text is not None:
+			nodes.append((n, False))
+			texts.append(n.text)
+		if n is not e and n.tail is not None:
+			nodes.append((n, True))
+			texts.append(n.tail)
+		if len(texts) >= size:
+			flush()
+	if len(texts) > 0:
+		flush()
+
+def count_toc_heads(e):
+	''' e 之中會列入目錄的 head 數, 即 handle_head() 增加 head_count 的次數 '''
+	n = 0
+	for h in e.iter('head'):
+		if h.getparent().tag == 'div' and h.get('type') != 'sub':
+			n += 1
+	return n
+
+class SandboxError(ValueError):
+	''' 引用的檔案不在 sandbox 之中 '''
+	pass
+
+def sandbox_path(folder, url):
+	''' 傳回 url 所指的檔案路徑, 不在 folder 之中時 raise SandboxError '''
+	parts = urllib.parse.urlsplit(url)
+	if parts.scheme == 'file':
+		path = urllib.request.url2pathname(parts.path)
+	elif len(parts.scheme) > 1: # 一個字母的是 Windows 的磁碟代號
+		raise SandboxError('不允許的路徑: ' + url)
+	else:
+		path = url
+	folder = os.path.abspath(folder)
+	path = os.path.abspath(path)
+	if os.path.commonpath([folder, path]) != folder:
+		raise SandboxError('路徑不在 sandbox 之中: ' + url)
+	return path
+
+def check_includes(root, folder):
+	''' root 之中的 xi:include 都必須引用 folder 之中的檔案
+	parse="text" 的 xi:include 不經過 resolver, 所以要在 xinclude() 之前先檢查 '''
+	for e in root.iter(XINCLUDE):
+		href = e.get('href')
+		if href:
+			base = e.base or ''
+			sandbox_path(folder, urllib.parse.urljoin(base, href) if '://' in base else os.path.join(os.path.dirname(base), href))
+
+class SandboxResolver(etree.Resolver):
+	''' xinclude() 讀取 parse="xml" 的檔案時使用, 只讀取 folder 之中的檔案, 並檢查其中的 xi:include
+	在 resolver 中 raise 會被 lxml 延後到下一次 parse, 所以先記在 error, 由呼叫者 raise '''
+	def __init__(self, folder, huge_tree=False):
+		super().__init__()
+		self.folder = folder
+		self.huge_tree = huge_tree
+		self.error = None
+
+	def resolve(self, url, pubid, context):
+		try:
+			path = sandbox_path(self.folder, url)
+			with open(path, 'rb') as fi:
+				data = fi.read()
+			check_includes(etree.fromstring(data, etree.XMLParser(huge_tree=self.huge_tree), base_url=path), self.folder)
+		except (SandboxError, OSError, etree.XMLSyntaxError) as e:
+			if self.error is None:
+				self.error = e if isinstance(e, SandboxError) else SandboxError('無法讀取 {}: {}'.format(url, e))
+			return self.resolve_empty(context)
+		return self.resolve_string(data, context, base_url=path)
+
+def convert_bytes(xml, config):
+	''' 將 XML (bytes) 轉換為 EPUB, 傳回 EPUB 的 bytes, 不寫任何暫存檔
+	config 與 XmlToEpub 相同, 但不需要 xml, epub_path, temp_folder
+	xi:include 及相對路徑以 config 中的 xml (如果有的話) 所在的資料夾為基準
+	config 中有 sandbox (資料夾) 時, xi:include、圖片、缺字字圖都只能引用 sandbox 之中的檔案,
+	沒有 xml 時 graphic_base, glyph_base 預設為 sandbox; 轉換上傳的 XML 時使用 '''
+	config = dict(config)
+	config.pop('temp_folder', None)
+	config.pop('streaming', None)
+	config.pop('targets', None) # 只寫出一個 EPUB 到記憶體
+	huge_tree = config.get('huge_tree', False)
+	sandbox = config.get('sandbox')
+	resolver = None
+	if sandbox is None:
+		parser = get_parser(huge_tree, config.get('remove_comments', True), config.get('remove_pis', True))
+	else:
+		# resolver 是 parser 的一部分, 不能放進共用的 parser
+		parser = etree.XMLParser(huge_tree=huge_tree, remove_comments=config.get('remove_comments', True),
+			remove_pis=config.get('remove_pis', True))
+		resolver = SandboxResolver(sandbox, huge_tree)
+		parser.resolvers.add(resolver)
+	base_url = config.pop('xml', None)
+	base = sandbox if base_url is None else os.path.dirname(base_url)
+	if base is not None:
+		config.setdefault('graphic_base', base)
+		config.setdefault('glyph_base', base)
+	root = etree.fromstring(xml, parser, base_url=base_url)
+	tree = root.getroottree()
+	if resolver is None:
+		tree.xinclude()
+	else:
+		check_includes(root, sandbox)
+		try:
+			tree.xinclude()
+		except etree.XIncludeError:
+			if resolver.error is not None:
+				raise resolver.error
+			raise
+		if resolver.error is not None:
+			raise resolver.error
+	# tree 是這裡建立的, 直接去掉 namespace, XmlToEpub 就不必再複製一份
+	config['lxml-etree'] = strip_namespaces(tree)
+	out = io.BytesIO()
+	config['epub_path'] = out
+	XmlToEpub(config).convert()
+	return out.getvalue()
+	
 def clear_folder(folder):
 	files = os.listdir(folder)
 	for f in files:
@@ -758,36 +1834,33 @@ def clear_folder(folder):
 		else:
 			os.remove(path)
 
+def get_parser(huge_tree=False, remove_comments=True, remove_pis=True):
+	''' 傳回 XML parser, 相同設定的 parser 只建立一次 '''
+	key = (huge_tree, remove_comments, remove_pis)
+	parser = _parsers.get(key)
+	if parser is None:
+		parser = etree.XMLParser(huge_tree=huge_tree, remove_comments=remove_comments, remove_pis=remove_pis)
+		_parsers[key] = parser
+	return parser
+
 def strip_namespaces(tree):
-	# http://wiki.tei-c.org/index.php/Remove-Namespaces.xsl
-	xslt_root = etree.XML('''\
-<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
-<xsl:output method="xml" indent="no"/>
-
-<xsl:template match="/|comment()|processing-instruction()">
-    <xsl:copy>
-      <xsl:apply-templates/>
-    </xsl:copy>
-</xsl:template>
-
-<xsl:template match="*">
-    <xsl:element name="{local-name()}">
-      <xsl:apply-templates select="@*|node()"/>
-    </xsl:element>
-</xsl:template>
-
-<xsl:template match="@*">
-    <xsl:attribute name="{local-name()}">
-      <xsl:value-of select="."/>
-    </xsl:attribute>
-</xsl:template>
-</xsl:stylesheet>
-''')
-	transform = etree.XSLT(xslt_root)
-	tree = transform(tree)
+	''' 就地去掉 tree 中所有元素及屬性的 namespace, 傳回同一個 tree
+	以前用 XSLT 產生一個新的 tree (http://wiki.tei-c.org/index.php/Remove-Namespaces.xsl),
+	記憶體用量加倍, 所以改為直接修改 '''
+	strip_subtree_namespaces(tree.getroot())
 	return tree
 
-def has_descendant(ance, desc):
-	for e in ance.iterdescendants(tag=desc):
-		return True
-	return False
\ No newline at end of file
+def strip_element_namespace(e):
+	''' 去掉單一元素標記及屬性的 namespace, 不處理子元素 '''
+	if e.tag[0] == '{':
+		e.tag = e.tag.split('}', 1)[1]
+	for k in e.attrib.keys():
+		if k[0] == '{':
+			v = e.attrib.pop(k)
+			e.set(k.split('}', 1)[1], v)
+
+def strip_subtree_namespaces(e):
+	''' 就地去掉 e 及其所有子元素的 namespace '''
+	for n in e.iter(tag=etree.Element):
+		strip_element_namespace(n)
+	etree.cleanup_namespaces(e)